@@ -0,0 +1,385 @@
+import os
+import sys
+import json
+import time
+import runpy
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import subprocess
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+KB = 1024
+MB = 1024 * 1024
+
+# Synthetic manifests: name -> list of (count, size in bytes). --scale multiplies the counts
+# of small files and the sizes of large ones, so the shape stays the same at any scale.
+MANIFESTS = {
+    "small": [(2000, 32 * KB)],
+    "huge": [(4, 256 * MB)],
+    "mixed": [(500, 64 * KB), (20, 4 * MB), (2, 256 * MB)],
+}
+LARGE_FILE_BYTES = 16 * MB
+
+# Fault profiles for the server (see benchmarks/server.py DEFAULT_FAULTS)
+SCENARIOS = {
+    "clean": {},
+    "wan": {"latency_seconds": 0.05, "bandwidth_bytes_per_sec": 20 * MB},
+    "no-ranges": {"ranges": False, "disconnect_probability": 0.02},
+    "faulty": {"latency_seconds": 0.01, "disconnect_probability": 0.05, "throttle_probability": 0.03,
+               "unavailable_probability": 0.02, "zero_byte_probability": 0.02, "retry_after_seconds": 1},
+}
+
+# Downloader configurations: overrides of configs.py. Keys a revision doesn't know are ignored by it,
+# so every configuration runs on any revision of hpc_downloader.py
+CONFIGS = {
+    "w4": {"max_concurrent_downloads": 4},
+    "w16": {"max_concurrent_downloads": 16},
+    "w8-seg4": {"max_concurrent_downloads": 8, "segments_per_file": 4, "segmented_min_size_bytes": 64 * MB},
+    "adaptive": {"max_concurrent_downloads": 4, "adaptive_concurrency": True, "concurrency_max": 16,
+                 "per_host_initial_concurrency": 4, "per_host_max_concurrency": 16,
+                 "concurrency_adjust_interval_seconds": 5},
+}
+
+# Shorter timeouts and backoff than configs.py so faulty scenarios finish in minutes
+BASE_CONFIG = {
+    "curl_retry_attempts": 3,
+    "curl_retry_delay_seconds": 1,
+    "curl_retry_max_time_seconds": 30,
+    "curl_connect_timeout_seconds": 10,
+    "curl_max_time_seconds": 600,
+    "curl_speed_time_seconds": 30,
+    "curl_speed_limit_bytes_per_sec": 1000,
+    "downloader_max_retries": 5,
+    "downloader_initial_retry_delay_seconds": 1,
+    "downloader_aggressive_max_retries": 3,
+    "downloader_aggressive_initial_retry_delay_seconds": 2,
+    "downloader_aggressive_timeout_seconds": 900,
+    "status_snapshot_interval_seconds": 5,
+    "status_snapshot_every_events": 1000,
+    "metrics_flush_interval_seconds": 5,
+}
+
+
+def manifest_urls(base_url, manifest, scale=1.0):
+    """URLs of a synthetic manifest; the server derives each file's size from its name"""
+    urls = []
+    index = 0
+    for count, size in MANIFESTS[manifest]:
+        if size >= LARGE_FILE_BYTES:
+            size = max(1, int(size * scale))
+        else:
+            count = max(1, int(count * scale))
+        for _ in range(count):
+            urls.append(f"{base_url}/{manifest}/f{index:05d}_{size}.bin")
+            index += 1
+    return urls
+
+
+def git_revision(repo=REPO_ROOT):
+    """(commit hash, True if the working tree has uncommitted changes) of the code being benchmarked"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def curl_version():
+    try:
+        return subprocess.run(["curl", "--version"], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def file_size_from_url(url):
+    return int(url.rsplit("_", 1)[1].split(".")[0])
+
+
+# ---- child: one benchmark run in a fresh process ----
+
+def run_child(spec_path):
+    """
+    Run hpc_downloader.py of the benchmarked tree once with the configuration
+    of the spec file and write the measurements. Only configs.config and the
+    script itself are used, so this works on any revision of the downloader.
+    """
+    with open(spec_path, 'r') as f:
+        spec = json.load(f)
+    repo = spec["repo"]
+    # This file's directory must not shadow the benchmarked tree's modules
+    sys.path[0] = repo
+    sys.argv = [os.path.join(repo, "hpc_downloader.py")]
+    import configs
+    configs.config.update(spec["config"])
+
+    started = time.time()
+    try:
+        runpy.run_path(sys.argv[0], run_name="__main__")
+        returncode = 0
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    makespan = time.time() - started
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN) # curl processes
+
+    cpu_seconds = usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+    measurements = {
+        "downloader_returncode": returncode,
+        "makespan_seconds": round(makespan, 3),
+        "cpu_user_seconds": round(usage_self.ru_utime, 3),
+        "cpu_system_seconds": round(usage_self.ru_stime, 3),
+        "cpu_children_user_seconds": round(usage_children.ru_utime, 3),
+        "cpu_children_system_seconds": round(usage_children.ru_stime, 3),
+        "cpu_seconds": round(cpu_seconds, 3),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(usage_self.ru_maxrss / KB, 1),
+        "children_peak_rss_mb": round(usage_children.ru_maxrss / KB, 1),
+    }
+    with open(spec["result_path"], 'w') as f:
+        json.dump(measurements, f)
+
+
+def check_downloads(download_dir, urls, digests):
+    """URLs whose file is in download_dir with the right size (and digest, if given); read from disk, so any revision can be checked"""
+    from benchmarks.server import expected_content_digest
+    succeeded = []
+    for url in urls:
+        path = os.path.join(download_dir, url.rsplit("/", 1)[1])
+        if not os.path.isfile(path) or os.path.getsize(path) != file_size_from_url(url):
+            continue
+        if url in digests:
+            hasher = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(MB), b""):
+                    hasher.update(chunk)
+            if hasher.hexdigest() != digests[url]:
+                continue
+        succeeded.append(url)
+    return succeeded
+
+
+# ---- parent: server, matrix and report ----
+
+def start_server(scenario, seed):
+    """Start benchmarks/server.py in its own process (so it does not share CPU accounting) and return (process, base URL)"""
+    args = [sys.executable, "-m", "benchmarks.server", "--seed", str(seed)]
+    for key, value in SCENARIOS[scenario].items():
+        args += ["--" + key.replace("_", "-"), str(value)]
+    process = subprocess.Popen(args, cwd=REPO_ROOT, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line.startswith("LISTENING "):
+        process.kill()
+        raise RuntimeError(f"Benchmark server for scenario '{scenario}' did not start")
+    return process, line.split()[1]
+
+
+def run_one(work_dir, base_url, scenario, manifest, backend, config_name, repeat, args):
+    from benchmarks.server import expected_content_digest
+    run_dir = tempfile.mkdtemp(prefix=f"{scenario}-{manifest}-{backend}-{config_name}-", dir=work_dir)
+    urls = manifest_urls(base_url, manifest, args.scale)
+    digests = {}
+    if args.digests:
+        digests = {url: expected_content_digest(url[len(base_url):]) for url in urls}
+        # Revisions that read a checksum manifest also verify the digests while downloading
+        with open(os.path.join(run_dir, "checksums.sha256"), 'w') as f:
+            f.writelines(f"{digest}  {url.rsplit('/', 1)[1]}\n" for url, digest in digests.items())
+    links_path = os.path.join(run_dir, "links.txt")
+    with open(links_path, 'w') as f:
+        f.writelines(f"{url} size={file_size_from_url(url)}\n" if args.sizes else f"{url}\n" for url in urls)
+    download_dir = os.path.join(run_dir, "downloads")
+    config = dict(BASE_CONFIG, download_dir=download_dir, links_file_path=links_path, download_backend=backend,
+                  metrics_enabled=args.metrics,
+                  checksum_manifest_path=os.path.join(run_dir, "checksums.sha256") if digests else None)
+    config.update(CONFIGS[config_name])
+    spec = {
+        "repo": args.repo,
+        "result_path": os.path.join(run_dir, "result.json"),
+        "config": config,
+    }
+    spec_path = os.path.join(run_dir, "spec.json")
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+
+    log_path = os.path.join(run_dir, "downloader.log")
+    with open(log_path, 'w') as log:
+        try:
+            # Started by path and from run_dir, so the benchmarked tree's modules are the ones imported
+            returncode = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", spec_path],
+                                        cwd=run_dir, stdout=log, stderr=subprocess.STDOUT,
+                                        timeout=args.timeout).returncode
+        except subprocess.TimeoutExpired:
+            returncode = "timeout"
+    record = {"scenario": scenario, "manifest": manifest, "backend": backend, "config": config_name,
+              "repeat": repeat, "returncode": returncode}
+    try:
+        with open(spec["result_path"], 'r') as f:
+            record.update(json.load(f))
+    except (OSError, ValueError):
+        record["log_tail"] = _tail(log_path)
+    if "makespan_seconds" in record:
+        succeeded = check_downloads(download_dir, urls, digests)
+        downloaded_bytes = sum(file_size_from_url(url) for url in succeeded)
+        makespan = record["makespan_seconds"]
+        record.update({
+            "files": len(urls),
+            "succeeded": len(succeeded),
+            "failed": len(urls) - len(succeeded),
+            "bytes": downloaded_bytes,
+            "throughput_mb_per_second": round(downloaded_bytes / MB / makespan, 2) if makespan else None,
+            "files_per_second": round(len(succeeded) / makespan, 2) if makespan else None,
+            "cpu_seconds_per_gb": round(record["cpu_seconds"] / (downloaded_bytes / (1024 * MB)), 3) if downloaded_bytes else None,
+        })
+    if args.keep:
+        record["run_dir"] = run_dir
+    else:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return record
+
+
+def _tail(path, lines=20):
+    try:
+        with open(path, 'r', errors='replace') as f:
+            return f.readlines()[-lines:]
+    except OSError:
+        return []
+
+
+def run_matrix(args):
+    commit, dirty = git_revision(args.repo)
+    report = {
+        "git_commit": commit,
+        "git_dirty": dirty,
+        "repo": args.repo,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "curl": curl_version(),
+        "cpu_count": os.cpu_count(),
+        "scale": args.scale,
+        "digests": args.digests,
+        "sizes": args.sizes,
+        "results": [],
+    }
+    work_dir = tempfile.mkdtemp(prefix="hpc-downloader-bench-", dir=args.work_dir)
+    try:
+        for scenario in args.scenarios:
+            server, base_url = start_server(scenario, args.seed)
+            try:
+                for manifest, backend, config_name, repeat in itertools.product(
+                        args.manifests, args.backends, args.configs, range(args.repeat)):
+                    record = run_one(work_dir, base_url, scenario, manifest, backend, config_name, repeat, args)
+                    report["results"].append(record)
+                    print(_format_row(record), flush=True)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = args.output
+    if output is None:
+        os.makedirs(os.path.join(REPO_ROOT, "benchmarks", "results"), exist_ok=True)
+        output = os.path.join(REPO_ROOT, "benchmarks", "results",
+                              f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{(commit or 'unknown')[:10]}.json")
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Results written to {output}")
+    return report
+
+
+HEADER = f"{'scenario':<10} {'manifest':<7} {'backend':<5} {'config':<9} {'ok/total':>10} {'makespan':>9} {'MB/s':>8} " \
+         f"{'CPU s':>7} {'CPU s/GB':>8} {'RSS MB':>7} {'curl RSS':>8}"
+
+
+def _format_row(record):
+    if "makespan_seconds" not in record:
+        return f"{record['scenario']:<10} {record['manifest']:<7} {record['backend']:<5} {record['config']:<9} " \
+               f"run failed (exit {record['returncode']})"
+    return (f"{record['scenario']:<10} {record['manifest']:<7} {record['backend']:<5} {record['config']:<9} "
+            f"{record['succeeded']:>5}/{record['files']:<4} {record['makespan_seconds']:>8.1f}s "
+            f"{record['throughput_mb_per_second'] or 0:>8.1f} {record['cpu_seconds']:>7.1f} "
+            f"{record['cpu_seconds_per_gb'] or 0:>8.2f} {record['peak_rss_mb']:>7.0f} {record['children_peak_rss_mb']:>8.0f}")
+
+
+def compare_reports(old_path, new_path, out=sys.stdout):
+    """Print per-run changes between two result files (repeats are averaged)"""
+    def load(path):
+        with open(path, 'r') as f:
+            report = json.load(f)
+        runs = {}
+        for record in report["results"]:
+            if "makespan_seconds" in record:
+                key = (record["scenario"], record["manifest"], record["backend"], record["config"])
+                runs.setdefault(key, []).append(record)
+        averaged = {key: {field: sum(r[field] or 0 for r in records) / len(records)
+                          for field in ("makespan_seconds", "throughput_mb_per_second", "cpu_seconds", "peak_rss_mb")}
+                    for key, records in runs.items()}
+        return report, averaged
+
+    old_report, old_runs = load(old_path)
+    new_report, new_runs = load(new_path)
+    out.write(f"old: {old_report['git_commit']} ({old_report['started_at']})\n")
+    out.write(f"new: {new_report['git_commit']} ({new_report['started_at']})\n")
+    out.write(f"{'run':<40} {'makespan':>18} {'MB/s':>18} {'CPU s':>18} {'RSS MB':>16}\n")
+
+    def change(old, new):
+        percent = f"{(new - old) / old * 100:+.0f}%" if old else "n/a"
+        return f"{old:.1f}->{new:.1f} {percent:>5}"
+
+    for key in sorted(set(old_runs) & set(new_runs)):
+        old, new = old_runs[key], new_runs[key]
+        out.write(f"{'/'.join(key):<40} {change(old['makespan_seconds'], new['makespan_seconds']):>18} "
+                  f"{change(old['throughput_mb_per_second'], new['throughput_mb_per_second']):>18} "
+                  f"{change(old['cpu_seconds'], new['cpu_seconds']):>18} "
+                  f"{change(old['peak_rss_mb'], new['peak_rss_mb']):>16}\n")
+    for key in sorted(set(old_runs) ^ set(new_runs)):
+        out.write(f"{'/'.join(key):<40} only in {'old' if key in old_runs else 'new'}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark hpc_downloader.py against a local "
+                                                 "fault-injecting HTTP server.")
+    parser.add_argument("--repo", default=REPO_ROOT, type=os.path.abspath,
+                        help="Tree whose hpc_downloader.py is benchmarked, e.g. a git worktree of an older "
+                             "commit (default: this one)")
+    parser.add_argument("--scenarios", nargs="+", default=["clean", "faulty"], choices=sorted(SCENARIOS))
+    parser.add_argument("--manifests", nargs="+", default=["small", "huge", "mixed"], choices=sorted(MANIFESTS))
+    parser.add_argument("--backends", nargs="+", default=["curl", "http"], choices=["curl", "http"])
+    parser.add_argument("--configs", nargs="+", default=["w4", "w8-seg4"], choices=sorted(CONFIGS))
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per combination")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplies small-file counts and large-file sizes")
+    parser.add_argument("--digests", action="store_true", help="Also verify sha256 digests (while downloading, on "
+                                                               "revisions that read checksum_manifest_path)")
+    parser.add_argument("--sizes", action="store_true", help="Write size= after each URL in the links file "
+                                                             "(only for revisions that parse it)")
+    parser.add_argument("--metrics", action="store_true", help="Record per-attempt metrics during runs")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the server's fault injection")
+    parser.add_argument("--timeout", type=float, default=1800, help="Seconds before a run is abandoned")
+    parser.add_argument("--work-dir", default=None, help="Where to download to (default: system temp dir)")
+    parser.add_argument("--keep", action="store_true", help="Keep downloads and logs of every run")
+    parser.add_argument("--output", default=None, help="Result file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit")
+    parser.add_argument("--child", metavar="SPEC", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        return run_child(args.child)
+    if args.compare:
+        return compare_reports(*args.compare)
+    print(HEADER, flush=True)
+    run_matrix(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+import re
+import sys
+import time
+import random
+import hashlib
+import argparse
+import threading
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Fault injection settings of the benchmark server. Probabilities are per GET request.
+DEFAULT_FAULTS = {
+    "bandwidth_bytes_per_sec": 0,    # Per-connection bandwidth cap (0 = unlimited)
+    "latency_seconds": 0.0,          # Delay before every response
+    "ranges": True,                  # Honour Range requests and advertise Accept-Ranges
+    "disconnect_probability": 0.0,   # Drop the connection somewhere in the middle of the body
+    "throttle_probability": 0.0,     # Answer 429 Too Many Requests
+    "unavailable_probability": 0.0,  # Answer 503 Service Unavailable
+    "zero_byte_probability": 0.0,    # Answer 200 with an empty body
+    "retry_after_seconds": 1,        # Retry-After sent with 429/503
+    "seed": 0,                       # Seed for the fault dice, so runs are reproducible
+    "content_version": 0,            # Changing it changes every file's content, ETag and Last-Modified
+}
+
+PATTERN_SIZE = 64 * 1024
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+def file_size_from_path(path):
+    """Synthetic files are named "<anything>_<size>.bin"; the size comes from the last number in the path"""
+    numbers = re.findall(r"(\d+)", path.split("?")[0])
+    return int(numbers[-1]) if numbers else 1024
+
+
+def file_pattern(path, version=0):
+    """Repeating 64 KiB block that makes up the content of path (deterministic, so downloads can be checked)"""
+    seed = hashlib.sha256(f"{path.split('?')[0]}|{version or ''}".encode()).digest()
+    return (seed * (PATTERN_SIZE // len(seed)))[:PATTERN_SIZE]
+
+
+def expected_content_digest(path, version=0):
+    """sha256 of the full synthetic content of path, for checking downloaded files"""
+    pattern = file_pattern(path, version)
+    size = file_size_from_path(path)
+    hasher = hashlib.sha256()
+    full, rest = divmod(size, PATTERN_SIZE)
+    for _ in range(full):
+        hasher.update(pattern)
+    hasher.update(pattern[:rest])
+    return hasher.hexdigest()
+
+
+class _FaultInjectingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "hpc-downloader-bench"
+
+    def log_message(self, format, *args):
+        pass # Keep benchmark output clean
+
+    def _roll(self, probability):
+        if probability <= 0:
+            return False
+        with self.server.rng_lock:
+            return self.server.rng.random() < probability
+
+    def _send_error(self, status):
+        self.send_response(status)
+        self.send_header("Retry-After", str(self.server.faults["retry_after_seconds"]))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.do_GET(head_only=True)
+
+    def do_GET(self, head_only=False):
+        faults = self.server.faults
+        with self.server.rng_lock:
+            self.server.requests += 1
+        if faults["latency_seconds"]:
+            time.sleep(faults["latency_seconds"])
+
+        if not head_only:
+            if self._roll(faults["throttle_probability"]):
+                return self._send_error(429)
+            if self._roll(faults["unavailable_probability"]):
+                return self._send_error(503)
+            if self._roll(faults["zero_byte_probability"]):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        size = file_size_from_path(self.path)
+        version = faults["content_version"]
+        etag = f'"{hashlib.md5(self.path.split("?")[0].encode()).hexdigest()}-{size}-{version}"'
+        last_modified = formatdate(1700000000 + 86400 * version, usegmt=True)
+        if self.headers.get("If-None-Match") == etag or (not self.headers.get("If-None-Match")
+                                                          and self.headers.get("If-Modified-Since") == last_modified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end, status = 0, size - 1, 200
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range not in (etag, last_modified):
+            range_header = None # The object changed since the client's partial copy: send all of it
+        if range_header and faults["ranges"]:
+            match = re.match(r"bytes=(\d+)-(\d*)", range_header)
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status = 206
+
+        self.send_response(status)
+        if faults["ranges"]:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        if head_only:
+            return
+
+        cut_at = None
+        if end >= start and self._roll(faults["disconnect_probability"]):
+            with self.server.rng_lock:
+                cut_at = start + self.server.rng.randint(0, end - start)
+        self._send_body(start, end, cut_at)
+
+    def _send_body(self, start, end, cut_at):
+        pattern = file_pattern(self.path, self.server.faults["content_version"])
+        bandwidth = self.server.faults["bandwidth_bytes_per_sec"]
+        sent = 0
+        began = time.time()
+        position = start
+        while position <= end:
+            offset = position % PATTERN_SIZE
+            length = min(WRITE_CHUNK_SIZE, PATTERN_SIZE - offset, end - position + 1)
+            if cut_at is not None and position + length > cut_at:
+                length = cut_at - position
+                if length > 0:
+                    self.wfile.write(pattern[offset:offset + length])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(2) # Mid-stream disconnect
+                return
+            try:
+                self.wfile.write(pattern[offset:offset + length])
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            position += length
+            sent += length
+            if bandwidth:
+                # Sleep until this connection is back under its cap
+                ahead = sent / bandwidth - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+class BenchmarkServer:
+    """Local HTTP server serving synthetic files of any size with injected faults"""
+
+    def __init__(self, faults=None, host="127.0.0.1", port=0):
+        self.faults = dict(DEFAULT_FAULTS, **(faults or {}))
+        self.httpd = ThreadingHTTPServer((host, port), _FaultInjectingHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.faults = self.faults
+        self.httpd.rng = random.Random(self.faults["seed"])
+        self.httpd.rng_lock = threading.Lock()
+        self.httpd.requests = 0
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="bench-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fault-injecting HTTP server for downloader benchmarks. "
+                                                 "Serves /<anything>_<size>.bin with deterministic content.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 picks a free port (printed on startup)")
+    for key, default in DEFAULT_FAULTS.items():
+        option = "--" + key.replace("_", "-")
+        if isinstance(default, bool):
+            parser.add_argument(option, type=lambda v: v.lower() in ("1", "true", "yes", "on"), default=default)
+        else:
+            parser.add_argument(option, type=type(default), default=default)
+    args = parser.parse_args(argv)
+    faults = {key: getattr(args, key) for key in DEFAULT_FAULTS}
+    server = BenchmarkServer(faults, args.host, args.port)
+    # The runner reads this line to find the port
+    print(f"LISTENING {server.base_url}", flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,7 +10,119 @@ os.makedirs(download_links_dir, exist_ok=True)
 config = {
     "download_dir": download_dir, # Directory to save downloaded files
     "max_concurrent_downloads": 3, # Max parallel downloads
-    "links_file_path": os.path.join(download_links_dir, "download_links1.txt"),
+    "links_file_path": os.path.join(download_links_dir, "download_links1.txt"), # A path, glob pattern or list of them; .gz files are read directly
+
+    # Integrity checks. Lines of the links file may carry "size=<bytes>" and "sha256=<hex>" / "md5=<hex>"
+    # after the URL; digests are computed while the file is written and a mismatch triggers a re-download
+    "checksum_manifest_path": None,   # Optional sha256sum/md5sum style file ("<digest>  <filename>") with expected digests
+    "verify_existing_on_resume": True, # Check files from earlier runs against their expected size/digest at startup
+    "verify_existing_rehash_completed": False, # Also re-hash completed files whose digest was recorded at download time
+    "verify_processes": 4,            # Processes used to hash existing files at startup
+    "verify_suspicious_size_bytes": 1024 * 1024, # Final check reports files below this size when no size is expected
+
+    # Startup reconciliation: partial files left by an interrupted run are checked against the server
+    # (size, ETag/Last-Modified and their last bytes) before any download starts; skipped after a checkpoint
+    "reconcile_on_resume": True,      # Classify partial files as complete, resumable or to be restarted at startup
+    "reconcile_concurrency": 32,      # Parallel probe/range requests while reconciling
+    "reconcile_tail_bytes": 64 * 1024, # Bytes at the end of each partial file compared with the server's copy
+
+    # Performance metrics in download_dir/metrics: one JSON line per attempt (attempts.jsonl)
+    # and rolling aggregates (summary.json), rewritten every metrics_flush_interval_seconds
+    "metrics_enabled": True,          # Record per-attempt timings and aggregates
+    "metrics_window_seconds": 300,    # Window for rolling throughput and p50/p95 figures
+    "metrics_flush_interval_seconds": 15, # How often the aggregates are written out
+    "metrics_prometheus_textfile": None, # Optional .prom file for node_exporter's textfile collector, e.g. "/var/lib/node_exporter/textfile/hpc_downloader.prom"
+
+    # Transport used for each download attempt
+    "download_backend": "curl",       # "curl": one curl subprocess per attempt; "http": in-process client with keep-alive connection pooling
+    "http_max_idle_connections_per_host": 4, # Idle keep-alive connections kept per host by the "http" backend
+
+    # Adaptive concurrency: when enabled, max_concurrent_downloads is only the starting total
+    "adaptive_concurrency": False,    # Tune the number of parallel downloads from throughput, errors and 429/503 responses
+    "concurrency_min": 1,             # Lower bound for the total number of parallel downloads
+    "concurrency_max": 16,            # Upper bound for the total number of parallel downloads
+    "per_host_initial_concurrency": 2, # Starting limit of parallel downloads from one host
+    "per_host_max_concurrency": 8,    # Upper bound of parallel downloads from one host
+    "concurrency_adjust_interval_seconds": 30, # How often the total limit is re-evaluated
+    "concurrency_error_rate_threshold": 0.2, # Network error rate above which the total limit is cut by a quarter
+
+    # Pre-flight probing: HEAD requests (or 0-0 range GETs) collect size, range support, ETag and
+    # Last-Modified of every URL before downloading; results are cached in the state journal
+    "probe_before_download": False,   # Probe all URLs first, for size-aware ordering and a projected ETA
+    "probe_concurrency": 32,          # Parallel probe requests
+    "probe_cache_max_age_seconds": 86400, # Cached probe results older than this are refreshed
+    "download_order": "file",         # "file": links file order; "largest_first": biggest first (LPT); "host_balanced": even out hosts
+    "eta_stream_bytes_per_sec": 50 * 1024 * 1024, # Assumed speed of one download for the projected ETA
+
+    # Shared content cache: completed downloads are kept in cache_dir with their ETag/Last-Modified and
+    # reused by later runs and other jobs through a hardlink (or reflink, or copy) instead of downloading
+    "cache_dir": None,                # e.g. "/scratch/<project>/hpc_downloader_cache" (None disables the cache)
+    "cache_max_bytes": 500 * 1024**3, # Least recently used entries are evicted above this size (500 GB)
+    "cache_revalidate": True,         # Check a cached copy with If-None-Match/If-Modified-Since before using it
+    "revalidate_completed": False,    # Re-check COMPLETED files the same way and download them again if they changed
+
+    # Bandwidth governor: a token bucket shared by all workers caps the download rate; with
+    # bandwidth_bucket_dir on node-local shared memory, every job on the node shares the same budget
+    "bandwidth_limit_bytes_per_sec": None, # Total download rate, e.g. 200 * 1024 * 1024 (None: unlimited)
+    "bandwidth_schedule": [],         # Time-of-day limits, e.g. [{"start": "08:00", "end": "18:00", "days": "mon-fri", "bytes_per_sec": 50 * 1024 * 1024}]
+    "bandwidth_host_limits": {},      # Per-host limits within the total, e.g. {"data.example.org": 20 * 1024 * 1024}
+    "bandwidth_bucket_dir": "/dev/shm/hpc_downloader_bandwidth", # Bucket files shared by jobs on the node (None: this job only)
+
+    # Staging: downloads are written to node-local scratch and moved into download_dir in large
+    # sequential batches by a background flusher, sparing the parallel filesystem many small writes
+    "staging_dir": None,              # e.g. "$TMPDIR/hpc_downloader_staging" or "/dev/shm/hpc_downloader_staging" (None: write to download_dir directly)
+    "staging_max_bytes": 50 * 1024**3, # Scratch space for running and unflushed downloads; new downloads wait above this (50 GB)
+    "staging_flush_batch_bytes": 4 * 1024**3, # Flush once this much is waiting (4 GB)...
+    "staging_flush_interval_seconds": 30, # ...or once the oldest waiting file is this old
+
+    # Post-processing: steps run on every completed download in a process pool while downloads continue;
+    # the result is recorded per URL in the state journal, so a resumed job doesn't process a file twice
+    "postprocess_steps": [],          # e.g. ["extract"], ["extract", "shell:gzip -t {path}"] or ["python:mypackage.hooks:index_file"]
+    "postprocess_processes": 8,       # Processes for post-processing (slurm_job.sh requests -c 10)
+    "postprocess_output_dir": None,   # Where "extract" unpacks archives (None: download_dir/extracted)
+
+    # Mirrors: a links file line may list further URLs of the same object; the fastest source is used,
+    # a failed download switches to the next mirror at once, and segments are spread over the mirrors
+    "mirror_probe_hosts": True,       # Probe each new mirror host once for its latency before ranking it
+    "mirror_failure_cooldown_seconds": 60, # A failing mirror host is ranked last for this long (doubling per failure)
+
+    # Slurm time limit: the end time comes from SLURM_JOB_END_TIME or squeue; SIGUSR1 (sbatch --signal=B:USR1@300)
+    # and SIGTERM are handled too. Interrupted downloads are checkpointed in the journal and resumed by the next job.
+    "slurm_stop_margin_seconds": 300, # Start no downloads (or retries) this close to the end, nor any that can't finish
+    "slurm_abort_margin_seconds": 60, # Abort running transfers and checkpoint them this close to the end
+    "slurm_signal_lead_seconds": 300, # Time left when SIGUSR1 arrives, if the end time is not known (match --signal)
+    "slurm_requeue": False,           # Requeue the job with scontrol when it stopped with work left (needs sbatch --requeue)
+
+    # Logging: lines are queued by the download threads and written in batches by one background thread
+    "log_format": "text",             # Standard output format: "text" ("[time] message"), "json" or "kv" (key=value)
+    "log_level": "INFO",              # Lowest level written: "DEBUG", "INFO", "WARNING" or "ERROR"
+    "log_file": None,                 # Also append every record to this file as JSON lines (sharded tasks add .task<N>)
+    "log_flush_interval_seconds": 1.0, # Queued records are written at least this often
+    "progress_interval_seconds": 30,  # Progress lines per running download and overall this often (0: none)
+    "progress_max_files": 20,         # Running downloads listed per progress report, largest first
+
+    # Status file (download_dir/download_status.txt) holds a compact snapshot, rewritten atomically
+    "status_snapshot_every_events": 100, # Rewrite the snapshot after this many finished downloads...
+    "status_snapshot_interval_seconds": 30, # ...and at least this often
+    "status_recent_failures": 20,     # Number of most recent failures listed in the snapshot
+
+    # Sharding across Slurm tasks (job arrays via SLURM_ARRAY_TASK_ID/COUNT, or srun tasks via SLURM_PROCID/NTASKS)
+    "shard_mode": "static",           # "static": hash-partition the links file per task; "dynamic": claim batches from a shared queue
+    "shard_claim_batch_size": 50,     # URLs claimed per lock acquisition in dynamic mode
+
+    # State journal (download_dir/download_state/state.db): one SQLite row per URL
+    "state_commit_batch_size": 200,   # Commit buffered state changes after this many updates...
+    "state_commit_interval_seconds": 10, # ...or after this many seconds, whichever comes first
+    "state_journal_per_task": True,   # Sharded tasks write state.task<N>.db each and merge all journals at startup (False: share state.db)
+
+    # Segmented downloads: large files on servers advertising "Accept-Ranges: bytes" are split into
+    # byte ranges fetched over parallel connections and written in place into a preallocated file.
+    # The size must be known before the download starts: from size= in the links file, probe_before_download
+    # or an earlier probe; other URLs are downloaded as a single stream without an extra probe
+    "segments_per_file": 1,           # Parallel range connections per large file, e.g. 4 (1 disables segmentation)
+    "segmented_min_size_bytes": 512 * 1024 * 1024, # Only files at least this large (512 MB) are segmented
+    "segment_max_retries": 5,         # Retries per segment before the whole attempt counts as failed
+    "segment_retry_delay_seconds": 5, # Initial delay between segment retries (doubles, max 60s)
 
     # Curl specific parameters
     "curl_retry_attempts": 3,         # --retry: Number of retries for curl internal transient errors
@@ -25,7 +137,7 @@ config = {
     "downloader_max_retries": 5,      # Number of times the script will re-attempt a failed download_file call
     "downloader_initial_retry_delay_seconds": 10, # Initial delay for the script's retry loop
 
-    # Parameters for the more aggressive retry in retry_failed_downloads
+    # Aggressive retry settings: a URL escalates to these once its normal retries are used up
     "downloader_aggressive_max_retries": 8,
     "downloader_aggressive_initial_retry_delay_seconds": 30,
     "downloader_aggressive_timeout_seconds": 3600, # Corresponds to curl_max_time_seconds for aggressive retries
@@ -1,8 +1,20 @@
 import os
+import glob
+import json
+import time
 from datetime import datetime
 from configs import config as config_dict
 from source.utils import *
 from source.downloader import download_files_concurrently
+from source.state import StateStore
+from source.checksums import load_checksum_manifest, verify_existing_downloads
+from source.probing import probe_urls, order_urls, project_eta, log_projection
+from source.reconcile import reconcile_partial_downloads
+from source.staging import staging_dir_from_params
+from source.transport import get_transport
+from source.sharding import detect_slurm_task, slurm_job_key, partition_links, shared_file_lock, SharedWorkQueue
+from source.jobcontrol import jobcontrol_from_params, requeue_job
+from source.logpipeline import logging_from_params
 
 # Force unbuffered output for real-time monitoring in batch jobs
 sys.stdout.reconfigure(line_buffering=0)  # For Python 3.7+
@@ -10,25 +22,127 @@ sys.stdout.reconfigure(line_buffering=0)  # For Python 3.7+
 
 if __name__ == "__main__":
     app_config, download_dir, state_dir = load_config(config_dict)
+    task_index, task_count = detect_slurm_task()
+
+    # From here on log lines are queued and written in batches by a background thread
+    log_file = app_config.get("log_file")
+    if log_file and task_count > 1:
+        root, ext = os.path.splitext(log_file)
+        log_file = f"{root}.task{task_index}{ext}"
+    logging_from_params(app_config, log_file)
+
+    # Watch the Slurm time limit and its signals from the start, so a signal during startup is not fatal
+    job_control = jobcontrol_from_params(app_config)
+    job_control.install_signal_handlers()
+    job_control.start()
 
     links_file_path = app_config.get("links_file_path", "download_links.txt")
 
-    links = download_file_handler(links_file_path)
+    links, expectations = download_file_handler(links_file_path)
+
+    # Expected digests can also come from a sha256sum/md5sum style manifest, matched by filename
+    checksum_manifest_path = app_config.get("checksum_manifest_path")
+    if checksum_manifest_path:
+        by_filename = load_checksum_manifest(checksum_manifest_path)
+        for url in links:
+            expected = by_filename.get(links.filename(url))
+            if expected is None:
+                continue
+            if url in expectations:
+                # Sizes and digests given in the links file take precedence
+                if expectations[url]["digest"] is None:
+                    expectations[url].update(algorithm=expected["algorithm"], digest=expected["digest"])
+            else:
+                expectations[url] = expected
+
+    # Sharded tasks keep a journal each (unless state_journal_per_task is off) and start from what all journals know;
+    # the lock lets one task at a time merge, import legacy state and verify existing files
+    per_task_journal = task_count > 1 and app_config.get("state_journal_per_task", True)
+    journal_path = os.path.join(state_dir, f"state.task{task_index}.db" if per_task_journal else "state.db")
+    with shared_file_lock(os.path.join(state_dir, "state.lock")):
+        state_store = StateStore(
+            journal_path,
+            commit_batch_size=app_config.get("state_commit_batch_size", 200),
+            commit_interval_seconds=app_config.get("state_commit_interval_seconds", 10),
+        )
+        state_store.merge_journals(sorted(path for path in glob.glob(os.path.join(state_dir, "state*.db"))
+                                          if path != journal_path))
+        # Carry over progress recorded by older versions as per-file .state files
+        state_store.import_legacy_state_dir(state_dir, links, links.filename)
+        # Check files left by earlier runs against their expected size/digest; mismatches are re-downloaded.
+        # With several tasks, the first one to get here checks every file and the others reuse its result.
+        # A job that stopped with a checkpoint left the journal accurate, so its successor skips the check.
+        verified_key = f"existing_files_verified:{slurm_job_key()}"
+        checkpoint = state_store.get_meta("checkpoint")
+        if checkpoint:
+            checkpoint = json.loads(checkpoint)
+            log_message(f"[JOB] Resuming from the checkpoint of {datetime.fromtimestamp(checkpoint['time']):%Y-%m-%d %H:%M:%S} "
+                        f"({len(checkpoint['in_flight'])} partial downloads); existing files are not checked again.")
+            state_store.set_meta("checkpoint", "")
+        elif expectations and app_config.get("verify_existing_on_resume", True) \
+                and not (task_count > 1 and state_store.get_meta(verified_key)):
+            verify_existing_downloads(state_store, download_dir, links, links.filename,
+                                      expectations, processes=app_config.get("verify_processes", 4),
+                                      rehash_completed=app_config.get("verify_existing_rehash_completed", False))
+            if task_count > 1:
+                state_store.set_meta(verified_key, str(time.time()))
+
+    # Sharded tasks each keep their own snapshot; download_status.txt then holds the merged view
+    status_file_name = f"download_status.task{task_index}.txt" if task_count > 1 else "download_status.txt"
+    status_file_path = os.path.join(download_dir, status_file_name)
 
-    status_file_path = os.path.join(download_dir, "download_status.txt")
-    try:
-        with open(status_file_path, 'w') as f:
-            f.write(f"Download job started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Downloading {len(links)} files\n")
-    except IOError as e:
-        log_message(f"Error: Could not write to status file {status_file_path}: {e}")
-        exit(1) 
-    
-    log_message("=== Starting download job ===")
-    
     # Group parameters into dictionaries
+    # Metrics files are per task; tasks sharing a node also need their own textfile
+    metrics_enabled = app_config.get("metrics_enabled", True)
+    metrics_dir = os.path.join(download_dir, "metrics")
+    task_suffix = f".task{task_index}" if task_count > 1 else ""
+    prometheus_textfile = app_config.get("metrics_prometheus_textfile") if metrics_enabled else None
+    if prometheus_textfile and task_suffix:
+        root, ext = os.path.splitext(prometheus_textfile)
+        prometheus_textfile = f"{root}{task_suffix}{ext}"
+
     main_params = {
         "max_workers": app_config.get("max_concurrent_downloads", 3),
+        "download_backend": app_config.get("download_backend", "curl"),
+        "http_max_idle_connections_per_host": app_config.get("http_max_idle_connections_per_host", 4),
+        "probe_cache_max_age_seconds": app_config.get("probe_cache_max_age_seconds", 86400),
+        "cache_dir": app_config.get("cache_dir"),
+        "cache_max_bytes": app_config.get("cache_max_bytes"),
+        "cache_revalidate": app_config.get("cache_revalidate", True),
+        "revalidate_completed": app_config.get("revalidate_completed", False),
+        "bandwidth_limit_bytes_per_sec": app_config.get("bandwidth_limit_bytes_per_sec"),
+        "bandwidth_schedule": app_config.get("bandwidth_schedule", []),
+        "bandwidth_host_limits": app_config.get("bandwidth_host_limits", {}),
+        "bandwidth_bucket_dir": app_config.get("bandwidth_bucket_dir"),
+        "staging_dir": app_config.get("staging_dir"),
+        "staging_max_bytes": app_config.get("staging_max_bytes", 50 * 1024**3),
+        "staging_flush_batch_bytes": app_config.get("staging_flush_batch_bytes", 4 * 1024**3),
+        "staging_flush_interval_seconds": app_config.get("staging_flush_interval_seconds", 30),
+        "postprocess_steps": app_config.get("postprocess_steps", []),
+        "postprocess_processes": app_config.get("postprocess_processes", 8),
+        "postprocess_output_dir": app_config.get("postprocess_output_dir"),
+        "mirror_probe_hosts": app_config.get("mirror_probe_hosts", True),
+        "mirror_failure_cooldown_seconds": app_config.get("mirror_failure_cooldown_seconds", 60),
+        "progress_interval_seconds": app_config.get("progress_interval_seconds", 30),
+        "progress_max_files": app_config.get("progress_max_files", 20),
+        "adaptive_concurrency": app_config.get("adaptive_concurrency", False),
+        "concurrency_min": app_config.get("concurrency_min", 1),
+        "concurrency_max": app_config.get("concurrency_max", 16),
+        "per_host_initial_concurrency": app_config.get("per_host_initial_concurrency", 2),
+        "per_host_max_concurrency": app_config.get("per_host_max_concurrency", 8),
+        "concurrency_adjust_interval_seconds": app_config.get("concurrency_adjust_interval_seconds", 30),
+        "concurrency_error_rate_threshold": app_config.get("concurrency_error_rate_threshold", 0.2),
+        "status_snapshot_every_events": app_config.get("status_snapshot_every_events", 100),
+        "status_snapshot_interval_seconds": app_config.get("status_snapshot_interval_seconds", 30),
+        "status_recent_failures": app_config.get("status_recent_failures", 20),
+        "status_file_name": status_file_name,
+        "metrics_jsonl_path": os.path.join(metrics_dir, f"attempts{task_suffix}.jsonl") if metrics_enabled else None,
+        "metrics_summary_path": os.path.join(metrics_dir, f"summary{task_suffix}.json"),
+        "metrics_prometheus_path": prometheus_textfile,
+        "metrics_window_seconds": app_config.get("metrics_window_seconds", 300),
+        "metrics_flush_interval_seconds": app_config.get("metrics_flush_interval_seconds", 15),
+        "metrics_labels": {"job": slurm_job_key(), "task": str(task_index)},
+        "merged_status_file_name": "download_status.txt" if task_count > 1 else None,
     }
 
     curl_params = {
@@ -46,26 +160,122 @@ if __name__ == "__main__":
         "downloader_initial_retry_delay_seconds": app_config.get("downloader_initial_retry_delay_seconds", 10),
     }
 
+    segment_params = {
+        "segments_per_file": app_config.get("segments_per_file", 1),
+        "segmented_min_size_bytes": app_config.get("segmented_min_size_bytes", 512 * 1024 * 1024),
+        "segment_max_retries": app_config.get("segment_max_retries", 5),
+        "segment_retry_delay_seconds": app_config.get("segment_retry_delay_seconds", 5),
+    }
+
     aggressive_retry_specific_params = {
         # For the retry function, these will be used to override/set specific values
         "downloader_max_retries": app_config.get("downloader_aggressive_max_retries", 8),
         "downloader_initial_retry_delay_seconds": app_config.get("downloader_aggressive_initial_retry_delay_seconds", 30),
-        # This key 'curl_max_time_seconds' is specifically looked for in retry_failed_downloads
-        # to override the one from base_curl_params for aggressive retries.
+        # This key 'curl_max_time_seconds' is specifically looked for in retry_policy_from_params
+        # to override the one from curl_params for aggressive retries.
         "curl_max_time_seconds": app_config.get("downloader_aggressive_timeout_seconds", 3600),
     }
 
+    def prepare_links(urls):
+        """Reconcile partial files and probe urls (if enabled) and put them in the configured download order"""
+        download_order = app_config.get("download_order", "file")
+        # After a checkpoint the partial files and their validators are known to be consistent
+        reconcile = app_config.get("reconcile_on_resume", True) and not checkpoint
+        if reconcile or app_config.get("probe_before_download", False):
+            transport = get_transport(main_params["download_backend"], main_params["http_max_idle_connections_per_host"])
+            try:
+                if reconcile:
+                    reconcile_partial_downloads(state_store, download_dir, urls, links.filename, transport, curl_params,
+                                                expectations, concurrency=app_config.get("reconcile_concurrency", 32),
+                                                tail_bytes=app_config.get("reconcile_tail_bytes", 64 * 1024),
+                                                staging_dir=staging_dir_from_params(main_params))
+                if app_config.get("probe_before_download", False):
+                    probe_urls(urls, state_store, transport, curl_params,
+                               concurrency=app_config.get("probe_concurrency", 32),
+                               max_age_seconds=main_params["probe_cache_max_age_seconds"])
+            finally:
+                transport.close()
+        if app_config.get("probe_before_download", False):
+            # A dynamically shared queue is worked on by every task's workers
+            workers = main_params["max_workers"] * (task_count if shard_mode == "dynamic" else 1)
+            stream_rate = app_config.get("eta_stream_bytes_per_sec", 50 * 1024 * 1024)
+            log_projection(project_eta(urls, state_store, workers, stream_rate), workers, stream_rate)
+        if download_order == "file":
+            return urls
+        log_message(f"Download order: {download_order}")
+        return order_urls(urls, state_store, download_order)
+
+    # Split the manifest across Slurm array tasks / srun tasks (a single task gets everything)
+    shard_mode = app_config.get("shard_mode", "static")
+    work_queue = None
+    if task_count > 1 and shard_mode == "dynamic":
+        # The task that creates the queue probes and orders the whole manifest; the others wait for it
+        work_queue = SharedWorkQueue(
+            os.path.join(download_dir, "work_queue", slurm_job_key()), links, task_index,
+            claim_batch_size=app_config.get("shard_claim_batch_size", 50),
+            prepare_links=prepare_links,
+        )
+        task_links = work_queue.iter_urls()
+        log_message(f"Task {task_index}/{task_count}: claiming work dynamically from {work_queue.queue_dir}")
+    elif task_count > 1:
+        task_links = prepare_links(partition_links(links, task_index, task_count))
+        log_message(f"Task {task_index}/{task_count}: {len(task_links)} of {len(links)} URLs (static hash partition)")
+    else:
+        task_links = prepare_links(links)
+
+    try:
+        with open(status_file_path, 'w') as f:
+            f.write(f"Download job started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+            if hasattr(task_links, "__len__"):
+                f.write(f"Downloading {len(task_links)} files\n")
+            else:
+                f.write(f"Downloading a dynamically claimed share of {len(links)} files\n")
+    except IOError as e:
+        log_message(f"Error: Could not write to status file {status_file_path}: {e}")
+        exit(1) 
+    
+    log_message("=== Starting download job ===")
+
     results = download_files_concurrently(
-        links,
+        task_links,
         download_dir,
-        state_dir,
+        state_store,
         main_params=main_params,
         curl_params=curl_params,
         downloader_params=downloader_params,
-        aggressive_retry_specific_params=aggressive_retry_specific_params
+        aggressive_retry_specific_params=aggressive_retry_specific_params,
+        segment_params=segment_params,
+        links_list=links,
+        expectations=expectations,
+        job_control=job_control
     )
-    
-    if not verify_downloads(download_dir, links):
+    job_control.stop()
+    work_left = bool(results["unfinished"])
+    if work_queue is not None:
+        # Another task, or this one after a requeue, claims them again
+        work_queue.give_back(results["unfinished"])
+        work_left = work_queue.remaining() > 0
+
+    if job_control.stopping:
+        state_store.close()
+        log_message("=== Download job stopped before its time limit; verification is left to the next job ===")
+        if work_left and app_config.get("slurm_requeue", False):
+            if task_count > 1 and "SLURM_ARRAY_TASK_ID" not in os.environ:
+                # Requeueing the job would kill the other srun tasks while they checkpoint
+                log_message("[JOB] Not requeueing from one of several srun tasks; requeue the job from the batch script.")
+            else:
+                requeue_job()
+        sys.exit(0)
+
+    if task_count > 1:
+        # Verify only what this task downloaded
+        verify_links = [url for url, _ in results["success"]] + [url for url, _ in results["failed"]]
+    else:
+        verify_links = links
+    if not verify_downloads(download_dir, verify_links, links_list=links, expectations=expectations,
+                            state_store=state_store,
+                            suspicious_size_bytes=app_config.get("verify_suspicious_size_bytes", 1024 * 1024)):
         log_message("!!! Verification failed for some files. Please check logs. !!!")
     
+    state_store.close()
     log_message("=== Download job completed ===")
\ No newline at end of file
@@ -1,12 +1,21 @@
 #!/bin/bash
 #SBATCH -N 1
 #SBATCH -n 1
+# To spread one links file over several nodes, either use a job array:
+##SBATCH --array=0-3
+# or several tasks in one job (and launch the script with srun below):
+##SBATCH -N 4
+##SBATCH -n 4
 #SBATCH -c 10
 #SBATCH -p qcluster
 #SBATCH -J downloadJob1
 #SBATCH -o /data/Parallel-HPC-Slurm-downloadManager/out_download_info_ver5_%x_%a_4.out
 #SBATCH -A cluster_name
 #SBATCH -t 5-00:00:00
+# Warn the downloader 5 minutes before the time limit so it can checkpoint (see slurm_* in configs.py);
+# with slurm_requeue enabled the job also needs to be requeueable:
+#SBATCH --signal=B:USR1@300
+##SBATCH --requeue
 #SBATCH --mem=100g
 #SBATCH --oversubscribe
 
@@ -28,6 +37,17 @@ which python
 python --version
 echo "-----------------------------"
 
-python Parallel-HPC-Slurm-downloadManager/hpc_downloader.py
+# Each task downloads its own share of the links file (see shard_mode in configs.py).
+# With -n > 1, start one copy per task:
+# srun python Parallel-HPC-Slurm-downloadManager/hpc_downloader.py &
+# Run in the background so the batch shell can pass Slurm's signals on (B:USR1 reaches only this shell)
+python Parallel-HPC-Slurm-downloadManager/hpc_downloader.py &
+PID=$!
+trap 'kill -USR1 $PID' USR1
+trap 'kill -TERM $PID' TERM
+# wait returns early whenever a trapped signal arrives; keep waiting until the downloader has checkpointed and exited
+while kill -0 $PID 2>/dev/null; do
+    wait $PID
+done
 
 echo "Job finished on $(date)"
\ No newline at end of file
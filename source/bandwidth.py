@@ -0,0 +1,197 @@
+import os
+import re
+import time
+import fcntl
+import struct
+import threading
+from datetime import datetime
+from .utils import log_message
+
+# Bucket files hold (tokens, last refill time) as two doubles
+_BUCKET_FORMAT = "dd"
+_BUCKET_SIZE = struct.calcsize(_BUCKET_FORMAT)
+# Tokens a full bucket holds, in seconds of its rate (how large a burst may be)
+BURST_SECONDS = 1.0
+# Bytes a thread accumulates before settling them with a bucket, at most this many seconds of the rate,
+# so a shared bucket file is locked a few times per second per stream rather than once per chunk
+_SETTLE_SECONDS = 0.05
+_SETTLE_MAX_BYTES = 4 * 1024 * 1024
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+class TokenBucket:
+    """
+    Token bucket limiting a byte stream to rate_fn() bytes per second (no limit
+    while it returns None or 0). Consumers take tokens for bytes already
+    transferred and may drive the bucket negative; each then sleeps until its
+    debt would be repaid, which holds the combined rate of all consumers.
+
+    With a path, the bucket state lives in that file and is updated under an
+    flock, so every process using the same file (e.g. in /dev/shm) shares it.
+    """
+
+    def __init__(self, rate_fn, path=None):
+        self.rate_fn = rate_fn
+        self.path = path
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._updated = time.time()
+        self._local = threading.local()
+        self._fd = None
+        if path:
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+
+    def consume(self, n):
+        """Account for n bytes; sleeps when the stream is ahead of the rate"""
+        rate = self.rate_fn()
+        if not rate:
+            return
+        pending = getattr(self._local, "pending", 0) + n
+        if pending < min(rate * _SETTLE_SECONDS, _SETTLE_MAX_BYTES):
+            self._local.pending = pending
+            return
+        self._local.pending = 0
+        wait = self._take(pending, rate)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _take(self, n, rate):
+        """Refill for the time passed, take n tokens and return the seconds until the balance is back at zero"""
+        with self._lock:
+            if self._fd is None:
+                self._tokens, wait = self._debit(self._tokens, self._updated, n, rate)
+                self._updated = time.time()
+                return wait
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(self._fd, _BUCKET_SIZE, 0)
+                tokens, updated = struct.unpack(_BUCKET_FORMAT, data) if len(data) == _BUCKET_SIZE else (0.0, time.time())
+                tokens, wait = self._debit(tokens, updated, n, rate)
+                os.pwrite(self._fd, struct.pack(_BUCKET_FORMAT, tokens, time.time()), 0)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            return wait
+
+    @staticmethod
+    def _debit(tokens, updated, n, rate):
+        now = time.time()
+        tokens = min(rate * BURST_SECONDS, tokens + max(0.0, now - updated) * rate) - n
+        return tokens, (-tokens / rate if tokens < 0 else 0.0)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _minutes(value):
+    hours, _, minutes = value.partition(":")
+    return int(hours) * 60 + int(minutes or 0)
+
+
+def _day_set(days):
+    """"mon-fri", "sat,sun" or a list of day names -> set of weekday numbers (None: every day)"""
+    if not days:
+        return None
+    if isinstance(days, str):
+        days = re.split(r"[,\s]+", days.strip().lower())
+    numbers = set()
+    for item in days:
+        first, _, last = item.lower().partition("-")
+        start = DAYS.index(first[:3])
+        end = DAYS.index(last[:3]) if last else start
+        numbers.update(range(start, end + 1) if start <= end else list(range(start, 7)) + list(range(0, end + 1)))
+    return numbers
+
+
+def scheduled_limit(schedule, default, now=None):
+    """
+    The limit in force at now (local time): the first schedule entry whose
+    window contains it, else default. Entries are dicts with "start" and "end"
+    ("HH:MM"; an end before the start wraps past midnight), "bytes_per_sec"
+    (None for no limit) and optionally "days" ("mon-fri", "sat,sun", ...).
+    """
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    for entry in schedule or ():
+        days = _day_set(entry.get("days"))
+        if days is not None and now.weekday() not in days:
+            continue
+        start, end = _minutes(entry["start"]), _minutes(entry["end"])
+        inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+        if inside:
+            return entry.get("bytes_per_sec")
+    return default
+
+
+class BandwidthGovernor:
+    """
+    Caps the download rate of every worker of a job, and of every job on the
+    node sharing bucket_dir: one token bucket for the total (limit_bytes_per_sec,
+    or the entry of schedule in force) and one per host listed in host_limits.
+    Transports call consume(host, n) for the bytes they receive; curl downloads
+    are streamed through the process for that (see transport.CurlTransport).
+    """
+
+    def __init__(self, limit_bytes_per_sec=None, schedule=None, host_limits=None, bucket_dir=None):
+        self.limit_bytes_per_sec = limit_bytes_per_sec
+        self.schedule = schedule or []
+        self.host_limits = {host.lower(): limit for host, limit in (host_limits or {}).items()}
+        self.bucket_dir = bucket_dir
+        if bucket_dir:
+            os.makedirs(bucket_dir, exist_ok=True)
+        self._limit_cache = (0.0, None) # (checked at, limit), re-evaluated every few seconds
+        self._global = TokenBucket(self.current_limit, self._bucket_path("total"))
+        self._hosts = {host: TokenBucket(lambda limit=limit: limit, self._bucket_path(f"host-{host}"))
+                       for host, limit in self.host_limits.items()}
+
+    def _bucket_path(self, name):
+        if not self.bucket_dir:
+            return None
+        return os.path.join(self.bucket_dir, re.sub(r"[^A-Za-z0-9._-]", "_", name) + ".bucket")
+
+    def current_limit(self):
+        """Total bytes per second allowed right now (None: unlimited)"""
+        checked_at, limit = self._limit_cache
+        now = time.time()
+        if now - checked_at >= 5:
+            limit = scheduled_limit(self.schedule, self.limit_bytes_per_sec)
+            if limit != self._limit_cache[1] and checked_at:
+                log_message(f"[BANDWIDTH] Total limit is now {_format_rate(limit)}.")
+            self._limit_cache = (now, limit)
+        return limit
+
+    def consume(self, host, n):
+        bucket = self._hosts.get(host)
+        if bucket is not None:
+            bucket.consume(n)
+        self._global.consume(n)
+
+    def describe(self):
+        parts = [f"total {_format_rate(self.current_limit())}"]
+        if self.schedule:
+            parts.append(f"{len(self.schedule)} scheduled windows")
+        parts += [f"{host} {_format_rate(limit)}" for host, limit in self.host_limits.items()]
+        scope = f"shared through {self.bucket_dir}" if self.bucket_dir else "this job only"
+        return f"{', '.join(parts)} ({scope})"
+
+    def close(self):
+        self._global.close()
+        for bucket in self._hosts.values():
+            bucket.close()
+
+
+def _format_rate(limit):
+    return f"{limit / (1024*1024):.1f} MB/s" if limit else "unlimited"
+
+
+def governor_from_params(main_params):
+    """Build the governor from the main_params dictionary assembled in hpc_downloader.py (None if no limits are set)"""
+    limit = main_params.get("bandwidth_limit_bytes_per_sec")
+    schedule = main_params.get("bandwidth_schedule")
+    host_limits = main_params.get("bandwidth_host_limits")
+    if not limit and not schedule and not host_limits:
+        return None
+    governor = BandwidthGovernor(limit, schedule, host_limits, main_params.get("bandwidth_bucket_dir"))
+    log_message(f"[BANDWIDTH] Limits: {governor.describe()}")
+    return governor
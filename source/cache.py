@@ -0,0 +1,215 @@
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import threading
+from .utils import log_message
+from .sharding import shared_file_lock
+
+# ioctl that makes dst share src's blocks (copy-on-write) on btrfs/XFS
+_FICLONE = 0x40049409
+# Eviction runs again once this share of the size cap has been added since the last scan
+_EVICT_CHECK_FRACTION = 0.05
+# ...and removes entries down to this share of the cap, so it doesn't run on every store
+_EVICT_LOW_WATERMARK = 0.9
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+
+
+def link_or_copy(src, dst):
+    """
+    Make dst a copy of src without moving bytes where possible: a hardlink,
+    else a reflink, else a plain copy (e.g. across filesystems).
+    Returns the method used.
+    """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        _reflink(src, dst)
+        return "reflink"
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def is_unchanged(probe, etag, last_modified):
+    """
+    True if a conditional probe (see transport.conditional_headers) shows that
+    the object still has the given validators: a 304, or the same ETag (or,
+    without an ETag, the same Last-Modified) from a server ignoring the condition.
+    """
+    if probe["returncode"] != 0:
+        return False
+    if probe["http_status"] == 304:
+        return True
+    if etag:
+        return probe["etag"] == etag
+    return bool(last_modified) and probe["last_modified"] == last_modified
+
+
+class ContentCache:
+    """
+    Completed downloads shared between runs and jobs, keyed by URL.
+
+    Each entry is a data file plus a small JSON file with the URL, its ETag and
+    Last-Modified, size and digest, under objects/<xx>/<sha256 of URL>. Entries
+    are placed into a download directory by hardlink (or reflink, or copy) and
+    stored the same way, so a hit moves no bytes on the same filesystem. Only
+    responses with a validator are cached, so a hit can be revalidated with a
+    conditional request. The JSON file's mtime is the last use; when the data
+    exceeds max_bytes the least recently used entries are evicted under a
+    file lock shared by all jobs using the cache.
+
+    Downloads linked from the cache share their inode with it: they must not
+    be modified in place (delete and re-create them instead).
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.lock_path = os.path.join(cache_dir, "cache.lock")
+        self.max_bytes = max_bytes
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.hits = 0
+        self.stores = 0
+        self._added_since_scan = 0
+        self._lock = threading.Lock()
+
+    def _entry_paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        directory = os.path.join(self.objects_dir, key[:2])
+        return directory, key
+
+    def lookup(self, url):
+        """The cache entry (metadata dict with "data_path") for url, or None"""
+        directory, key = self._entry_paths(url)
+        try:
+            with open(os.path.join(directory, f"{key}.json"), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        entry["data_path"] = os.path.join(directory, entry["data_file"])
+        try:
+            if entry["url"] != url or os.path.getsize(entry["data_path"]) != entry["size"]:
+                return None
+        except OSError:
+            return None # Replaced or evicted meanwhile
+        return entry
+
+    def serve(self, entry, output_path):
+        """Place the cached data of entry at output_path. Returns the method used, or None if it is gone."""
+        tmp_path = f"{output_path}.cache.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            method = link_or_copy(entry["data_path"], tmp_path)
+        except OSError:
+            return None
+        os.replace(tmp_path, output_path)
+        try:
+            directory, key = self._entry_paths(entry["url"])
+            os.utime(os.path.join(directory, f"{key}.json")) # Mark as recently used
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return method
+
+    def store(self, url, path, etag=None, last_modified=None, digest=None):
+        """Add the completed download at path for url; skipped (False) without a validator"""
+        if not etag and not last_modified:
+            return False
+        directory, key = self._entry_paths(url)
+        os.makedirs(directory, exist_ok=True)
+        size = os.path.getsize(path)
+        # Every version gets its own data file, so the JSON file always names complete data
+        version = hashlib.sha256(f"{etag}|{last_modified}|{size}".encode()).hexdigest()[:16]
+        data_file = f"{key}.{version}.data"
+        data_path = os.path.join(directory, data_file)
+        meta_path = os.path.join(directory, f"{key}.json")
+        previous = self.lookup(url)
+        suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            if not os.path.exists(data_path):
+                link_or_copy(path, f"{data_path}.{suffix}")
+                os.replace(f"{data_path}.{suffix}", data_path)
+            with open(f"{meta_path}.{suffix}", 'w') as f:
+                json.dump({"url": url, "etag": etag, "last_modified": last_modified, "size": size,
+                           "digest": digest, "data_file": data_file}, f)
+            os.replace(f"{meta_path}.{suffix}", meta_path)
+        except OSError as e:
+            log_message(f"Warning: could not add {url} to the cache: {e}")
+            return False
+        if previous and previous["data_file"] != data_file:
+            try:
+                os.remove(previous["data_path"])
+            except OSError:
+                pass
+        with self._lock:
+            self.stores += 1
+            self._added_since_scan += size
+            evict = self.max_bytes and self._added_since_scan >= self.max_bytes * _EVICT_CHECK_FRACTION
+            if evict:
+                self._added_since_scan = 0
+        if evict:
+            self.evict()
+        return True
+
+    def evict(self):
+        """Remove least recently used entries until the cached data fits in max_bytes"""
+        if not self.max_bytes:
+            return 0
+        with shared_file_lock(self.lock_path):
+            entries = [] # (last used, size, meta path, data path)
+            total = 0
+            for directory in os.scandir(self.objects_dir):
+                if not directory.is_dir():
+                    continue
+                for item in os.scandir(directory.path):
+                    if not item.name.endswith(".json"):
+                        continue
+                    try:
+                        with open(item.path, 'r') as f:
+                            entry = json.load(f)
+                        used = item.stat().st_mtime
+                    except (OSError, ValueError):
+                        continue
+                    entries.append((used, entry["size"], item.path, os.path.join(directory.path, entry["data_file"])))
+                    total += entry["size"]
+            if total <= self.max_bytes:
+                return 0
+            entries.sort()
+            evicted = 0
+            for used, size, meta_path, data_path in entries:
+                if total <= self.max_bytes * _EVICT_LOW_WATERMARK:
+                    break
+                for stale in (meta_path, data_path):
+                    try:
+                        os.remove(stale)
+                    except OSError:
+                        pass
+                total -= size
+                evicted += 1
+        log_message(f"[CACHE] Evicted {evicted} least recently used entries; {total / (1024**3):.2f} GB cached.")
+        return evicted
+
+
+def cache_from_params(main_params):
+    """Build the cache from the main_params dictionary assembled in hpc_downloader.py (None if disabled)"""
+    cache_dir = main_params.get("cache_dir")
+    if not cache_dir:
+        return None
+    cache = ContentCache(cache_dir, main_params.get("cache_max_bytes"))
+    cache.evict()
+    return cache
@@ -0,0 +1,165 @@
+import os
+import hashlib
+import concurrent.futures
+from .utils import log_message, expectation
+from .state import STATUS_COMPLETED, STATUS_PENDING
+
+# Hex digest length -> algorithm, for sha256sum/md5sum style manifests
+_ALGORITHM_BY_HEX_LENGTH = {64: "sha256", 32: "md5"}
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def load_checksum_manifest(manifest_path):
+    """
+    Read a sha256sum/md5sum style manifest ("<hex digest>  <filename>" per line)
+    and return {filename: expectation}. The algorithm follows from the digest length.
+    """
+    expected = {}
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            digest, _, filename = line.partition(" ")
+            filename = filename.strip().lstrip("*") # "*name" marks binary mode in sha256sum output
+            algorithm = _ALGORITHM_BY_HEX_LENGTH.get(len(digest))
+            if algorithm is None or not filename:
+                log_message(f"Warning: skipping unrecognised line in checksum manifest {manifest_path}: {line}")
+                continue
+            expected[os.path.basename(filename)] = expectation(algorithm=algorithm, digest=digest)
+    log_message(f"Loaded {len(expected)} checksums from {manifest_path}")
+    return expected
+
+
+def new_hasher(algorithm):
+    return hashlib.new(algorithm)
+
+
+def update_from_file(hasher, path, length=None):
+    """Feed the first length bytes of path (all of it if None) into hasher"""
+    remaining = length
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(READ_CHUNK_SIZE if remaining is None else min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hasher
+
+
+def file_digest(path, algorithm):
+    """Hex digest of the whole file at path"""
+    return update_from_file(new_hasher(algorithm), path).hexdigest()
+
+
+def format_digest(algorithm, hex_digest):
+    """Digest as stored in the state journal, e.g. "sha256:ab12..." """
+    return f"{algorithm}:{hex_digest}"
+
+
+def check_download(path, expected, size, digest=None):
+    """
+    Compare a finished download with its expectation. digest is the hex digest
+    computed while streaming (None if it has to be computed now).
+    Returns (error message or None, hex digest or None).
+    """
+    if expected is None:
+        return None, digest
+    if expected["size"] is not None and size != expected["size"]:
+        return f"Size mismatch: expected {expected['size']} bytes, got {size}.", digest
+    if expected["digest"]:
+        if digest is None:
+            digest = file_digest(path, expected["algorithm"])
+        if digest != expected["digest"]:
+            return f"Checksum mismatch: expected {expected['algorithm']} {expected['digest']}, got {digest}.", digest
+    return None, digest
+
+
+def _hash_job(path, algorithm):
+    # Runs in a worker process
+    try:
+        return file_digest(path, algorithm), None
+    except OSError as e:
+        return None, str(e)
+
+
+def verify_existing_downloads(state_store, download_dir, urls, filename_for_url, expectations, processes=4,
+                              rehash_completed=False):
+    """
+    Check files already on disk against their expected size and digest before downloading.
+
+    Completed files are checked with one stat each; their digest is only
+    recomputed if the journal has no matching digest for them (or always, with
+    rehash_completed, to catch corruption on disk since then). Files of the
+    expected size that are not marked COMPLETED (e.g. copied in by hand) are
+    hashed too and adopted when they match. Hashing runs in a process pool.
+    Mismatching files are deleted and their URLs set back to PENDING so they
+    are downloaded again. Returns the number of URLs marked for re-download.
+    """
+    from .segmented import segments_file_path # segmented -> transport -> checksums
+    to_hash = [] # (url, path, expected, completed)
+    redownload = 0
+    adopted = 0
+
+    def mark_for_redownload(url, path, reason):
+        nonlocal redownload
+        log_message(f"[VERIFY] {os.path.basename(path)} (URL: {url}): {reason} Marking for re-download.")
+        if os.path.exists(path):
+            os.remove(path)
+        state_store.set_status(url, STATUS_PENDING, last_error=reason, bytes_done=0, digest=None, finished_at=None)
+        redownload += 1
+
+    for url in urls:
+        expected = expectations.get(url)
+        if expected is None:
+            continue
+        filename = filename_for_url(url)
+        path = os.path.join(download_dir, filename)
+        record = state_store.get(url)
+        completed = record is not None and record["status"] == STATUS_COMPLETED
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            if completed:
+                mark_for_redownload(url, path, "File is missing.")
+            continue
+
+        if expected["size"] is not None and size != expected["size"]:
+            if completed or size > expected["size"]:
+                mark_for_redownload(url, path, f"Size mismatch: expected {expected['size']} bytes, found {size}.")
+            continue # Otherwise a partial file to resume
+        if not expected["digest"]:
+            continue
+        if not completed and os.path.exists(segments_file_path(path)):
+            continue # Preallocated segmented partial: full size, but not all bytes are there yet
+        if completed and not rehash_completed and record["digest"] == format_digest(expected["algorithm"], expected["digest"]) \
+                and record["bytes_done"] == size:
+            continue # Verified when it was downloaded
+        if completed or expected["size"] is not None:
+            to_hash.append((url, path, expected, completed))
+
+    if to_hash:
+        log_message(f"[VERIFY] Hashing {len(to_hash)} existing files with {processes} processes...")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, processes)) as executor:
+            futures = {executor.submit(_hash_job, path, expected["algorithm"]): (url, path, expected, completed)
+                       for url, path, expected, completed in to_hash}
+            for future in concurrent.futures.as_completed(futures):
+                url, path, expected, completed = futures[future]
+                digest, error = future.result()
+                if error:
+                    log_message(f"[VERIFY] Could not read {path}: {error}")
+                elif digest != expected["digest"]:
+                    mark_for_redownload(url, path, f"Checksum mismatch: expected {expected['algorithm']} "
+                                                   f"{expected['digest']}, found {digest}.")
+                else:
+                    size = os.path.getsize(path)
+                    if not completed:
+                        adopted += 1
+                    state_store.set_status(url, STATUS_COMPLETED, filename=os.path.basename(path), bytes_done=size,
+                                           digest=format_digest(expected["algorithm"], digest), last_error=None)
+    state_store.flush()
+    log_message(f"[VERIFY] Existing files checked: {len(to_hash)} hashed, {adopted} adopted as completed, "
+                f"{redownload} marked for re-download.")
+    return redownload
@@ -1,12 +1,323 @@
 import os
-import subprocess
+import json
 import time
-from urllib.parse import urlparse
-from .utils import log_message # Assuming log_message is in source/utils.py
+from .utils import log_message, url_to_filename, LinkIndex # Assuming log_message is in source/utils.py
+from .state import STATUS_IN_PROGRESS, STATUS_COMPLETED, STATUS_FAILED
+from .transport import CurlTransport, get_transport, conditional_headers, if_range_validator
+from .segmented import download_segmented, segments_file_path, segmented_bytes_done
+from .checksums import check_download, format_digest
+from .status import StatusReporter
+from .metrics import metrics_from_params
+from .scheduler import controller_from_params, url_host, RetryPolicy
+from .probing import cached_probe, store_probe
+from .cache import cache_from_params, is_unchanged
+from .bandwidth import governor_from_params
+from .staging import staging_from_params, preallocate
+from .postprocess import postprocessor_from_params
+from .mirrors import MirrorRanker, source_key
+from .logpipeline import progress_from_params
+import heapq
+import itertools
+import collections
 import concurrent.futures
-from datetime import datetime
 
-def download_file(url, download_dir, state_dir, links_list, 
+def prepare_download(url, download_dir, state_store, links_list, transport, curl_options,
+                     segments_per_file=1, segmented_min_size_bytes=512*1024*1024, expected=None,
+                     probe_max_age_seconds=86400, cache=None, revalidate_cached=True, revalidate_completed=False,
+                     staging=None, mirrors=None, ranker=None):
+    """
+    Set up the first attempt for url. Returns None if the journal already marks
+    it COMPLETED or it was served from cache (see source/cache.py); otherwise
+    marks it IN_PROGRESS, decides between a single-stream and a segmented
+    download and returns the job dictionary used by download_attempt.
+    expected is the URL's expected size/digest (see source/checksums.py), if any.
+    A probe cached in the journal within probe_max_age_seconds is reused.
+    With revalidate_completed, a COMPLETED file is kept only if a conditional
+    request shows it is unchanged upstream; revalidate_cached does the same for
+    cache entries. With staging (see source/staging.py) the download is written
+    to scratch and the job's final_path is where the flusher puts it.
+    mirrors are other URLs of the same object; the job's sources are url and
+    its mirrors ranked by ranker (see source/mirrors.py), fastest first.
+    A partial file left by an earlier run is resumed with If-Range against the
+    validators recorded for it, so it is discarded if the object has changed.
+    """
+    filename = url_to_filename(url, links_list)
+    output_path = os.path.join(download_dir, filename)
+
+    # Check existing state (served from the journal's in-memory copy, no file I/O)
+    record = state_store.get(url)
+    if record and record["status"] == STATUS_COMPLETED:
+        if not (revalidate_completed and (record["etag"] or record["last_modified"]) and os.path.exists(output_path)):
+            log_message(f"[SKIPPED] {filename} (URL: {url}) already marked as COMPLETED.")
+            return None
+        probe = transport.probe(url, curl_options, conditional_headers(record["etag"], record["last_modified"]))
+        if probe["returncode"] != 0 or is_unchanged(probe, record["etag"], record["last_modified"]):
+            # When the server can't be asked, keep what we have
+            log_message(f"[SKIPPED] {filename} (URL: {url}) already marked as COMPLETED"
+                        + (", unchanged upstream." if probe["returncode"] == 0 else "."))
+            return None
+        log_message(f"[CHANGED] {filename} (URL: {url}) changed upstream since it was downloaded, downloading it again.")
+        os.remove(output_path) # Unlinks only this copy if it is shared with the cache
+        state_store.update(url, bytes_done=0, digest=None)
+
+    if cache is not None and _serve_from_cache(url, filename, output_path, state_store, cache, transport, curl_options,
+                                               expected, revalidate_cached):
+        return None
+
+    log_message(f"[STARTED] Downloading {filename} from {url}")
+    state_store.set_status(url, STATUS_IN_PROGRESS, filename=filename, started_at=time.time(), finished_at=None,
+                           processing_status=None)
+    final_path = output_path
+    if staging is not None:
+        output_path = staging.stage_path(filename)
+
+    # Large objects on servers that accept byte ranges are fetched as parallel segments. Only URLs already
+    # known to be large (size= in the links file, an earlier probe or a segmented partial) are probed here,
+    # so small files don't pay an extra round trip before they start.
+    segmented_size = None
+    if segments_per_file > 1:
+        probe = cached_probe(state_store, url, probe_max_age_seconds)
+        known_size = expected["size"] if expected and expected["size"] is not None else state_store.get(url)["content_length"]
+        if probe is None and ((known_size or 0) >= segmented_min_size_bytes or os.path.exists(segments_file_path(output_path))):
+            probe = transport.probe(url, curl_options)
+            if probe["returncode"] == 0:
+                store_probe(state_store, url, probe)
+        if probe is not None and probe["returncode"] == 0 and probe["accept_ranges"] \
+                and (probe["content_length"] or 0) >= segmented_min_size_bytes:
+            segmented_size = probe["content_length"]
+    if segmented_size is None and os.path.exists(segments_file_path(output_path)):
+        # A preallocated segmented file can't be resumed by appending to it; start over
+        log_message(f"[RESET] {filename}: segmented partial can't be resumed as a single stream, restarting.")
+        for stale in (output_path, segments_file_path(output_path)):
+            if os.path.exists(stale):
+                os.remove(stale)
+    if staging is not None and segmented_size is None:
+        # Segmented files are preallocated anyway; reserve space for single streams of known size too
+        record = state_store.get(url)
+        size = expected["size"] if expected and expected["size"] is not None else record["content_length"]
+        if size:
+            preallocate(output_path, size)
+
+    job = {"url": url, "filename": filename, "output_path": output_path, "final_path": final_path,
+           "host": url_host(url), "segmented_size": segmented_size, "expected": expected}
+    if segmented_size is None and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        record = state_store.get(url)
+        job["if_range"] = if_range_validator(record["etag"], record["last_modified"])
+    if mirrors:
+        size = segmented_size or (expected["size"] if expected else None) or state_store.get(url)["content_length"]
+        sources = [url] + [mirror for mirror in mirrors if mirror != url]
+        if ranker is not None:
+            sources = ranker.rank(sources, size)
+        job["sources"] = sources
+        job["source_index"] = 0
+        if segmented_size is not None and ranker is not None:
+            usable = ranker.range_sources([url] + [source for source in sources if source != url], segmented_size)
+            job["segment_sources"] = [source for source in sources if source in usable]
+        if sources[0] != url and ranker is not None:
+            log_message(f"[MIRROR] {filename}: fastest source is {ranker.describe(sources[0])}.")
+    return job
+
+
+def _bytes_on_disk(output_path):
+    """Bytes of a download written so far; a segmented file is preallocated, so its sidecar is asked"""
+    if os.path.exists(segments_file_path(output_path)):
+        return segmented_bytes_done(output_path) or 0
+    return os.path.getsize(output_path) if os.path.exists(output_path) else 0
+
+
+def _serve_from_cache(url, filename, output_path, state_store, cache, transport, curl_options, expected, revalidate):
+    """Place the cached copy of url at output_path and mark it COMPLETED; False if there is no usable entry"""
+    entry = cache.lookup(url)
+    if entry is None or (expected and expected["size"] is not None and entry["size"] != expected["size"]):
+        return False
+    if revalidate:
+        probe = transport.probe(url, curl_options, conditional_headers(entry["etag"], entry["last_modified"]))
+        if not is_unchanged(probe, entry["etag"], entry["last_modified"]):
+            log_message(f"[CACHE] {filename}: cached copy is outdated or could not be revalidated, downloading.")
+            return False
+    for stale in (output_path, segments_file_path(output_path)):
+        if os.path.exists(stale):
+            os.remove(stale) # A partial download; never write through a link into the cache
+    method = cache.serve(entry, output_path)
+    if method is None:
+        return False
+    cached_digest = None
+    if expected and expected["digest"] and (entry["digest"] or "").startswith(f"{expected['algorithm']}:"):
+        cached_digest = entry["digest"].split(":", 1)[1]
+    mismatch, digest = check_download(output_path, expected, entry["size"], cached_digest)
+    if mismatch:
+        log_message(f"[CACHE] {filename}: cached copy does not match: {mismatch} Downloading.")
+        os.remove(output_path)
+        return False
+    state_store.set_status(url, STATUS_COMPLETED, filename=filename, bytes_done=entry["size"], last_error=None,
+                           digest=format_digest(expected["algorithm"], digest) if digest else None,
+                           etag=entry["etag"], last_modified=entry["last_modified"], finished_at=time.time(),
+                           processing_status=None)
+    log_message(f"[CACHED] {filename} (URL: {url}) served from the cache ({method}).")
+    return True
+
+
+def download_attempt(job, state_store, transport, curl_options,
+                     segments_per_file=1, segment_max_retries=5, segment_retry_delay_seconds=5,
+                     controller=None, metrics=None, cache=None, staging=None, on_completed=None, ranker=None,
+                     job_control=None, progress=None):
+    """
+    Make one download attempt for a job from prepare_download and record it in
+    the journal (COMPLETED on success). When the job has an expected size or
+    digest, the finished file must match it; a mismatching file is deleted and
+    the attempt counts as failed. Every attempt is reported to metrics
+    (see source/metrics.py) if given, and completed files are added to cache.
+    With staging, a completed file is handed to the flusher and becomes
+    COMPLETED once it is in the download directory. on_completed(url, path),
+    if given, is called then (e.g. to queue post-processing). A job with
+    sources (mirrors) is fetched from its current source, and ranker learns
+    from the outcome. A failed attempt records the bytes on disk and their
+    validators, from which the next attempt (or the next job) resumes.
+    job_control (see source/jobcontrol.py) learns the download rate, and
+    progress (see logpipeline.ProgressTracker) samples the transfer.
+    Returns (success, message).
+    """
+    url, filename, output_path = job["url"], job["filename"], job["output_path"]
+    job["attempts"] = job.get("attempts", 0) + 1
+    expected = job.get("expected")
+    if expected and expected["digest"]:
+        # The transport hashes the bytes as it writes them
+        curl_options = dict(curl_options, digest_algorithm=expected["algorithm"])
+    source = job["sources"][job["source_index"]] if job.get("sources") else url
+    if job.get("if_range") and source == url:
+        curl_options = dict(curl_options, if_range=job["if_range"])
+    if source != url and job["segmented_size"] is None and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        # A mirror's validators say nothing about the partial file, so a plain Range request could splice versions
+        reason = _mirror_resume_mismatch(source, state_store.get(url), expected, transport, curl_options)
+        if reason is not None:
+            log_message(f"[RESET] {filename}: not resuming the partial file from mirror {source_key(source)}: {reason}")
+            os.remove(output_path)
+            state_store.update(url, bytes_done=0)
+            job.pop("if_range", None)
+    if progress is not None:
+        total = job["segmented_size"]
+        if total is None:
+            total = expected["size"] if expected and expected["size"] is not None else state_store.get(url)["content_length"]
+        progress.begin(url, filename, total, lambda: _bytes_on_disk(output_path))
+    try:
+        if job["segmented_size"] is not None:
+            attempt = download_segmented(url, output_path, filename, transport, curl_options, job["segmented_size"],
+                                         segments_per_file, segment_max_retries, segment_retry_delay_seconds,
+                                         sources=job.get("segment_sources"), on_result=ranker.record if ranker else None)
+        else:
+            attempt = transport.fetch(source, output_path, filename, curl_options)
+            if ranker:
+                ranker.record(source, attempt)
+    finally:
+        if progress is not None:
+            progress.end(url)
+    if controller:
+        controller.record_attempt(url_host(source) if job["segmented_size"] is None else job["host"], attempt)
+    if job_control:
+        job_control.record_attempt(attempt)
+
+    output_size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+    if attempt["returncode"] == 0:
+        if output_size > 0:
+            mismatch, digest = check_download(output_path, expected, output_size, attempt.get("digest"))
+            if mismatch is None:
+                file_size_mb = output_size / (1024*1024)
+                log_message(f"[COMPLETED] {filename} (URL: {url}). Size: {file_size_mb:.2f} MB."
+                            + (f" {expected['algorithm']} verified." if digest else ""))
+                state_store.record_attempt(url, bytes_done=output_size)
+                stored_digest = format_digest(expected["algorithm"], digest) if digest else None
+                # Validators of what we now have, for conditional requests later (to url, so not a mirror's)
+                validators = {key: attempt[key] for key in ("etag", "last_modified") if attempt.get(key) and source == url}
+                if not validators and job["segmented_size"] is not None:
+                    record = state_store.get(url)
+                    validators = {"etag": record["etag"], "last_modified": record["last_modified"]}
+                final_path = job.get("final_path", output_path)
+
+                def mark_completed():
+                    state_store.set_status(url, STATUS_COMPLETED, finished_at=time.time(), digest=stored_digest, **validators)
+                    if cache is not None:
+                        cache.store(url, final_path, validators.get("etag"), validators.get("last_modified"), stored_digest)
+                    if on_completed is not None:
+                        on_completed(url, final_path)
+                if staging is not None and final_path != output_path:
+                    staging.submit(url, output_path, final_path, mark_completed)
+                else:
+                    mark_completed()
+                if metrics:
+                    metrics.record_attempt(job, attempt, True)
+                return True, f"Completed, Size: {file_size_mb:.2f} MB"
+            # The bytes on disk are wrong; resuming from them would only keep the damage
+            log_message(f"[VERIFY FAILED] {filename} (URL: {url}). {mismatch} Deleting it for a fresh download.")
+            os.remove(output_path)
+            output_size = 0
+            attempt_error = mismatch
+        else:
+            attempt_error = f"{transport.name} success (code 0), but file is missing or zero size."
+    else:
+        attempt_error = f"{transport.name} exit code: {attempt['returncode']}." + (f" {attempt['error']}" if attempt["error"] else "")
+    log_message(f"[FAILED ATTEMPT] {filename} (URL: {url}). {attempt_error}")
+    if job["segmented_size"] is not None:
+        # The file is preallocated; the sidecar knows how much of it is real
+        output_size = segmented_bytes_done(output_path) or 0
+    state_store.record_attempt(url, error=attempt_error, bytes_done=output_size)
+    validators = {key: attempt[key] for key in ("etag", "last_modified") if attempt.get(key) and source == url}
+    if output_size > 0 and validators and job["segmented_size"] is None:
+        # The partial file is of this version of the object; resume it only while it is unchanged
+        state_store.update(url, **validators)
+        job["if_range"] = if_range_validator(validators.get("etag"), validators.get("last_modified"))
+    if metrics:
+        metrics.record_attempt(job, attempt, False, attempt_error)
+    return False, attempt_error
+
+
+def _mirror_resume_mismatch(source, record, expected, transport, curl_options):
+    """
+    Why a partial file of record's URL must not be continued from mirror source,
+    or None if it may: the mirror must have the recorded size and ETag, where
+    they are known, and an expected digest must be there to catch a mirror
+    that still holds another version of the object.
+    """
+    if not (expected and expected["digest"]):
+        return "no expected digest would catch a different version there."
+    probe = transport.probe(source, curl_options)
+    if probe["returncode"] != 0:
+        return f"the mirror could not be probed ({probe['error'] or probe['http_status']})."
+    size = expected["size"] if expected["size"] is not None else record["content_length"]
+    if size is not None and probe["content_length"] != size:
+        return f"its size ({probe['content_length']}) does not match the recorded size ({size})."
+    if record["etag"] and probe["etag"] and record["etag"] != probe["etag"]:
+        return "its ETag differs from the recorded one."
+    return None
+
+
+def _mark_failed(state_store, url, filename, error_message, state_error=None):
+    log_message(f"[EXHAUSTED RETRIES/FAILED] {filename} (URL: {url}). {error_message}")
+    try:
+        state_store.set_status(url, STATUS_FAILED, last_error=state_error or error_message, finished_at=time.time())
+    except Exception as se:
+        log_message(f"Could not record state for {url} after failure: {se}")
+
+
+def retry_policy_from_params(curl_params, downloader_params, aggressive_retry_specific_params):
+    """
+    Retry policy for one URL: downloader_max_retries normal retries, then an
+    escalation to the aggressive settings (longer curl max time, more retries).
+    """
+    aggressive_curl_params = dict(curl_params)
+    if "curl_max_time_seconds" in aggressive_retry_specific_params:
+        aggressive_curl_params["curl_max_time_seconds"] = aggressive_retry_specific_params["curl_max_time_seconds"]
+    return RetryPolicy([
+        {"name": "normal", "label": "SCRIPT RETRY", "options": dict(curl_params),
+         "max_retries": downloader_params.get("downloader_max_retries", 5),
+         "initial_delay_seconds": downloader_params.get("downloader_initial_retry_delay_seconds", 10)},
+        # A fresh attempt plus its retries, as the separate aggressive pass used to make
+        {"name": "aggressive", "label": "AGGRESSIVE RETRY", "options": aggressive_curl_params,
+         "max_retries": aggressive_retry_specific_params.get("downloader_max_retries", 8) + 1,
+         "initial_delay_seconds": aggressive_retry_specific_params.get("downloader_initial_retry_delay_seconds", 30)},
+    ])
+
+
+def download_file(url, download_dir, state_store, links_list, 
                   # Curl parameters
                   curl_retry_attempts,
                   curl_retry_delay_seconds,
@@ -17,292 +328,455 @@ def download_file(url, download_dir, state_dir, links_list,
                   curl_speed_limit_bytes_per_sec,
                   # Downloader loop parameters
                   downloader_max_retries, 
-                  downloader_initial_retry_delay_seconds
+                  downloader_initial_retry_delay_seconds,
+                  # Transport used for each attempt (see source/transport.py); defaults to curl
+                  transport=None,
+                  # Segmented (multi-connection) download parameters; 1 segment disables it
+                  segments_per_file=1,
+                  segmented_min_size_bytes=512*1024*1024,
+                  segment_max_retries=5,
+                  segment_retry_delay_seconds=5,
+                  # Concurrency controller fed with every attempt's outcome (see source/scheduler.py)
+                  controller=None,
+                  # Expected size/digest the finished file must match (see source/checksums.py)
+                  expected=None,
+                  # Per-attempt metrics recorder (see source/metrics.py)
+                  metrics=None,
+                  # Shared content cache (see source/cache.py)
+                  cache=None
                   ):  
     """
-    Download a single file using curl with specified retry and timeout parameters.
+    Download a single file with specified retry and timeout parameters, waiting
+    between retries in the calling thread. For one-off downloads; the concurrent
+    downloader schedules retries itself instead of sleeping in a worker.
     Manages state and logs progress.
     """
+    if transport is None:
+        transport = CurlTransport()
+    curl_options = {
+        "curl_retry_attempts": curl_retry_attempts,
+        "curl_retry_delay_seconds": curl_retry_delay_seconds,
+        "curl_retry_max_time_seconds": curl_retry_max_time_seconds,
+        "curl_connect_timeout_seconds": curl_connect_timeout_seconds,
+        "curl_max_time_seconds": curl_max_time_seconds,
+        "curl_speed_time_seconds": curl_speed_time_seconds,
+        "curl_speed_limit_bytes_per_sec": curl_speed_limit_bytes_per_sec,
+    }
+    policy = RetryPolicy([{"name": "normal", "label": "SCRIPT RETRY", "options": curl_options,
+                           "max_retries": downloader_max_retries,
+                           "initial_delay_seconds": downloader_initial_retry_delay_seconds}])
     filename = "" # Initialize to ensure it's defined in case of early exception
     try:
-        filename = os.path.basename(urlparse(url).path)
-        if not filename: # Fallback for URLs without a clear filename part
-            try:
-                idx = links_list.index(url) # Use original list for consistent naming
-                filename = f"file_{idx}.download"
-            except ValueError: # Should not happen if links_list is the original list
-                timestamp = int(time.time())
-                filename = f"file_unknown_{timestamp}.download"
-        
-        output_path = os.path.join(download_dir, filename)
-        state_file = os.path.join(state_dir, f"{filename}.state")
-
-        # Check existing state
-        if os.path.exists(state_file):
-            with open(state_file, 'r') as f_state:
-                status = f_state.read().strip()
-                if status == "COMPLETED":
-                    log_message(f"[SKIPPED] {filename} (URL: {url}) already marked as COMPLETED.")
-                    return True, url, "Skipped, already completed"
-        
-        log_message(f"[STARTED] Downloading {filename} from {url}")
-        
-        current_script_retry_count = 0
-        current_script_retry_delay = downloader_initial_retry_delay_seconds
-        operation_successful = False
-        
-        while current_script_retry_count <= downloader_max_retries and not operation_successful:
-            if current_script_retry_count > 0:
-                log_message(f"[SCRIPT RETRY {current_script_retry_count}/{downloader_max_retries}] For {filename}, waiting {current_script_retry_delay}s.")
-                time.sleep(current_script_retry_delay)
-                current_script_retry_delay = min(current_script_retry_delay * 2, 300) # Exponential backoff, max 5 mins
-
-            cmd = [
-                "curl", "-L", "-C", "-", 
-                "--retry", str(curl_retry_attempts),
-                "--retry-delay", str(curl_retry_delay_seconds),
-                "--retry-max-time", str(curl_retry_max_time_seconds),
-                "--connect-timeout", str(curl_connect_timeout_seconds),
-                "--max-time", str(curl_max_time_seconds),
-                "--speed-time", str(curl_speed_time_seconds),
-                "--speed-limit", str(curl_speed_limit_bytes_per_sec),
-                "-#", # Progress bar
-                "-o", output_path, url
-            ]
-            
-            log_message(f"[CURL CMD] For {filename}: {' '.join(cmd)}")
-            
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, text=True)
-            
-            # Log curl's output line by line
-            if process.stdout:
-                for line in iter(process.stdout.readline, ''):
-                    log_message(f"  {filename} (curl): {line.strip()}")
-            
-            process.wait() # Wait for curl to complete
-            
-            if process.returncode == 0:
-                if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-                    operation_successful = True
-                    file_size_mb = os.path.getsize(output_path) / (1024*1024)
-                    log_message(f"[COMPLETED] {filename} (URL: {url}). Size: {file_size_mb:.2f} MB.")
-                    with open(state_file, 'w') as f_state:
-                        f_state.write("COMPLETED")
-                    return True, url, f"Completed, Size: {file_size_mb:.2f} MB"
-                else:
-                    log_message(f"[FAILED ATTEMPT] {filename} (URL: {url}). Curl success (code 0), but file is missing or zero size.")
-                    # operation_successful remains False, will trigger script retry if applicable
-            else:
-                log_message(f"[FAILED ATTEMPT] {filename} (URL: {url}). Curl exit code: {process.returncode}.")
-            
-            current_script_retry_count += 1
-            
-        # If loop finishes and not successful
-        if not operation_successful:
-            error_message = f"Failed after {downloader_max_retries} script retries (curl errors or zero-size file)."
-            log_message(f"[EXHAUSTED RETRIES/FAILED] {filename} (URL: {url}). {error_message}")
-            with open(state_file, 'w') as f_state:
-                f_state.write(f"FAILED: {error_message}")
-            return False, url, error_message
+        job = prepare_download(url, download_dir, state_store, links_list, transport, curl_options,
+                               segments_per_file, segmented_min_size_bytes, expected, cache=cache)
+        if job is None:
+            return True, url, "Skipped, already completed"
+        filename = job["filename"]
+
+        retry_state = policy.new_state()
+        while True:
+            success, message = download_attempt(job, state_store, transport, curl_options, segments_per_file,
+                                                segment_max_retries, segment_retry_delay_seconds, controller, metrics, cache)
+            if success:
+                return True, url, message
+            wait = policy.next_delay(retry_state)
+            if wait is None:
+                break
+            # Never retry sooner than the host's Retry-After allows
+            wait = max(wait, controller.host_backoff_remaining(job["host"]) if controller else 0)
+            log_message(f"[SCRIPT RETRY {retry_state['retries']}/{downloader_max_retries}] For {filename}, waiting {wait:.0f}s.")
+            time.sleep(wait)
+
+        error_message = f"Failed after {downloader_max_retries} script retries (curl errors or zero-size file)."
+        _mark_failed(state_store, url, filename, error_message)
+        return False, url, error_message
 
     except Exception as e:
         error_message = f"Exception during download of {url} (filename: {filename}): {str(e)}"
         log_message(f"[ERROR] {error_message}")
-        # Attempt to write FAILED state even on general exception
-        if filename: # Check if filename was determined before exception
-            state_file = os.path.join(state_dir, f"{filename}.state")
-            try:
-                with open(state_file, 'w') as f_state:
-                    f_state.write(f"FAILED: Exception - {str(e)}")
-            except Exception as se:
-                log_message(f"Could not write state file for {filename} after exception: {se}")
+        # Attempt to record FAILED state even on general exception
+        _mark_failed(state_store, url, filename, error_message, state_error=f"Exception - {str(e)}")
         return False, url, error_message
-    
-    # Fallback, should ideally not be reached if logic above is complete
-    return False, url, "Unknown failure in download_file"
+
+
+def _run_downloads(url_iter, run_download, on_result, controller, metrics=None, admit=None, should_stop=None):
+    """
+    Call run_download(url) on worker threads for every URL from url_iter.
+    A download starts only when the controller grants a slot for its host; URLs
+    of busy or throttled hosts wait in a bounded lookahead buffer while other
+    hosts proceed. on_result(url, future) runs in this thread as each call ends;
+    if it returns a number of seconds, url is put on a delay queue keyed by the
+    time it becomes eligible and run again then, ahead of new URLs of its host.
+    No worker thread ever sleeps waiting for a retry. metrics, if given, is
+    kept informed of the number of running, ready and delayed URLs. admit(url),
+    if given, may hold URLs back (e.g. while staging scratch is full); they are
+    offered again on the next pass. Once should_stop(), if given, returns True
+    nothing more is started (retries included) and the call returns when the
+    running downloads have ended, with the URLs taken from url_iter that
+    never ran or were waiting for a retry.
+    """
+    lookahead = max(controller.max_total * 4, 64)
+    waiting = collections.OrderedDict() # host -> deque of URLs ready to start
+    buffered = 0
+    exhausted = False
+    delayed = [] # heap of (eligible_at, sequence, url) waiting for a retry
+    sequence = itertools.count()
+    in_flight = {} # future -> (url, host)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=controller.max_total) as executor:
+        while True:
+            if should_stop is not None and should_stop():
+                if not in_flight:
+                    return [url for queue in waiting.values() for url in queue] + [url for _, _, url in sorted(delayed)]
+                done, _ = concurrent.futures.wait(in_flight, timeout=1.0, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    url, host = in_flight.pop(future)
+                    controller.release(host)
+                    on_result(url, future) # Nothing is retried now
+                continue
+
+            while not exhausted and buffered < lookahead:
+                url = next(url_iter, None)
+                if url is None:
+                    exhausted = True
+                    break
+                waiting.setdefault(url_host(url), collections.deque()).append(url)
+                buffered += 1
+
+            now = time.time()
+            while delayed and delayed[0][0] <= now:
+                _, _, url = heapq.heappop(delayed)
+                waiting.setdefault(url_host(url), collections.deque()).appendleft(url)
+                buffered += 1
+
+            # Start as many downloads as the controller allows, rotating over hosts
+            started = True
+            while started and waiting and controller.has_capacity():
+                started = False
+                for host in list(waiting):
+                    if admit is not None and not admit(waiting[host][0]):
+                        continue
+                    if controller.try_acquire(host):
+                        url = waiting[host].popleft()
+                        buffered -= 1
+                        if waiting[host]:
+                            waiting.move_to_end(host)
+                        else:
+                            del waiting[host]
+                        in_flight[executor.submit(run_download, url)] = (url, host)
+                        started = True
+                        break
+
+            if metrics:
+                metrics.set_queue_state(len(in_flight), buffered, len(delayed))
+
+            # Wake up for the next due retry, and periodically while URLs wait so that
+            # paused hosts and limit changes are noticed
+            timeout = None
+            if delayed:
+                timeout = max(0.0, delayed[0][0] - time.time())
+            if waiting or should_stop is not None:
+                # The stop condition is checked about once a second too
+                timeout = min(timeout, 1.0) if timeout is not None else 1.0
+            if not in_flight:
+                if not waiting and not delayed and exhausted:
+                    break
+                if waiting:
+                    # Every waiting host is paused; sleep until the first one is released
+                    timeout = min(timeout, controller.next_unblock_in() or 1.0)
+                time.sleep(timeout)
+                continue
+            done, _ = concurrent.futures.wait(in_flight, timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                url, host = in_flight.pop(future)
+                controller.release(host)
+                retry_in = on_result(url, future)
+                if retry_in is not None:
+                    heapq.heappush(delayed, (time.time() + retry_in, next(sequence), url))
+    return []
 
 
 def download_files_concurrently(
-        urls, download_dir, state_dir,
+        urls, download_dir, state_store,
         main_params, 
         curl_params, 
         downloader_params, 
-        aggressive_retry_specific_params
+        aggressive_retry_specific_params,
+        segment_params=None,
+        links_list=None,
+        expectations=None,
+        job_control=None
     ):    
+    """
+    Download urls with a pool of worker threads. Each worker makes one attempt
+    at a time; failed URLs are rescheduled after their backoff delay, first with
+    the normal retry settings and then escalating to the aggressive ones, so
+    retries run alongside new downloads instead of in a separate pass.
+    urls may be any iterable (e.g. URLs claimed from a shared work queue); it is
+    consumed lazily through a bounded lookahead buffer. How many downloads run
+    at once, overall and per host, is decided by the concurrency controller.
+    links_list is the full manifest (a LinkIndex from utils.download_file_handler)
+    used for naming files (defaults to an index of urls); sharded tasks pass the
+    unsharded index so names agree.
+    expectations maps URLs to their expected size/digest (see source/checksums.py).
+    With job_control (see source/jobcontrol.py), downloads that can't finish
+    before the job's time limit are deferred, and once the job is stopping the
+    running ones are checkpointed in the journal (bytes on disk, validators)
+    instead of retried; results["unfinished"] then lists every URL taken from
+    urls that is neither completed nor failed.
+    """
     max_workers = main_params.get("max_workers", 3)
-    log_message(f"Starting concurrent download of {len(urls)} files with {max_workers} workers.")
+    segment_params = segment_params or {}
+    controller = controller_from_params(main_params)
+    policy = retry_policy_from_params(curl_params, downloader_params, aggressive_retry_specific_params)
+    if links_list is None:
+        # Index the URLs once so naming is O(1) per file and duplicates are dropped
+        links_list = urls if isinstance(urls, LinkIndex) else LinkIndex.from_urls(urls)
+        urls = links_list
+    # One transport is shared by every worker so the HTTP backend can reuse connections across files,
+    # and every byte it downloads passes through the same bandwidth governor
+    governor = governor_from_params(main_params)
+    transport = get_transport(main_params.get("download_backend", "curl"),
+                              main_params.get("http_max_idle_connections_per_host", 4), governor)
+    if job_control is not None:
+        job_control.on_abort(transport.abort)
+    url_count = f"{len(urls)} files" if hasattr(urls, "__len__") else "files from the shared work queue"
+    log_message(f"Starting concurrent download of {url_count} with {max_workers} workers ({transport.name} backend"
+                f"{f', adaptive {controller.min_total}-{controller.max_total}' if controller.adaptive else ''}).")
     
-    results = {"success": [], "failed": [], "pending": list(urls)}
-    status_file_path = os.path.join(download_dir, "download_status.txt") # Used by update_status
-
-    def update_status_file(pass_name="Initial Pass"):
-        # Appends to the status file. Initial header is written by hpc_downloader.py
-        with open(status_file_path, 'a') as sf:
-            sf.write(f"\n--- Status Update ({pass_name} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---\n")
-            sf.write(f"Total URLs: {len(urls)}\n")
-            sf.write(f"Successful/Skipped: {len(results['success'])}\n")
-            sf.write(f"Failed (this pass/total): {len(results['failed'])}\n") # This will show cumulative failures after retry pass
-            sf.write(f"Still Pending: {len(results['pending'])}\n\n")
-            
-            if results["success"]:
-                sf.write("Successful/Skipped Downloads:\n")
-                for s_url, msg in results["success"]:
-                    sf.write(f"  ✓ {s_url} ({msg})\n")
-            if results["failed"]:
-                sf.write("\nFailed Downloads (current list):\n")
-                for f_url, error in results["failed"]:
-                    sf.write(f"  ✗ {f_url} (Error: {error})\n")
-            if results["pending"]:
-                sf.write("\nPending Downloads:\n")
-                for p_url in results["pending"]:
-                    sf.write(f"  ⟳ {p_url}\n")
-            sf.write("--- End Status Update ---\n")
-
-    # update_status_file("Before Downloads Start") # Optional: initial detailed status
-
-    failed_urls_for_retry_pass = []
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_url = {
-            executor.submit(
-                download_file, url, download_dir, state_dir, urls, # Pass 'urls' as links_list
-                **curl_params, 
-                **downloader_params
-            ): url for url in urls
-        }
-        
-        for future in concurrent.futures.as_completed(future_to_url):
-            url_processed = future_to_url[future]
-            if url_processed in results["pending"]:
-                 results["pending"].remove(url_processed)
-            
-            try:
-                is_success, completed_url, message = future.result()
-                if is_success:
-                    results["success"].append((completed_url, message))
-                else:
-                    results["failed"].append((completed_url, message))
-                    if completed_url not in failed_urls_for_retry_pass:
-                        failed_urls_for_retry_pass.append(completed_url)
-            except Exception as exc:
-                error_msg = f"Future processing error for {url_processed}: {exc}"
-                log_message(f"[ERROR] {error_msg}")
-                results["failed"].append((url_processed, error_msg))
-                if url_processed not in failed_urls_for_retry_pass:
-                    failed_urls_for_retry_pass.append(url_processed)
-            
-            update_status_file("During Initial Pass")
+    results = {"success": [], "failed": [], "pending": [], "unfinished": []}
+    status_file_path = os.path.join(download_dir, main_params.get("status_file_name", "download_status.txt"))
+    merged_status_file_name = main_params.get("merged_status_file_name")
+    # In-memory counters; the status file is rewritten as a compact snapshot every K events / T seconds
+    status = StatusReporter(
+        status_file_path, [],
+        snapshot_every_events=main_params.get("status_snapshot_every_events", 100),
+        snapshot_interval_seconds=main_params.get("status_snapshot_interval_seconds", 30),
+        recent_failures=main_params.get("status_recent_failures", 20),
+        merged_status_path=os.path.join(download_dir, merged_status_file_name) if merged_status_file_name else None,
+    )
+    if hasattr(urls, "__len__"):
+        status.add_urls(urls)
+    status.start()
+    metrics = metrics_from_params(main_params, transport.name)
+    if metrics:
+        metrics.start()
+    progress = progress_from_params(main_params)
+    if progress is not None:
+        progress.start()
+    cache = cache_from_params(main_params)
+    staging = staging_from_params(main_params, download_dir)
+    if staging is not None:
+        staging.start()
+    # Completed files are post-processed (e.g. extracted) in a process pool while downloads continue
+    processor = postprocessor_from_params(main_params, state_store, download_dir)
+    mirrors = getattr(links_list, "mirrors", None) or {}
+    ranker = None
+    if mirrors:
+        ranker = MirrorRanker(transport, policy.stages[0]["options"],
+                              failure_cooldown_seconds=main_params.get("mirror_failure_cooldown_seconds", 60),
+                              probe_hosts=main_params.get("mirror_probe_hosts", True),
+                              probe_max_age_seconds=main_params.get("probe_cache_max_age_seconds", 86400))
 
-    log_message("\n===== Summary of Initial Download Pass =====")
-    log_message(f"Successfully downloaded/skipped: {len(results['success'])} files.")
-    log_message(f"Failed in initial pass: {len(results['failed'])} files.")
-    if results["failed"]:
-        log_message("Details of initial failures:")
-        for f_url, err in results["failed"]:
-            log_message(f"  - {f_url}: {err}")
+    segment_attempt_params = {key: segment_params[key] for key in
+                              ("segments_per_file", "segment_max_retries", "segment_retry_delay_seconds")
+                              if key in segment_params}
+    jobs = {} # url -> job from prepare_download (with its retry state) while the URL is in flight or delayed
 
-    if failed_urls_for_retry_pass:
-        log_message(f"\n===== Attempting Aggressive Retry for {len(failed_urls_for_retry_pass)} Failed Downloads =====")
-        
-        retry_pass_results = retry_failed_downloads(
-            list(set(failed_urls_for_retry_pass)), # Ensure unique URLs
-            download_dir, state_dir, urls, # Pass original 'urls' as links_list
-            main_params, # Can reuse main_params for max_workers or have a specific one
-            curl_params, # Base curl params
-            aggressive_retry_specific_params # Aggressive settings
-        )
-        
-        # Update main results based on retry pass
-        # Remove successfully retried URLs from the main 'failed' list
-        # Add successfully retried URLs to the main 'success' list
-        
-        newly_succeeded_urls_in_retry = [s_url for s_url, _ in retry_pass_results["success"]]
-        
-        # Add to main success list
-        results["success"].extend(retry_pass_results["success"])
-        
-        # Rebuild the main failed list: only those that failed in initial AND also failed in retry
-        final_failed_list = []
-        for initial_fail_url, initial_error in results["failed"]:
-            if initial_fail_url not in newly_succeeded_urls_in_retry:
-                # Check if it was part of the retry attempt and if it's in retry_pass_results["failed"]
-                found_in_retry_failures = False
-                for retry_fail_url, retry_error_msg in retry_pass_results["failed"]:
-                    if retry_fail_url == initial_fail_url:
-                        final_failed_list.append((retry_fail_url, retry_error_msg)) # Use the latest error
-                        found_in_retry_failures = True
-                        break
-                if not found_in_retry_failures:
-                     # This means it failed initially but wasn't in the retry batch (should not happen if failed_urls_for_retry_pass is correct)
-                     # OR it was in the retry batch but somehow not in retry_pass_results["failed"] (e.g. an exception before it was added there)
-                     # For safety, keep its original failure status if not explicitly succeeded or re-failed.
-                     final_failed_list.append((initial_fail_url, initial_error))
+    def known_size(url):
+        """Size of url from the links file or a cached probe (None if unknown)"""
+        expected = expectations.get(url) if expectations else None
+        if expected and expected["size"] is not None:
+            return expected["size"]
+        record = state_store.get(url)
+        return record["content_length"] if record else None
+
+    def run_download(url):
+        record = state_store.get(url) if job_control is not None else None
+        if job_control is not None and not (record and record["status"] == STATUS_COMPLETED):
+            size = known_size(url)
+            done = (record["bytes_done"] or 0) if record and record["status"] == STATUS_IN_PROGRESS else 0
+            if not job_control.can_finish(max(0, size - done) if size else None):
+                return None, "not enough time left in the job to finish it"
+        status.record_started(url)
+        job = jobs.get(url)
+        if job is None:
+            job = prepare_download(url, download_dir, state_store, links_list, transport, policy.stages[0]["options"],
+                                   segment_params.get("segments_per_file", 1),
+                                   segment_params.get("segmented_min_size_bytes", 512*1024*1024),
+                                   expected=expectations.get(url) if expectations else None,
+                                   probe_max_age_seconds=main_params.get("probe_cache_max_age_seconds", 86400),
+                                   cache=cache, revalidate_cached=main_params.get("cache_revalidate", True),
+                                   revalidate_completed=main_params.get("revalidate_completed", False),
+                                   staging=staging, mirrors=mirrors.get(url), ranker=ranker)
+            if job is None:
+                return True, "Skipped, already completed"
+            job["retry"] = policy.new_state()
+            job["stage"] = policy.stage(job["retry"])["name"]
+            jobs[url] = job
+        return download_attempt(job, state_store, transport, policy.options(job["retry"]),
+                                controller=controller, metrics=metrics, cache=cache, staging=staging,
+                                on_completed=processor.submit if processor is not None else None,
+                                ranker=ranker, job_control=job_control, progress=progress, **segment_attempt_params)
+
+    failed_by_url = {} # url -> final error, in the order URLs gave up
+    deferred = [] # URLs not started because the job is ending
 
+    def release_staging(url, job):
+        """Free url's scratch reservation once it is done; a partial staged file is useless after a final failure"""
+        if staging is not None:
+            staging.release(url, job["output_path"] if job and job["output_path"] != job["final_path"] else None)
 
-        results["failed"] = final_failed_list
-        update_status_file("After Aggressive Retry Pass")
+    def record_result(url, future):
+        job = jobs.get(url)
+        filename = job["filename"] if job else ""
+        try:
+            is_success, message = future.result()
+        except Exception as exc:
+            error_message = f"Exception during download of {url} (filename: {filename}): {exc}"
+            log_message(f"[ERROR] {error_message}")
+            _mark_failed(state_store, url, filename, error_message, state_error=f"Exception - {exc}")
+            jobs.pop(url, None)
+            release_staging(url, job)
+            status.record_failure(url, error_message)
+            failed_by_url[url] = error_message
+            return None
+
+        if is_success is None:
+            log_message(f"[DEFERRED] {filename or url_to_filename(url, links_list)} (URL: {url}): {message}.")
+            deferred.append(url)
+            return None
+
+        if is_success:
+            jobs.pop(url, None)
+            release_staging(url, None) # A staged file now belongs to the flusher
+            record = state_store.get(url)
+            if processor is not None and message.startswith("Skipped"):
+                # Completed earlier or served from the cache; processed unless the journal says it was
+                path = os.path.join(download_dir, url_to_filename(url, links_list))
+                if os.path.exists(path):
+                    processor.submit(url, path)
+            status.record_success(url, skipped=message.startswith("Skipped"),
+                                  bytes_downloaded=record["bytes_done"] if record else 0)
+            results["success"].append((url, message))
+            return None
+
+        if job_control is not None and job_control.stopping:
+            # No retry in this job; the journal has the bytes on disk for the next one to resume from
+            record = state_store.get(url)
+            log_message(f"[CHECKPOINT] {filename} (URL: {url}): {(record['bytes_done'] or 0) / (1024*1024):.2f} MB "
+                        f"on disk, resumed by the next job.")
+            return None
+
+        sources = job.get("sources")
+        if sources and job["segmented_size"] is None:
+            if job["source_index"] + 1 < len(sources):
+                # Another mirror may have it: try the next one now instead of backing off
+                job["source_index"] += 1
+                job["failovers"] = job.get("failovers", 0) + 1
+                if metrics:
+                    metrics.record_failover(job["host"])
+                log_message(f"[FAILOVER] {filename}: {source_key(sources[job['source_index'] - 1])} failed, "
+                            f"switching to {ranker.describe(sources[job['source_index']])}.")
+                status.record_retry(url)
+                return 0
+            # Every mirror failed this round: back off as usual, then start again from the best one
+            job["sources"] = ranker.rank(sources, job["segmented_size"])
+            job["source_index"] = 0
+
+        retry_state = job["retry"]
+        previous_stage = retry_state["stage"]
+        wait = policy.next_delay(retry_state)
+        if wait is not None:
+            stage = policy.stage(retry_state)
+            if retry_state["stage"] != previous_stage:
+                job["stage"] = stage["name"]
+                log_message(f"[ESCALATED] {filename}: {policy.stages[previous_stage]['name']} retries exhausted, "
+                            f"switching to {stage['name']} settings.")
+            # Never retry sooner than the host's Retry-After allows
+            wait = max(wait, controller.host_backoff_remaining(job["host"]))
+            log_message(f"[{stage['label']} {retry_state['retries']}/{stage['max_retries']}] For {filename}, "
+                        f"next attempt in {wait:.0f}s.")
+            status.record_retry(url)
+            if metrics:
+                metrics.record_retry_scheduled(job["host"], wait)
+            return wait
+
+        error_message = f"Failed after {policy.total_retries()} script retries (curl errors, zero-size or mismatching file). Last error: {message}"
+        _mark_failed(state_store, url, filename, error_message)
+        jobs.pop(url, None)
+        release_staging(url, job)
+        status.record_failure(url, error_message)
+        failed_by_url[url] = error_message
+        return None
+
+    def admit(url):
+        """Hold new URLs back while scratch is full; the size comes from the links file or a cached probe"""
+        if state_store.get_status(url) == STATUS_COMPLETED:
+            return staging.admit(url, 0)
+        return staging.admit(url, known_size(url) or 0)
+
+    def counted(url_iter):
+        for url in url_iter:
+            status.add_urls([url])
+            yield url
+
+    unstarted = _run_downloads(counted(iter(urls)), run_download, record_result, controller, metrics,
+                               admit if staging is not None else None,
+                               (lambda: job_control.stopping) if job_control is not None else None)
+    stopped = job_control is not None and job_control.stopping
+    if stopped:
+        # Downloads checkpointed mid-transfer or waiting for a retry keep their jobs
+        checkpoint = {}
+        for url, job in jobs.items():
+            release_staging(url, None)
+            record = state_store.get(url)
+            checkpoint[url] = (record["bytes_done"] or 0) if record else 0
+        state_store.set_meta("checkpoint", json.dumps({"time": time.time(), "reason": job_control.reason,
+                                                       "in_flight": checkpoint}))
+        results["unfinished"] = list(dict.fromkeys(list(jobs) + deferred + unstarted))
+        log_message(f"[CHECKPOINT] Job stopping ({job_control.reason}): {len(checkpoint)} partial downloads "
+                    f"({sum(checkpoint.values()) / (1024*1024):.1f} MB) checkpointed, "
+                    f"{len(results['unfinished']) - len(checkpoint)} URLs left for the next job.")
+    else:
+        results["unfinished"] = deferred
+    if staging is not None:
+        staging.close() # Waits for the last batch
+        flush_failed = dict(staging.flush_failures)
+        for url, error_message in flush_failed.items():
+            _mark_failed(state_store, url, url_to_filename(url, links_list), error_message)
+            status.record_failure(url, error_message)
+            failed_by_url[url] = error_message
+        results["success"] = [item for item in results["success"] if item[0] not in flush_failed]
+    if processor is not None:
+        processor.close(cancel=stopped) # Unprocessed files are picked up by the next job
+
+    results["failed"] = list(failed_by_url.items())
+    results["pending"] = list(status.pending)
+    status.set_phase(f"Stopped ({job_control.reason})" if stopped else "Finished")
+    status.stop()
+    if metrics:
+        metrics.stop()
+    if progress is not None:
+        progress.stop()
+
+    transport.close()
+    if governor is not None:
+        governor.close()
+    state_store.flush()
 
     log_message("\n===== Final Download Job Summary =====")
     log_message(f"Total successfully downloaded/skipped: {len(results['success'])} files.")
     log_message(f"Permanently failed after all attempts: {len(results['failed'])} files.")
+    if cache is not None:
+        log_message(f"Served from the cache: {cache.hits} files; added to the cache: {cache.stores} files.")
+    if results["unfinished"]:
+        log_message(f"Left for the next job: {len(results['unfinished'])} files.")
     if results["failed"]:
         log_message("Details of permanently failed downloads:")
         for f_url, err in results["failed"]:
             log_message(f"  - {f_url}: {err}")
-    else:
+    elif not results["unfinished"]:
         log_message("All downloads were successful or skipped.")
             
     return results
-
-
-def retry_failed_downloads(
-        urls_to_retry, download_dir, state_dir, original_links_list,
-        main_params_for_retry, # Contains max_workers for retry
-        base_curl_params, 
-        aggressive_retry_config
-    ):
-    if not urls_to_retry:
-        return {"success": [], "failed": []}
-
-    max_workers = main_params_for_retry.get("max_workers", 2) # Default to 2 workers for retry if not specified
-    log_message(f"Aggressive retry: {len(urls_to_retry)} URLs with {max_workers} workers.")
-
-    retry_results = {"success": [], "failed": []}
-
-    # Prepare parameters for aggressive download_file attempts
-    # Start with base curl parameters and override specific ones for aggression
-    aggressive_curl_params_for_call = base_curl_params.copy()
-    if "curl_max_time_seconds" in aggressive_retry_config: # Check if specific override exists
-        aggressive_curl_params_for_call["curl_max_time_seconds"] = aggressive_retry_config["curl_max_time_seconds"]
-    # Potentially override other curl params if defined in aggressive_retry_config
-
-    # Prepare aggressive downloader loop parameters
-    aggressive_downloader_params_for_call = {
-        "downloader_max_retries": aggressive_retry_config.get("downloader_max_retries", 8),
-        "downloader_initial_retry_delay_seconds": aggressive_retry_config.get("downloader_initial_retry_delay_seconds", 30),
-    }
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_url = {
-            executor.submit(
-                download_file, url, download_dir, state_dir, original_links_list,
-                **aggressive_curl_params_for_call,
-                **aggressive_downloader_params_for_call
-            ): url for url in urls_to_retry
-        }
-        
-        for future in concurrent.futures.as_completed(future_to_url):
-            url_processed = future_to_url[future]
-            try:
-                is_success, completed_url, message = future.result()
-                if is_success:
-                    retry_results["success"].append((completed_url, message))
-                else:
-                    retry_results["failed"].append((completed_url, message))
-            except Exception as exc:
-                error_msg = f"Aggressive retry future processing error for {url_processed}: {exc}"
-                log_message(f"[ERROR] {error_msg}")
-                retry_results["failed"].append((url_processed, error_msg))
-    
-    log_message(f"Aggressive retry summary: {len(retry_results['success'])} succeeded, {len(retry_results['failed'])} failed.")
-    return retry_results
\ No newline at end of file
@@ -0,0 +1,211 @@
+import os
+import time
+import signal
+import threading
+import subprocess
+from datetime import datetime
+from .utils import log_message
+
+# Weight of the newest measurement in the per-download rate average
+_EWMA_ALPHA = 0.3
+# Downloads smaller than this say little about the rate
+_MIN_RATE_SAMPLE_BYTES = 1024 * 1024
+# How often the end time is asked again (scontrol update may have changed the time limit)
+_END_TIME_REFRESH_SECONDS = 600
+
+
+def job_end_time(environ=None):
+    """
+    Epoch time at which Slurm will end this job, or None outside Slurm or
+    without a limit: SLURM_JOB_END_TIME if set, else the end time squeue reports.
+    """
+    environ = os.environ if environ is None else environ
+    value = environ.get("SLURM_JOB_END_TIME")
+    if value and value.isdigit():
+        return float(value)
+    job_id = environ.get("SLURM_JOB_ID")
+    if not job_id:
+        return None
+    try:
+        process = subprocess.run(["squeue", "-h", "-j", job_id, "-o", "%e"], stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, universal_newlines=True, timeout=30)
+    except (OSError, subprocess.SubprocessError) as e:
+        log_message(f"[JOB] Could not ask squeue for the end time of job {job_id}: {e}")
+        return None
+    value = process.stdout.strip().splitlines()[0].strip() if process.stdout.strip() else ""
+    try:
+        # Local time, e.g. 2024-05-03T10:00:00; "N/A"/"NONE"/"Unknown" when there is no limit
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S").timestamp()
+    except ValueError:
+        return None
+
+
+def requeue_job(environ=None):
+    """Ask Slurm to requeue this job (the job must be requeueable, e.g. sbatch --requeue); True on success"""
+    environ = os.environ if environ is None else environ
+    job_id = environ.get("SLURM_JOB_ID")
+    if not job_id:
+        log_message("[JOB] Not running under Slurm; nothing to requeue.")
+        return False
+    try:
+        process = subprocess.run(["scontrol", "requeue", job_id], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True, timeout=60)
+    except (OSError, subprocess.SubprocessError) as e:
+        log_message(f"[JOB] scontrol requeue {job_id} failed: {e}")
+        return False
+    if process.returncode != 0:
+        log_message(f"[JOB] scontrol requeue {job_id} failed: {process.stdout.strip()}")
+        return False
+    log_message(f"[JOB] Requeued job {job_id}; the next allocation resumes from the checkpoint.")
+    return True
+
+
+class JobControl:
+    """
+    Keeps a download job inside its Slurm time limit. stop_margin_seconds
+    before the end (or on SIGUSR1, e.g. from sbatch --signal=B:USR1@300) the
+    job drains: no new downloads or retries are started and the running ones
+    may still finish. abort_margin_seconds before the end, or on SIGTERM, the
+    running transfers are aborted so their progress can be checkpointed before
+    Slurm kills the job. can_finish() tells whether a download of a given size
+    would end before that, from the rate of the downloads finished so far.
+
+    Signal handlers only set flags; a monitor thread does the rest.
+    """
+
+    def __init__(self, end_time=None, stop_margin_seconds=300, abort_margin_seconds=60, signal_lead_seconds=300,
+                 end_time_fn=None):
+        self.end_time = end_time
+        self.stop_margin_seconds = stop_margin_seconds
+        self.abort_margin_seconds = abort_margin_seconds
+        self.signal_lead_seconds = signal_lead_seconds
+        self.end_time_fn = end_time_fn
+        self.reason = None # Why the job stopped starting downloads, once it did
+        self._signalled = None # Name of the signal received, set by the handler
+        self._terminate = False
+        self._aborted = False
+        self._logged = False
+        self._abort_callbacks = []
+        self._rate = None # bytes per second of one download, moving average
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def install_signal_handlers(self):
+        """Handle SIGUSR1 (drain) and SIGTERM (abort now); must be called from the main thread"""
+        signal.signal(signal.SIGUSR1, self._on_signal)
+        signal.signal(signal.SIGTERM, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self._signalled = signal.Signals(signum).name
+        if signum == signal.SIGTERM:
+            self._terminate = True
+
+    def time_left(self):
+        """Seconds until the job ends, or None if that is not known"""
+        return self.end_time - time.time() if self.end_time is not None else None
+
+    @property
+    def stopping(self):
+        """True once no new downloads should be started"""
+        if self.reason is None:
+            self._check()
+        return self.reason is not None
+
+    @property
+    def aborted(self):
+        return self._aborted
+
+    def _check(self):
+        with self._lock:
+            if self._signalled and self.reason is None:
+                if self.end_time is None or self.time_left() > self.signal_lead_seconds:
+                    # sbatch --signal=B:USR1@<lead> arrives <lead> seconds before the end
+                    self.end_time = time.time() + self.signal_lead_seconds
+                self.reason = f"received {self._signalled}"
+            time_left = self.time_left()
+            if self.reason is None and time_left is not None and time_left <= self.stop_margin_seconds:
+                self.reason = f"{max(0, time_left):.0f}s left in the job's time limit"
+            if self.reason is not None and not self._logged:
+                self._logged = True
+                log_message(f"[JOB] Stopping: {self.reason}. No new downloads are started; "
+                            f"running ones are checkpointed if they can't finish.")
+            abort = not self._aborted and (self._terminate or (time_left is not None and time_left <= self.abort_margin_seconds))
+            if abort:
+                self._aborted = True
+                callbacks = list(self._abort_callbacks)
+        if abort:
+            log_message("[JOB] Aborting running transfers to checkpoint them before the job ends.")
+            for callback in callbacks:
+                callback()
+
+    def on_abort(self, callback):
+        """Call callback() (e.g. a transport's abort) when running transfers must end"""
+        with self._lock:
+            self._abort_callbacks.append(callback)
+            aborted = self._aborted
+        if aborted:
+            callback()
+
+    def record_attempt(self, attempt):
+        """Learn the per-download rate from one transport attempt result"""
+        transfer_time = (attempt.get("elapsed") or 0) - (attempt.get("ttfb") or 0)
+        if attempt["returncode"] != 0 or (attempt.get("bytes") or 0) < _MIN_RATE_SAMPLE_BYTES or transfer_time <= 0:
+            return
+        rate = attempt["bytes"] / transfer_time
+        with self._lock:
+            self._rate = rate if self._rate is None else (1 - _EWMA_ALPHA) * self._rate + _EWMA_ALPHA * rate
+
+    def can_finish(self, remaining_bytes):
+        """
+        Whether a download with remaining_bytes left (None if unknown) is
+        expected to end before running transfers are aborted. Always True
+        while the end time or the download rate is unknown.
+        """
+        if self.stopping:
+            return False
+        time_left = self.time_left()
+        if time_left is None or not remaining_bytes or not self._rate:
+            return True
+        return remaining_bytes / self._rate <= time_left - self.abort_margin_seconds
+
+    def describe(self):
+        time_left = self.time_left()
+        if time_left is None:
+            return "no time limit known; draining on SIGUSR1, checkpointing on SIGTERM"
+        return (f"{time_left / 3600:.1f}h left; new downloads stop {self.stop_margin_seconds}s "
+                f"and running ones are checkpointed {self.abort_margin_seconds}s before the end")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="job-control", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        refreshed = time.time()
+        while not self._stop_event.wait(1.0):
+            if self.end_time_fn is not None and self._signalled is None \
+                    and time.time() - refreshed >= _END_TIME_REFRESH_SECONDS:
+                refreshed = time.time()
+                end_time = self.end_time_fn()
+                if end_time is not None and end_time != self.end_time:
+                    self.end_time = end_time
+                    log_message(f"[JOB] Job end time is now {datetime.fromtimestamp(end_time):%Y-%m-%d %H:%M:%S}.")
+            self._check()
+
+
+def jobcontrol_from_params(main_params):
+    """
+    Build the job control from the configuration (see configs.py). Unlike the
+    other builders it is called with the loaded config itself, before
+    main_params exists, so that signals are handled from the start.
+    """
+    job_control = JobControl(job_end_time(), main_params.get("slurm_stop_margin_seconds", 300),
+                             main_params.get("slurm_abort_margin_seconds", 60),
+                             main_params.get("slurm_signal_lead_seconds", 300), end_time_fn=job_end_time)
+    log_message(f"[JOB] Time limit: {job_control.describe()}.")
+    return job_control
@@ -0,0 +1,262 @@
+import os
+import re
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+FORMATS = ("text", "json", "kv")
+
+# Leading "[TAG]" of a message, e.g. "[COMPLETED]" or "[SCRIPT RETRY 2/5]"
+_TAG = re.compile(r"\s*\[([A-Z][A-Z _-]*)")
+_WARNING_TAGS = ("FAILED", "EXHAUSTED", "VERIFY FAILED", "FLUSH FAILED", "PROCESSING FAILED")
+_MAX_BATCH = 5000 # Records written per write() call at most
+
+_pipeline = None
+
+
+def classify(message):
+    """(level, event) of a message from its leading [TAG], for callers that don't give a level"""
+    match = _TAG.match(message)
+    event = match.group(1).strip() if match else None
+    if event == "ERROR" or message.startswith("Error"):
+        return "ERROR", event
+    if (event and event.startswith(_WARNING_TAGS)) or message.startswith("!!!"):
+        return "WARNING", event
+    return "INFO", event
+
+
+def format_record(record, fmt):
+    """One output line for a record: "text" is the classic "[time] message", "json" and "kv" add level, event and fields"""
+    if fmt == "text":
+        return f"[{datetime.fromtimestamp(record['time']):%Y-%m-%d %H:%M:%S}] {record['message']}\n"
+    fields = {"time": datetime.fromtimestamp(record["time"]).isoformat(timespec="milliseconds"),
+              "level": record["level"], "event": record["event"], "message": record["message"]}
+    fields.update(record["fields"])
+    if fmt == "json":
+        return json.dumps(fields, default=str) + "\n"
+    return " ".join(f"{key}={_kv_value(value)}" for key, value in fields.items() if value is not None) + "\n"
+
+
+def _kv_value(value):
+    value = str(value)
+    if value and not any(c in value for c in ' "=\n'):
+        return value
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+
+
+class LogPipeline:
+    """
+    Log records are put on a queue by the calling thread, which never waits
+    for I/O, and written by one background thread in batches: whatever has
+    queued up since the last write goes out in a single write() and flush(),
+    at least every flush_interval_seconds. stream gets records in fmt; with
+    file_path, every record is also appended there as a JSON line.
+    """
+
+    def __init__(self, stream=None, fmt="text", level="INFO", file_path=None, flush_interval_seconds=1.0):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown log_format '{fmt}' (expected one of {', '.join(FORMATS)})")
+        self.stream = stream or sys.stdout
+        self.fmt = fmt
+        self.min_level = LEVELS[level.upper()]
+        self.file_path = file_path
+        self.flush_interval_seconds = flush_interval_seconds
+        self._file = None
+        if file_path:
+            os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+            self._file = open(file_path, 'a')
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def emit(self, message, level=None, **fields):
+        default_level, event = classify(message)
+        level = level or default_level
+        if LEVELS[level] < self.min_level:
+            return
+        self._queue.put({"time": time.time(), "level": level, "event": event, "message": message, "fields": fields})
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.flush_interval_seconds)]
+            except queue.Empty:
+                continue
+            while len(batch) < _MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            records = [record for record in batch if record is not None]
+            if records:
+                self._write(records)
+            if stop:
+                return
+
+    def _write(self, records):
+        try:
+            self.stream.write("".join(format_record(record, self.fmt) for record in records))
+            self.stream.flush()
+            if self._file is not None:
+                self._file.write("".join(format_record(record, "json") for record in records))
+                self._file.flush()
+        except (OSError, ValueError):
+            pass # Nowhere left to report it; logging must not take the job down
+
+    def close(self):
+        """Write everything still queued and stop the writer"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        if self._file is not None:
+            self._file.close()
+
+
+def log(message, level=None, **fields):
+    """Log through the pipeline if one is running, else print right away (one-off tools, tests)"""
+    pipeline = _pipeline
+    if pipeline is not None:
+        pipeline.emit(message, level, **fields)
+        return
+    print(f"[{datetime.now():%Y-%m-%d %H:%M:%S}] {message}")
+    sys.stdout.flush()
+
+
+def start_logging(fmt="text", level="INFO", file_path=None, flush_interval_seconds=1.0):
+    """Route log_message through a background LogPipeline for the rest of the process"""
+    global _pipeline
+    if _pipeline is not None:
+        return _pipeline
+    _pipeline = LogPipeline(sys.stdout, fmt, level, file_path, flush_interval_seconds)
+    atexit.register(stop_logging)
+    return _pipeline
+
+
+def stop_logging():
+    """Write out what is queued and go back to printing directly"""
+    global _pipeline
+    pipeline, _pipeline = _pipeline, None
+    if pipeline is not None:
+        pipeline.close()
+
+
+def logging_from_params(main_params, file_path=None):
+    """
+    Start the log pipeline from the configuration (see configs.py); like the
+    job control it is set up before main_params exists. file_path overrides
+    log_file (e.g. with a per-task name).
+    """
+    return start_logging(main_params.get("log_format", "text"), main_params.get("log_level", "INFO"),
+                         file_path or main_params.get("log_file"),
+                         main_params.get("log_flush_interval_seconds", 1.0))
+
+
+class ProgressTracker:
+    """
+    Periodic progress lines instead of per-chunk output: every interval_seconds
+    one line per running download (at most max_files, largest first) and one
+    overall line with the aggregate rate. Bytes are sampled from bytes_fn of
+    each download (e.g. the size of its file), so transfers themselves report
+    nothing.
+    """
+
+    def __init__(self, interval_seconds=30, max_files=20):
+        self.interval_seconds = interval_seconds
+        self.max_files = max_files
+        self._active = {} # url -> [label, total, bytes_fn, bytes at the last sample, started at]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_report = time.time()
+        self.bytes_total = 0
+        self.finished = 0
+
+    def begin(self, url, label, total, bytes_fn):
+        """A transfer of url started; bytes_fn() returns its bytes on disk (total may be None if unknown)"""
+        initial = self._sample(bytes_fn)
+        with self._lock:
+            self._active[url] = [label, total, bytes_fn, initial, time.time()]
+
+    def end(self, url):
+        with self._lock:
+            entry = self._active.pop(url, None)
+        if entry is not None:
+            # Once popped, report() no longer touches the entry, so its last sample is final here
+            delta = max(0, self._sample(entry[2]) - entry[3])
+            with self._lock:
+                self.bytes_total += delta
+                self.finished += 1
+
+    @staticmethod
+    def _sample(bytes_fn):
+        try:
+            return bytes_fn() or 0
+        except OSError:
+            return 0
+
+    def report(self):
+        now = time.time()
+        elapsed = max(1e-6, now - self._last_report)
+        self._last_report = now
+        with self._lock:
+            active = list(self._active.items())
+        # Sample outside the lock (a stat per file), then count under it
+        samples = [(url, entry, self._sample(entry[2])) for url, entry in active]
+        lines = []
+        interval_bytes = 0
+        with self._lock:
+            for url, entry, current in samples:
+                if self._active.get(url) is not entry:
+                    continue # Ended meanwhile; end() counted its bytes
+                label, total, _, previous, _ = entry
+                delta = max(0, current - previous)
+                entry[3] = max(previous, current)
+                interval_bytes += delta
+                lines.append((current, url, label, total, delta / elapsed))
+            self.bytes_total += interval_bytes
+        lines.sort(key=lambda line: line[0], reverse=True)
+        for current, url, label, total, rate in lines[:self.max_files]:
+            done = f"{current / total * 100:.1f}% of {total / (1024*1024):.1f} MB" if total else f"{current / (1024*1024):.1f} MB"
+            log(f"[PROGRESS] {label}: {done} at {rate / (1024*1024):.2f} MB/s",
+                url=url, bytes=current, total=total, rate=round(rate))
+        if lines or interval_bytes:
+            more = f" ({len(lines) - self.max_files} not listed)" if len(lines) > self.max_files else ""
+            log(f"[PROGRESS] {len(lines)} downloads running{more}, {interval_bytes / elapsed / (1024*1024):.2f} MB/s "
+                f"over the last {elapsed:.0f}s, {_format_bytes(self.bytes_total)} so far, {self.finished} transfers ended.",
+                active=len(lines), rate=round(interval_bytes / elapsed), bytes=self.bytes_total)
+
+    def start(self):
+        if self.interval_seconds and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval_seconds):
+            self.report()
+
+
+def _format_bytes(n):
+    return f"{n / (1024**3):.2f} GB" if n >= 1024**3 else f"{n / (1024*1024):.1f} MB"
+
+
+def progress_from_params(main_params):
+    """Build the progress tracker from the main_params dictionary assembled in hpc_downloader.py (None if disabled)"""
+    interval = main_params.get("progress_interval_seconds", 30)
+    if not interval:
+        return None
+    return ProgressTracker(interval, main_params.get("progress_max_files", 20))
@@ -0,0 +1,289 @@
+import os
+import sys
+import math
+import json
+import time
+import threading
+import collections
+from .utils import log_message, atomic_write
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list (None if empty)"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _label_value(value):
+    # Escaping required by the Prometheus text format
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRecorder:
+    """
+    Performance telemetry for a download job.
+
+    Every attempt is appended as one JSON line to jsonl_path (connect time,
+    time to first byte, transfer time, bytes, exit code, retry number, ...).
+    An attempt on the next mirror right after a failure is a failover, not a
+    retry: its retry number stays that of the attempt it replaces.
+    Rolling aggregates over the last window_seconds (throughput, p50/p95
+    attempt durations and TTFB, per-host throughput) plus the dispatcher's
+    in-flight and queue depth gauges are written every flush_interval_seconds
+    to summary_path as JSON and, when prometheus_path is given, in the
+    Prometheus text format for node_exporter's textfile collector.
+    """
+
+    def __init__(self, jsonl_path, summary_path=None, prometheus_path=None, window_seconds=300,
+                 flush_interval_seconds=15, labels=None, backend=None):
+        self.jsonl_path = jsonl_path
+        self.summary_path = summary_path
+        self.prometheus_path = prometheus_path
+        self.window_seconds = window_seconds
+        self.flush_interval_seconds = flush_interval_seconds
+        self.labels = labels or {}
+        self.backend = backend
+        self.started_at = time.time()
+
+        self._window = collections.deque() # (finished_at, bytes, elapsed, ttfb, ok, host)
+        self.attempts_by_outcome = collections.Counter()
+        self.bytes_total = 0
+        self.bytes_by_host = collections.Counter()
+        self.backoff_seconds_total = 0.0
+        self.retries_scheduled = 0
+        self.failovers = 0
+        self.in_flight = 0
+        self.queued = 0
+        self.retry_waiting = 0
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+        os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+        # Appended to, so a restarted job keeps the history of earlier runs
+        self._jsonl = open(jsonl_path, 'a', buffering=1024 * 1024)
+
+    # ---- events ----
+
+    def record_attempt(self, job, attempt, success, error=None):
+        """One finished attempt of a job from downloader.prepare_download"""
+        now = time.time()
+        ttfb = attempt.get("ttfb")
+        elapsed = attempt.get("elapsed") or 0.0
+        record = {
+            "ts": round(now, 3),
+            "url": job["url"],
+            "host": job["host"],
+            "filename": job["filename"],
+            "backend": self.backend,
+            "attempt": job.get("attempts", 1),
+            "retry": job.get("attempts", 1) - 1 - job.get("failovers", 0),
+            "failover": job.get("source_index", 0) > 0,
+            "stage": job.get("stage"),
+            "segmented": job.get("segmented_size") is not None,
+            "returncode": attempt.get("returncode"),
+            "http_status": attempt.get("http_status"),
+            "bytes": attempt.get("bytes") or 0,
+            "elapsed": round(elapsed, 4),
+            "connect_time": attempt.get("connect_time"),
+            "ttfb": ttfb,
+            "transfer_time": round(elapsed - ttfb, 4) if ttfb is not None else None,
+            "success": success,
+            "error": error,
+        }
+        record.update(self.labels)
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._jsonl.write(line)
+            self.attempts_by_outcome["success" if success else "failure"] += 1
+            self.bytes_total += record["bytes"]
+            self.bytes_by_host[job["host"]] += record["bytes"]
+            self._window.append((now, record["bytes"], elapsed, ttfb, success, job["host"]))
+
+    def record_retry_scheduled(self, host, wait_seconds):
+        """A failed URL was put on the retry queue for wait_seconds"""
+        with self._lock:
+            self.retries_scheduled += 1
+            self.backoff_seconds_total += wait_seconds
+
+    def record_failover(self, host):
+        """A failed attempt moves on to the next mirror at once, without a retry"""
+        with self._lock:
+            self.failovers += 1
+
+    def set_queue_state(self, in_flight, queued, retry_waiting):
+        """Gauges from the dispatcher: running downloads, URLs ready to start, URLs waiting for a retry"""
+        self.in_flight, self.queued, self.retry_waiting = in_flight, queued, retry_waiting
+
+    # ---- aggregates ----
+
+    def _aggregates_locked(self):
+        now = time.time()
+        while self._window and self._window[0][0] < now - self.window_seconds:
+            self._window.popleft()
+        window_seconds = min(self.window_seconds, max(now - self.started_at, 1e-6))
+        durations = sorted(entry[2] for entry in self._window)
+        ttfbs = sorted(entry[3] for entry in self._window if entry[3] is not None)
+        host_bytes = collections.Counter()
+        for entry in self._window:
+            host_bytes[entry[5]] += entry[1]
+        failures = sum(1 for entry in self._window if not entry[4])
+        return {
+            "updated_at": now,
+            "window_seconds": round(window_seconds, 1),
+            "attempts_in_window": len(self._window),
+            "failures_in_window": failures,
+            "bytes_per_second": sum(entry[1] for entry in self._window) / window_seconds,
+            "duration_p50": percentile(durations, 0.5),
+            "duration_p95": percentile(durations, 0.95),
+            "ttfb_p50": percentile(ttfbs, 0.5),
+            "ttfb_p95": percentile(ttfbs, 0.95),
+            "host_bytes_per_second": {host: b / window_seconds for host, b in host_bytes.most_common()},
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "retry_waiting": self.retry_waiting,
+            "attempts_total": dict(self.attempts_by_outcome),
+            "bytes_total": self.bytes_total,
+            "retries_scheduled_total": self.retries_scheduled,
+            "failovers_total": self.failovers,
+            "backoff_seconds_total": round(self.backoff_seconds_total, 1),
+        }
+
+    def aggregates(self):
+        with self._lock:
+            return self._aggregates_locked()
+
+    def _prometheus_text_locked(self, aggregates):
+        def labels(**extra):
+            parts = [f'{key}="{_label_value(value)}"' for key, value in sorted(self.labels.items())]
+            parts += [f'{key}="{_label_value(value)}"' for key, value in extra.items()]
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP hpc_downloader_{name} {help_text}")
+            lines.append(f"# TYPE hpc_downloader_{name} {kind}")
+            for sample_labels, value in samples:
+                if value is not None:
+                    lines.append(f"hpc_downloader_{name}{sample_labels} {value}")
+
+        metric("attempts_total", "counter", "Download attempts by outcome.",
+               [(labels(outcome=outcome), count) for outcome, count in sorted(self.attempts_by_outcome.items())])
+        metric("bytes_total", "counter", "Bytes received.", [(labels(), self.bytes_total)])
+        metric("host_bytes_total", "counter", "Bytes received per host.",
+               [(labels(host=host), count) for host, count in sorted(self.bytes_by_host.items())])
+        metric("retries_scheduled_total", "counter", "Failed attempts put back on the retry queue.",
+               [(labels(), self.retries_scheduled)])
+        metric("failovers_total", "counter", "Failed attempts continued on another mirror at once.",
+               [(labels(), self.failovers)])
+        metric("backoff_seconds_total", "counter", "Retry backoff scheduled, in seconds.",
+               [(labels(), round(self.backoff_seconds_total, 3))])
+        metric("in_flight", "gauge", "Downloads running.", [(labels(), aggregates["in_flight"])])
+        metric("queue_depth", "gauge", "URLs ready to start.", [(labels(), aggregates["queued"])])
+        metric("retry_waiting", "gauge", "URLs waiting for a retry.", [(labels(), aggregates["retry_waiting"])])
+        metric("throughput_bytes_per_second", "gauge", f"Throughput over the last {self.window_seconds}s.",
+               [(labels(), round(aggregates["bytes_per_second"], 1))])
+        metric("attempt_duration_seconds", "gauge", f"Attempt duration quantiles over the last {self.window_seconds}s.",
+               [(labels(quantile="0.5"), aggregates["duration_p50"]), (labels(quantile="0.95"), aggregates["duration_p95"])])
+        metric("ttfb_seconds", "gauge", f"Time to first byte quantiles over the last {self.window_seconds}s.",
+               [(labels(quantile="0.5"), aggregates["ttfb_p50"]), (labels(quantile="0.95"), aggregates["ttfb_p95"])])
+        return "\n".join(lines) + "\n"
+
+    # ---- output ----
+
+    def start(self):
+        if self.flush_interval_seconds and self._timer is None:
+            self._timer = threading.Thread(target=self._run_timer, name="metrics-flush", daemon=True)
+            self._timer.start()
+
+    def stop(self):
+        """Stop the flush thread, write final aggregates and close the JSONL file"""
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        self.flush()
+        with self._lock:
+            self._jsonl.close()
+
+    def _run_timer(self):
+        while not self._stop.wait(self.flush_interval_seconds):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            try:
+                self._jsonl.flush()
+                aggregates = self._aggregates_locked()
+                if self.summary_path:
+                    atomic_write(self.summary_path, json.dumps(aggregates, indent=1))
+                if self.prometheus_path:
+                    atomic_write(self.prometheus_path, self._prometheus_text_locked(aggregates))
+            except (OSError, ValueError) as e:
+                log_message(f"Warning: could not write metrics: {e}")
+
+
+def metrics_from_params(main_params, backend=None):
+    """Build the recorder from the main_params dictionary assembled in hpc_downloader.py (None if disabled)"""
+    jsonl_path = main_params.get("metrics_jsonl_path")
+    if not jsonl_path:
+        return None
+    return MetricsRecorder(
+        jsonl_path,
+        summary_path=main_params.get("metrics_summary_path"),
+        prometheus_path=main_params.get("metrics_prometheus_path"),
+        window_seconds=main_params.get("metrics_window_seconds", 300),
+        flush_interval_seconds=main_params.get("metrics_flush_interval_seconds", 15),
+        labels=main_params.get("metrics_labels"),
+        backend=backend,
+    )
+
+
+def summarize_attempts(jsonl_paths, out):
+    """Write per-host throughput, TTFB and retry statistics from attempt JSONL files to the open file out"""
+    hosts = collections.defaultdict(lambda: {"attempts": 0, "failures": 0, "bytes": 0, "elapsed": 0.0, "ttfb": [], "retries": 0,
+                                       "failovers": 0})
+    first = last = None
+    for path in jsonl_paths:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # Torn last line of a killed job
+                stats = hosts[record["host"]]
+                stats["attempts"] += 1
+                stats["failures"] += 0 if record["success"] else 1
+                stats["bytes"] += record["bytes"]
+                stats["elapsed"] += record["elapsed"]
+                if record.get("failover"):
+                    stats["failovers"] += 1
+                elif record["retry"]:
+                    stats["retries"] += 1
+                if record["ttfb"] is not None:
+                    stats["ttfb"].append(record["ttfb"])
+                first = record["ts"] if first is None else min(first, record["ts"])
+                last = record["ts"] if last is None else max(last, record["ts"])
+
+    out.write(f"--- Attempt Metrics ({', '.join(jsonl_paths)}) ---\n")
+    if first is not None:
+        out.write(f"Span: {last - first:.0f}s\n")
+    for host, stats in sorted(hosts.items(), key=lambda item: -item[1]["bytes"]):
+        ttfb = sorted(stats["ttfb"])
+        rate = stats["bytes"] / stats["elapsed"] if stats["elapsed"] else 0.0
+        p50, p95 = percentile(ttfb, 0.5), percentile(ttfb, 0.95)
+        out.write(f"  {host}: {stats['attempts']} attempts ({stats['failures']} failed, {stats['retries']} retries, "
+                  f"{stats['failovers']} failovers), "
+                  f"{stats['bytes'] / (1024*1024):.2f} MB, {rate / (1024*1024):.2f} MB/s per stream, "
+                  f"TTFB p50 {p50 if p50 is not None else 0:.3f}s p95 {p95 if p95 is not None else 0:.3f}s\n")
+    out.write("--- End Attempt Metrics ---\n")
+
+
+if __name__ == "__main__":
+    # python -m source.metrics <download_dir>/metrics/attempts*.jsonl
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python -m source.metrics <attempts.jsonl> [more.jsonl ...]")
+    summarize_attempts(sys.argv[1:], sys.stdout)
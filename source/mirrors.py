@@ -0,0 +1,165 @@
+import time
+import threading
+import collections
+import concurrent.futures
+from urllib.parse import urlparse
+
+# Weight of the newest measurement in a host's moving averages
+_EWMA_ALPHA = 0.3
+# Transfers smaller than this say more about latency than about throughput
+_MIN_THROUGHPUT_SAMPLE_BYTES = 1024 * 1024
+# Size assumed when ranking mirrors for a file of unknown size
+_DEFAULT_SIZE_BYTES = 64 * 1024 * 1024
+_MAX_COOLDOWN_SECONDS = 600
+# Mirror probes kept for range_sources at most; the oldest are dropped first
+_MAX_CACHED_PROBES = 10000
+
+
+def source_key(url):
+    """Mirrors are told apart by host and port"""
+    return urlparse(url).netloc.lower()
+
+
+class _HostStats:
+    def __init__(self):
+        self.latency = None     # seconds to the first byte (or to a probe's answer)
+        self.throughput = None  # bytes per second once the transfer is running
+        self.failures = 0       # consecutive failed attempts
+        self.cooldown_until = 0.0
+
+
+class MirrorRanker:
+    """
+    Ranks the sources of a download (its URL and the mirrors listed with it in
+    the links file) by the expected time to fetch the file from each host:
+    latency plus size over throughput, both moving averages of what was
+    measured on earlier attempts. Hosts nothing is known about yet are probed
+    once for their latency and assumed as fast as the best known host, so
+    each one gets tried. A host that fails is ranked last for a cooldown that
+    doubles with each consecutive failure. Probes of mirror URLs are reused
+    for probe_max_age_seconds, and only the most recent _MAX_CACHED_PROBES are
+    kept.
+    """
+
+    def __init__(self, transport, options, failure_cooldown_seconds=60, probe_hosts=True, probe_max_age_seconds=86400):
+        self.transport = transport
+        self.options = options
+        self.failure_cooldown_seconds = failure_cooldown_seconds
+        self.probe_hosts = probe_hosts
+        self.probe_max_age_seconds = probe_max_age_seconds
+        self._hosts = {}
+        self._probes = collections.OrderedDict() # url -> (probed at, probe result), oldest first
+        self._lock = threading.Lock()
+
+    def _stats(self, host):
+        # Called with self._lock held
+        stats = self._hosts.get(host)
+        if stats is None:
+            stats = self._hosts[host] = _HostStats()
+        return stats
+
+    def record(self, url, attempt):
+        """Learn from one transport attempt result (see transport.attempt_result) fetched from url"""
+        with self._lock:
+            stats = self._stats(source_key(url))
+            if attempt["returncode"] != 0:
+                stats.failures += 1
+                cooldown = min(_MAX_COOLDOWN_SECONDS, self.failure_cooldown_seconds * 2 ** (stats.failures - 1))
+                stats.cooldown_until = time.time() + cooldown
+                return
+            stats.failures = 0
+            stats.cooldown_until = 0.0
+            latency = attempt.get("ttfb") or attempt.get("connect_time")
+            if latency:
+                stats.latency = latency if stats.latency is None else _ewma(stats.latency, latency)
+            transfer_time = (attempt.get("elapsed") or 0) - (attempt.get("ttfb") or 0)
+            if (attempt.get("bytes") or 0) >= _MIN_THROUGHPUT_SAMPLE_BYTES and transfer_time > 0:
+                throughput = attempt["bytes"] / transfer_time
+                stats.throughput = throughput if stats.throughput is None else _ewma(stats.throughput, throughput)
+
+    def _probe(self, url):
+        started = time.time()
+        probe = self.transport.probe(url, self.options)
+        with self._lock:
+            self._probes.pop(url, None)
+            self._probes[url] = (time.time(), probe)
+            self._expire_probes()
+            stats = self._stats(source_key(url))
+            if probe["returncode"] == 0:
+                if stats.latency is None:
+                    stats.latency = time.time() - started
+            else:
+                stats.failures += 1
+                stats.cooldown_until = time.time() + self.failure_cooldown_seconds
+        return probe
+
+    def _expire_probes(self):
+        # Called with self._lock held; entries are in the order they were probed
+        cutoff = time.time() - self.probe_max_age_seconds
+        while self._probes and (len(self._probes) > _MAX_CACHED_PROBES or next(iter(self._probes.values()))[0] < cutoff):
+            self._probes.popitem(last=False)
+
+    def _probe_all(self, urls):
+        if len(urls) == 1:
+            return [self._probe(urls[0])]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            return list(executor.map(self._probe, urls))
+
+    def rank(self, urls, size=None):
+        """urls ordered from the expected fastest to the slowest source"""
+        if self.probe_hosts:
+            with self._lock:
+                unmeasured = {}
+                for url in urls:
+                    stats = self._hosts.get(source_key(url))
+                    if stats is None or (stats.latency is None and not stats.failures):
+                        unmeasured.setdefault(source_key(url), url)
+            if unmeasured:
+                self._probe_all(list(unmeasured.values()))
+        size = size or _DEFAULT_SIZE_BYTES
+        now = time.time()
+        with self._lock:
+            known = [stats.throughput for stats in self._hosts.values() if stats.throughput]
+            best_throughput = max(known) if known else None
+
+            def key(item):
+                position, url = item
+                stats = self._hosts.get(source_key(url)) or _HostStats()
+                throughput = stats.throughput or best_throughput
+                seconds = (stats.latency or 0.0) + (size / throughput if throughput else 0.0)
+                return (stats.cooldown_until > now, seconds, position)
+            return [url for _, url in sorted(enumerate(urls), key=key)]
+
+    def range_sources(self, urls, size):
+        """
+        The urls (in the given order) that can serve byte ranges of this
+        object: the first one, which was checked already, and mirrors whose
+        probe shows range support and the same size.
+        """
+        mirrors = urls[1:]
+        with self._lock:
+            self._expire_probes()
+            # Taken now, since another thread may evict them while the rest are probed
+            probes = {url: self._probes[url][1] for url in mirrors if url in self._probes}
+        to_probe = [url for url in mirrors if url not in probes]
+        if to_probe:
+            probes.update(zip(to_probe, self._probe_all(to_probe)))
+        usable = [url for url in mirrors if probes[url]["returncode"] == 0 and probes[url]["accept_ranges"]
+                  and probes[url]["content_length"] == size]
+        return urls[:1] + usable
+
+    def describe(self, url):
+        with self._lock:
+            stats = self._hosts.get(source_key(url))
+            if stats is None:
+                return source_key(url)
+            parts = []
+            if stats.latency is not None:
+                parts.append(f"{stats.latency * 1000:.0f} ms")
+            if stats.throughput:
+                parts.append(f"{stats.throughput / (1024*1024):.1f} MB/s")
+            return f"{source_key(url)} ({', '.join(parts)})" if parts else source_key(url)
+
+
+def _ewma(old, new):
+    return (1 - _EWMA_ALPHA) * old + _EWMA_ALPHA * new
@@ -0,0 +1,215 @@
+import os
+import bz2
+import gzip
+import lzma
+import time
+import shlex
+import shutil
+import tarfile
+import zipfile
+import importlib
+import threading
+import subprocess
+import multiprocessing
+import concurrent.futures
+from .utils import log_message
+
+# Processing status values stored in the journal's processing_status column
+PROCESSING_DONE = "DONE"
+PROCESSING_FAILED = "FAILED"
+
+_TAR_SUFFIXES = (".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz", ".tar")
+_COMPRESSED_SUFFIXES = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+def _strip_suffix(name, suffixes):
+    for suffix in suffixes:
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)]
+    return None
+
+
+def _check_members(names, target, what="Archive member"):
+    """Refuse archives with members that would land outside target (absolute paths, "..")"""
+    root = os.path.realpath(target)
+    for name in names:
+        path = os.path.realpath(os.path.join(target, name))
+        if path != root and not path.startswith(root + os.sep):
+            raise ValueError(f"{what} '{name}' would land outside {target}")
+
+
+def _extract_into(target, extract):
+    """Run extract(tmp_dir) and move the result to target, so a target that exists is complete"""
+    tmp_dir = f"{target}.partial"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir) # Left by an interrupted run
+    os.makedirs(tmp_dir)
+    try:
+        count = extract(tmp_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.replace(tmp_dir, target)
+    return count
+
+
+def extract_file(path, output_dir):
+    """
+    Unpack the download at path into output_dir: tar archives (optionally
+    gzip/bzip2/xz compressed) and zip files into a directory named after the
+    archive, single .gz/.bz2/.xz files into the decompressed file. Other files
+    are left alone. Returns a short description of what was done.
+    """
+    name = os.path.basename(path)
+    os.makedirs(output_dir, exist_ok=True)
+    stem = _strip_suffix(name, _TAR_SUFFIXES)
+    if stem is not None:
+        def extract(tmp_dir):
+            with tarfile.open(path, 'r:*') as archive:
+                members = archive.getmembers()
+                _check_members((m.name for m in members), tmp_dir)
+                # Nor may links point outside, which older Pythons' extractall() has no filter for
+                _check_members((os.path.join(os.path.dirname(m.name), m.linkname) if m.issym() else m.linkname
+                                for m in members if m.issym() or m.islnk()), tmp_dir, "Link target")
+                if hasattr(tarfile, "data_filter"):
+                    archive.extractall(tmp_dir, filter="data")
+                else:
+                    archive.extractall(tmp_dir)
+                return len(members)
+        target = os.path.join(output_dir, stem)
+        return f"extracted {_extract_into(target, extract)} members to {target}"
+    stem = _strip_suffix(name, (".zip",))
+    if stem is not None:
+        def extract(tmp_dir):
+            with zipfile.ZipFile(path) as archive:
+                names = archive.namelist()
+                _check_members(names, tmp_dir)
+                archive.extractall(tmp_dir)
+                return len(names)
+        target = os.path.join(output_dir, stem)
+        return f"extracted {_extract_into(target, extract)} members to {target}"
+    suffix = os.path.splitext(name)[1].lower()
+    if suffix in _COMPRESSED_SUFFIXES:
+        target = os.path.join(output_dir, name[:-len(suffix)])
+        tmp_path = f"{target}.partial"
+        with _COMPRESSED_SUFFIXES[suffix](path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(tmp_path, target)
+        return f"decompressed to {target}"
+    return "nothing to extract"
+
+
+def run_hook(step, path, url):
+    """
+    Run a user step on one file: "python:package.module:function" calls
+    function(path, url); "shell:<command>" runs the command with {path} and
+    {url} replaced by the quoted values and fails on a non-zero exit code.
+    """
+    kind, _, spec = step.partition(":")
+    if kind == "python":
+        module_name, _, function_name = spec.rpartition(":")
+        function = getattr(importlib.import_module(module_name), function_name)
+        result = function(path, url)
+        return f"{spec} returned {result!r}" if result is not None else f"ran {spec}"
+    if kind == "shell":
+        command = spec.replace("{path}", shlex.quote(path)).replace("{url}", shlex.quote(url))
+        process = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 universal_newlines=True)
+        if process.returncode != 0:
+            raise RuntimeError(f"'{command}' exited with {process.returncode}: {process.stdout.strip()[-500:]}")
+        return f"ran '{command}'"
+    raise ValueError(f"Unknown post-processing step '{step}' (expected 'extract', 'python:...' or 'shell:...')")
+
+
+def _process_job(path, url, steps, output_dir):
+    # Runs in a worker process
+    try:
+        done = []
+        for step in steps:
+            if step == "extract":
+                done.append(extract_file(path, output_dir))
+            else:
+                done.append(run_hook(step, path, url))
+        return "; ".join(done), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+class PostProcessor:
+    """
+    Runs the configured steps on completed downloads in a process pool of its
+    own, while the downloads go on. submit() is called for every URL as it
+    completes (and for URLs already completed by an earlier run); URLs whose
+    processing_status in the journal is DONE are not processed again, and a
+    new download of a URL resets its status.
+    """
+
+    def __init__(self, steps, state_store, output_dir, processes=4):
+        self.steps = list(steps)
+        self.state_store = state_store
+        self.output_dir = output_dir
+        self.processes = max(1, processes)
+        # Workers start while download threads are running; a fork server avoids forking a threaded process
+        context = multiprocessing.get_context("forkserver") if "forkserver" in multiprocessing.get_all_start_methods() else None
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.processed = 0
+        self.failed = 0
+
+    def submit(self, url, path):
+        record = self.state_store.get(url)
+        if record and record["processing_status"] == PROCESSING_DONE:
+            return
+        with self._lock:
+            if url in self._pending:
+                return
+            self._pending.add(url)
+        future = self._executor.submit(_process_job, path, url, self.steps, self.output_dir)
+        future.add_done_callback(lambda f: self._done(url, path, f))
+
+    def _done(self, url, path, future):
+        if future.cancelled():
+            with self._lock:
+                self._pending.discard(url)
+            return # Left for the next run
+        try:
+            summary, error = future.result()
+        except Exception as e: # e.g. a worker process died
+            summary, error = None, f"{type(e).__name__}: {e}"
+        with self._lock:
+            self._pending.discard(url)
+            if error:
+                self.failed += 1
+            else:
+                self.processed += 1
+        if error:
+            log_message(f"[PROCESSING FAILED] {os.path.basename(path)} (URL: {url}): {error}")
+            self.state_store.update(url, processing_status=PROCESSING_FAILED, processing_error=error, processed_at=time.time())
+        else:
+            log_message(f"[PROCESSED] {os.path.basename(path)}: {summary}")
+            self.state_store.update(url, processing_status=PROCESSING_DONE, processing_error=None, processed_at=time.time())
+
+    def close(self, cancel=False):
+        """Wait for all submitted files to be processed; with cancel, only for those already being processed"""
+        with self._lock:
+            waiting = len(self._pending)
+        if waiting:
+            log_message(f"[PROCESSING] Waiting for {waiting} files still being processed..."
+                        + (" Files not started yet are left for the next run." if cancel else ""))
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+        log_message(f"[PROCESSING] {self.processed} files processed, {self.failed} failed.")
+
+
+def postprocessor_from_params(main_params, state_store, download_dir):
+    """Build the post-processor from the main_params dictionary assembled in hpc_downloader.py (None if no steps are set)"""
+    steps = main_params.get("postprocess_steps")
+    if not steps:
+        return None
+    output_dir = main_params.get("postprocess_output_dir") or os.path.join(download_dir, "extracted")
+    processor = PostProcessor(steps, state_store, output_dir, main_params.get("postprocess_processes", 4))
+    log_message(f"[PROCESSING] Steps {', '.join(processor.steps)} run on completed downloads "
+                f"with {processor.processes} processes.")
+    return processor
@@ -0,0 +1,159 @@
+import time
+import heapq
+import collections
+import concurrent.futures
+from .utils import log_message, format_duration
+from .state import STATUS_COMPLETED
+from .scheduler import url_host
+
+# Orders accepted by order_urls / the download_order setting
+DOWNLOAD_ORDERS = ("file", "largest_first", "host_balanced")
+
+
+def cached_probe(state_store, url, max_age_seconds=None):
+    """
+    The probe result cached in the journal for url (see transport.probe_result),
+    or None if url was never probed or its probe is older than max_age_seconds.
+    """
+    record = state_store.get(url)
+    if not record or not record["probed_at"]:
+        return None
+    if max_age_seconds is not None and time.time() - record["probed_at"] > max_age_seconds:
+        return None
+    return {"returncode": 0, "http_status": None, "content_length": record["content_length"],
+            "accept_ranges": bool(record["accept_ranges"]), "etag": record["etag"],
+            "last_modified": record["last_modified"], "effective_url": url, "error": None}
+
+
+def store_probe(state_store, url, probe):
+    """Cache a successful probe's size, range support and validators in the journal"""
+    state_store.update(url, content_length=probe["content_length"], accept_ranges=1 if probe["accept_ranges"] else 0,
+                       etag=probe["etag"], last_modified=probe["last_modified"], probed_at=time.time())
+
+
+def probe_urls(urls, state_store, transport, options, concurrency=32, max_age_seconds=86400):
+    """
+    Probe every URL that is not COMPLETED and has no recent cached probe, with
+    concurrency requests in flight, and cache the results in the journal.
+    Failed probes are logged in the summary only; those URLs simply have no
+    known size. Returns the number of URLs probed successfully.
+    """
+    to_probe = [url for url in urls if state_store.get_status(url) != STATUS_COMPLETED
+                and cached_probe(state_store, url, max_age_seconds) is None]
+    if not to_probe:
+        return 0
+    log_message(f"[PROBE] Probing {len(to_probe)} URLs with {concurrency} parallel requests...")
+    started = time.time()
+    probed = 0
+    errors = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        # Submit in bounded windows so millions of URLs don't become millions of futures
+        pending = set()
+        url_iter = iter(to_probe)
+        while True:
+            for url in url_iter:
+                pending.add(executor.submit(lambda u: (u, transport.probe(u, options)), url))
+                if len(pending) >= concurrency * 4:
+                    break
+            if not pending:
+                break
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    url, probe = future.result()
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                    continue
+                if probe["returncode"] == 0:
+                    store_probe(state_store, url, probe)
+                    probed += 1
+                else:
+                    errors[f"HTTP {probe['http_status']}" if probe["http_status"] else f"exit {probe['returncode']}"] += 1
+    state_store.flush()
+    failed = sum(errors.values())
+    log_message(f"[PROBE] {probed} URLs probed in {time.time() - started:.1f}s"
+                + (f", {failed} failed ({', '.join(f'{k}: {v}' for k, v in errors.most_common(5))})" if failed else "."))
+    return probed
+
+
+def _remaining_bytes(state_store, urls):
+    """url -> bytes still to download (None if the size is unknown); completed URLs are left out"""
+    remaining = {}
+    for url in urls:
+        record = state_store.get(url)
+        if record and record["status"] == STATUS_COMPLETED:
+            continue
+        size = record["content_length"] if record else None
+        remaining[url] = None if size is None else max(0, size - (record["bytes_done"] or 0))
+    return remaining
+
+
+def order_urls(urls, state_store, order="file"):
+    """
+    Return urls in download order, using the sizes cached by probe_urls:
+    "file" keeps the links file order; "largest_first" starts the biggest
+    downloads first (LPT), so no large file is left to start at the end of the
+    job; "host_balanced" always takes the largest remaining file of the host
+    with the most bytes left, so every host's work ends at about the same time.
+    URLs of unknown size count as the average known size; completed URLs go last.
+    """
+    if order == "file":
+        return list(urls)
+    if order not in DOWNLOAD_ORDERS:
+        raise ValueError(f"Unknown download_order '{order}' (expected one of {', '.join(DOWNLOAD_ORDERS)})")
+    urls = list(urls)
+    remaining = _remaining_bytes(state_store, urls)
+    known = [size for size in remaining.values() if size is not None]
+    default_size = sum(known) // len(known) if known else 0
+    size = {url: default_size if value is None else value for url, value in remaining.items()}
+    completed = [url for url in urls if url not in remaining]
+    by_size = sorted(remaining, key=lambda url: -size[url]) # sorted() is stable, so ties keep file order
+    if order == "largest_first":
+        return by_size + completed
+
+    hosts = collections.OrderedDict()
+    for url in by_size:
+        hosts.setdefault(url_host(url), collections.deque()).append(url)
+    host_bytes = {host: sum(size[url] for url in queue) for host, queue in hosts.items()}
+    heap = [(-host_bytes[host], index, host) for index, host in enumerate(hosts)]
+    heapq.heapify(heap)
+    ordered = []
+    while heap:
+        _, index, host = heapq.heappop(heap)
+        url = hosts[host].popleft()
+        ordered.append(url)
+        host_bytes[host] -= size[url]
+        if hosts[host]:
+            heapq.heappush(heap, (-host_bytes[host], index, host))
+    return ordered + completed
+
+
+def project_eta(urls, state_store, workers, stream_bytes_per_sec):
+    """
+    Projected makespan before any bytes move: the remaining sizes are assigned
+    largest-first to the least loaded of workers parallel streams, each moving
+    stream_bytes_per_sec. Returns a dict with the byte totals and the estimate.
+    """
+    remaining = _remaining_bytes(state_store, urls)
+    known = sorted((size for size in remaining.values() if size is not None), reverse=True)
+    loads = [0] * max(1, workers)
+    for size in known:
+        heapq.heapreplace(loads, loads[0] + size)
+    busiest = max(loads)
+    return {
+        "urls": len(remaining),
+        "unknown_size": len(remaining) - len(known),
+        "bytes": sum(known),
+        "largest_bytes": known[0] if known else 0,
+        "eta_seconds": busiest / stream_bytes_per_sec if stream_bytes_per_sec else None,
+    }
+
+
+def log_projection(projection, workers, stream_bytes_per_sec):
+    gb = 1024 * 1024 * 1024
+    if projection["eta_seconds"] is None:
+        return
+    unknown = f" ({projection['unknown_size']} URLs of unknown size not included)" if projection["unknown_size"] else ""
+    log_message(f"[PROBE] {projection['urls']} URLs, {projection['bytes'] / gb:.2f} GB to download{unknown}. "
+                f"Largest file {projection['largest_bytes'] / gb:.2f} GB. Projected time with {workers} streams at "
+                f"{stream_bytes_per_sec / (1024*1024):.0f} MB/s each: {format_duration(projection['eta_seconds'])}.")
@@ -0,0 +1,175 @@
+import os
+import time
+import tempfile
+import collections
+import concurrent.futures
+from .utils import log_message
+from .state import STATUS_COMPLETED, STATUS_PENDING
+from .probing import store_probe
+from .segmented import segments_file_path
+from .transport import CURL_RANGE_ERROR
+
+# Outcomes of reconcile_partial_downloads
+RECONCILE_COMPLETE = "complete"    # Already whole; marked COMPLETED
+RECONCILE_RESUME = "resume"        # Resumable from its current size
+RECONCILE_TRUNCATED = "truncated"  # Resumable after cutting off a tail that did not match the server
+RECONCILE_RESTART = "restart"      # Deleted; downloaded again from the start
+RECONCILE_UNCHECKED = "unchecked"  # The server could not be asked; left as it was
+
+
+def _validators_changed(record, probe):
+    """True if the object changed since the validators recorded for its partial file"""
+    if not record:
+        return False
+    if record["etag"] and probe["etag"]:
+        return record["etag"] != probe["etag"]
+    if record["last_modified"] and probe["last_modified"]:
+        return record["last_modified"] != probe["last_modified"]
+    return False
+
+
+def _verified_prefix(path, transport, url, options, size, tail_bytes):
+    """
+    Compare the last tail_bytes of the partial file at path (size bytes) with
+    the same range fetched from url. Returns (offset up to which the file is
+    known to match, None) or (None, error) if the range could not be fetched.
+    """
+    start = max(0, size - tail_bytes)
+    length = size - start
+    # fetch_range writes at absolute offsets; the temp file stays sparse below start
+    with tempfile.TemporaryFile() as remote_file:
+        result = transport.fetch_range(url, remote_file.fileno(), start, size - 1, options)
+        if result["returncode"] != 0:
+            return None, result
+        remote = os.pread(remote_file.fileno(), length, start)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        local = f.read(length)
+    if local == remote:
+        return size, None
+    mismatch = next((i for i, (a, b) in enumerate(zip(local, remote)) if a != b), min(len(local), len(remote)))
+    # Only bytes before the first mismatch inside the window are verified
+    return (start + mismatch if mismatch > 0 else 0), None
+
+
+def _list_files(directory):
+    try:
+        return {entry.name: entry for entry in os.scandir(directory) if entry.is_file()}
+    except FileNotFoundError:
+        return {}
+
+
+def reconcile_partial_downloads(state_store, download_dir, urls, filename_for_url, transport, options,
+                                expectations=None, concurrency=32, tail_bytes=64 * 1024, staging_dir=None):
+    """
+    Check the partial files left in download_dir by an interrupted run against
+    the server before anything is downloaded, so a resume never appends to
+    bytes of a different or corrupted object. With staging_dir (see
+    source/staging.py), the "<filename>.part" files there are checked the same
+    way and take precedence, since they are what a staged download resumes.
+
+    Each directory is listed once with os.scandir; every URL not marked
+    COMPLETED whose file is there is probed again (a cached probe describes
+    the object the file was downloaded from, not the current one), with
+    concurrency requests in flight.
+    A file larger than the object or recorded against other validators is
+    deleted and restarts. Otherwise its last tail_bytes are fetched and
+    compared: if they match, the file is resumed from its size, or marked
+    COMPLETED when it is whole (unless an expected digest still has to be
+    checked, or it is staged and still has to be flushed); if only the end differs, it is cut back to the last matching
+    byte; if nothing matches, it restarts. Segmented partials are preallocated,
+    so only their size and validators are checked. Returns a Counter of
+    outcomes (see RECONCILE_*).
+    """
+    expectations = expectations or {}
+    # (directory, suffix of the partial file, staged), the one a download resumes first
+    locations = ([(staging_dir, ".part", True)] if staging_dir else []) + [(download_dir, "", False)]
+    listings = [(directory, suffix, staged, _list_files(directory)) for directory, suffix, staged in locations]
+    candidates = []
+    for url in urls:
+        if state_store.get_status(url) == STATUS_COMPLETED:
+            continue
+        filename = filename_for_url(url)
+        for directory, suffix, staged, entries in listings:
+            entry = entries.get(filename + suffix)
+            if entry is None:
+                continue
+            size = entry.stat().st_size
+            if size > 0:
+                candidates.append((url, filename, entry.path, size, f"{filename}{suffix}.segments" in entries, staged))
+                break
+    if not candidates:
+        return collections.Counter()
+
+    log_message(f"[RECONCILE] Checking {len(candidates)} partial files against the server "
+                f"with {concurrency} parallel requests...")
+    started = time.time()
+
+    def restart(url, path, reason):
+        log_message(f"[RECONCILE] {os.path.basename(path)} (URL: {url}): {reason} Restarting it.")
+        for stale in (path, segments_file_path(path)):
+            if os.path.exists(stale):
+                os.remove(stale)
+        state_store.set_status(url, STATUS_PENDING, bytes_done=0, digest=None, last_error=reason, finished_at=None)
+        return RECONCILE_RESTART, 0
+
+    def reconcile(candidate):
+        try:
+            return _reconcile(*candidate)
+        except OSError as e:
+            log_message(f"[RECONCILE] {candidate[1]} (URL: {candidate[0]}): could not be checked: {e}")
+            return RECONCILE_UNCHECKED, candidate[3]
+
+    def _reconcile(url, filename, path, size, segmented, staged):
+        record = state_store.get(url)
+        probe = transport.probe(url, options)
+        if probe["returncode"] != 0:
+            return RECONCILE_UNCHECKED, size
+        # The resumed download sends these validators with If-Range
+        store_probe(state_store, url, probe)
+        if _validators_changed(record, probe):
+            return restart(url, path, "The object changed upstream since the partial file was written.")
+        remote_size = probe["content_length"]
+        if remote_size is not None and size > remote_size:
+            return restart(url, path, f"Partial file is larger than the object ({size} > {remote_size} bytes).")
+        if segmented:
+            if remote_size is not None and size != remote_size:
+                return restart(url, path, f"Segmented partial was laid out for {size} bytes, the object has {remote_size}.")
+            return RECONCILE_RESUME, size
+        if not probe["accept_ranges"]:
+            return restart(url, path, "Server does not accept byte ranges, so the partial file can't be resumed.")
+        verified, failed = _verified_prefix(path, transport, url, options, size, tail_bytes)
+        if failed is not None:
+            if failed["returncode"] == CURL_RANGE_ERROR:
+                return restart(url, path, "Server ignored the byte range request.")
+            return RECONCILE_UNCHECKED, size
+        if verified == 0:
+            return restart(url, path, "The end of the partial file does not match the object.")
+        if verified < size:
+            log_message(f"[RECONCILE] {filename} (URL: {url}): the last {size - verified} bytes do not match "
+                        f"the object; resuming from byte {verified}.")
+            os.truncate(path, verified)
+            state_store.update(url, bytes_done=verified)
+            return RECONCILE_TRUNCATED, verified
+        expected = expectations.get(url)
+        if size == remote_size and not (expected and expected["digest"]) and not staged:
+            log_message(f"[RECONCILE] {filename} (URL: {url}): already complete.")
+            state_store.set_status(url, STATUS_COMPLETED, filename=filename, bytes_done=size, last_error=None,
+                                   finished_at=time.time())
+            return RECONCILE_COMPLETE, size
+        state_store.update(url, bytes_done=size)
+        return RECONCILE_RESUME, size
+
+    outcomes = collections.Counter()
+    kept_bytes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for outcome, kept in executor.map(reconcile, candidates):
+            outcomes[outcome] += 1
+            kept_bytes += kept
+    state_store.flush()
+    log_message(f"[RECONCILE] {len(candidates)} partial files checked in {time.time() - started:.1f}s: "
+                f"{outcomes[RECONCILE_COMPLETE]} complete, {outcomes[RECONCILE_RESUME]} resumable, "
+                f"{outcomes[RECONCILE_TRUNCATED]} cut back to their last matching byte, "
+                f"{outcomes[RECONCILE_RESTART]} restarting, {outcomes[RECONCILE_UNCHECKED]} could not be checked; "
+                f"{kept_bytes / (1024*1024):.1f} MB kept.")
+    return outcomes
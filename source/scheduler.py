@@ -0,0 +1,219 @@
+import time
+import threading
+import collections
+from urllib.parse import urlparse
+from .utils import log_message
+
+# HTTP statuses that mean "slow down" rather than "this URL is broken"
+THROTTLE_HTTP_STATUSES = {429, 503}
+# Host pause applied on a throttle response that carries no Retry-After header
+DEFAULT_THROTTLE_BACKOFF_SECONDS = 30
+
+
+def url_host(url):
+    return (urlparse(url).hostname or "").lower()
+
+
+class _HostState:
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+
+
+class AdaptiveConcurrencyController:
+    """
+    Decides how many downloads may run at once, overall and per host.
+
+    Per host (AIMD): every successful attempt adds 1/limit to the host's limit
+    (about +1 per round of completions) up to per_host_max; a 429/503 halves it
+    and pauses new downloads from that host until its Retry-After has passed.
+
+    Overall: every adjust_interval_seconds the aggregate throughput and error
+    rate of the last interval are compared with the previous one. A high error
+    rate (network failures; throttle responses only affect their host) cuts
+    the total limit by a quarter; otherwise the limit keeps moving in
+    the direction that last improved throughput, by one slot at a time, within
+    [min_total, max_total].
+
+    With adaptive=False the total stays at initial_total and hosts are unlimited,
+    which is the plain fixed-size worker pool.
+    """
+
+    def __init__(self, initial_total, min_total=1, max_total=16, per_host_initial=2, per_host_max=8,
+                 adjust_interval_seconds=30, error_rate_threshold=0.2, adaptive=True):
+        self.adaptive = adaptive
+        self.min_total = max(1, min(min_total, initial_total)) if adaptive else initial_total
+        self.max_total = max(max_total, initial_total) if adaptive else initial_total
+        self.total_limit = float(initial_total)
+        self.per_host_initial = per_host_initial if adaptive else initial_total
+        self.per_host_max = per_host_max if adaptive else initial_total
+        self.adjust_interval_seconds = adjust_interval_seconds
+        self.error_rate_threshold = error_rate_threshold
+
+        self.in_flight = 0
+        self._hosts = collections.defaultdict(lambda: _HostState(self.per_host_initial))
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._window_attempts = 0
+        self._window_errors = 0
+        self._last_throughput = None
+        self._direction = 1 # +1: last change was an increase, -1: a decrease
+
+    # ---- slots ----
+
+    def try_acquire(self, host):
+        """Take a download slot for host if both the total and the host limit allow it"""
+        with self._lock:
+            self._maybe_adjust()
+            state = self._hosts[host]
+            if self.in_flight >= int(self.total_limit):
+                return False
+            if state.in_flight >= max(1, int(state.limit)) or time.time() < state.blocked_until:
+                return False
+            self.in_flight += 1
+            state.in_flight += 1
+            return True
+
+    def release(self, host):
+        with self._lock:
+            self.in_flight -= 1
+            self._hosts[host].in_flight -= 1
+
+    def host_available(self, host):
+        """True if host is neither at its limit nor paused by a throttle response"""
+        with self._lock:
+            state = self._hosts[host]
+            return state.in_flight < max(1, int(state.limit)) and time.time() >= state.blocked_until
+
+    def has_capacity(self):
+        with self._lock:
+            return self.in_flight < int(self.total_limit)
+
+    def host_backoff_remaining(self, host):
+        """Seconds until host accepts new requests again (0 if it is not paused)"""
+        with self._lock:
+            return max(0.0, self._hosts[host].blocked_until - time.time())
+
+    def next_unblock_in(self):
+        """Seconds until the earliest paused host is released, or None if no host is paused"""
+        with self._lock:
+            now = time.time()
+            waits = [s.blocked_until - now for s in self._hosts.values() if s.blocked_until > now]
+            return min(waits) if waits else None
+
+    # ---- feedback ----
+
+    def record_attempt(self, host, attempt):
+        """Feed one transport attempt result (see transport.attempt_result) back into the limits"""
+        with self._lock:
+            self._window_attempts += 1
+            self._window_bytes += attempt.get("bytes") or 0
+            if not self.adaptive:
+                if attempt.get("http_status") in THROTTLE_HTTP_STATUSES and attempt.get("retry_after"):
+                    state = self._hosts[host]
+                    state.blocked_until = max(state.blocked_until, time.time() + attempt["retry_after"])
+                return
+            state = self._hosts[host]
+            if attempt.get("returncode") == 0:
+                state.limit = min(self.per_host_max, state.limit + 1.0 / max(state.limit, 1.0))
+                return
+            if attempt.get("http_status") not in THROTTLE_HTTP_STATUSES:
+                # Throttling is one host's policy and is handled by that host's limit;
+                # other failures (timeouts, resets) count against the total
+                self._window_errors += 1
+                return
+            state.limit = max(1.0, state.limit / 2)
+            backoff = attempt.get("retry_after")
+            if backoff is None:
+                backoff = DEFAULT_THROTTLE_BACKOFF_SECONDS
+            state.blocked_until = max(state.blocked_until, time.time() + backoff)
+            log_message(f"[THROTTLED] {host}: HTTP {attempt['http_status']}, host limit now {int(state.limit)}, "
+                        f"pausing new downloads for {backoff:.0f}s.")
+
+    def _maybe_adjust(self):
+        # Called with self._lock held
+        now = time.time()
+        elapsed = now - self._window_start
+        if not self.adaptive or elapsed < self.adjust_interval_seconds:
+            return
+        throughput = self._window_bytes / elapsed
+        error_rate = self._window_errors / self._window_attempts if self._window_attempts else 0.0
+        old_limit = int(self.total_limit)
+
+        if self._window_attempts and error_rate > self.error_rate_threshold:
+            self.total_limit = max(self.min_total, self.total_limit * 0.75)
+            self._direction = -1
+        elif self.in_flight >= old_limit:
+            # Only adjust while the limit is actually the bottleneck
+            if self._last_throughput is not None and throughput < self._last_throughput * 0.95:
+                self._direction = -self._direction # The last move made things worse; reverse it
+            self.total_limit = min(self.max_total, max(self.min_total, self.total_limit + self._direction))
+
+        if int(self.total_limit) != old_limit:
+            log_message(f"[CONCURRENCY] Total limit {old_limit} -> {int(self.total_limit)} "
+                        f"(throughput {throughput / (1024*1024):.2f} MB/s, error rate {error_rate:.0%}).")
+        self._last_throughput = throughput
+        self._window_start = now
+        self._window_bytes = self._window_attempts = self._window_errors = 0
+
+
+def controller_from_params(main_params):
+    """Build the controller from the main_params dictionary assembled in hpc_downloader.py"""
+    return AdaptiveConcurrencyController(
+        initial_total=main_params.get("max_workers", 3),
+        min_total=main_params.get("concurrency_min", 1),
+        max_total=main_params.get("concurrency_max", 16),
+        per_host_initial=main_params.get("per_host_initial_concurrency", 2),
+        per_host_max=main_params.get("per_host_max_concurrency", 8),
+        adjust_interval_seconds=main_params.get("concurrency_adjust_interval_seconds", 30),
+        error_rate_threshold=main_params.get("concurrency_error_rate_threshold", 0.2),
+        adaptive=main_params.get("adaptive_concurrency", False),
+    )
+
+
+class RetryPolicy:
+    """
+    Escalating retry schedule for one URL.
+    stages is a list of dicts with "name", "label" (log tag), "max_retries",
+    "initial_delay_seconds" and "options" (transport options for attempts in
+    that stage). Each stage allows max_retries further attempts with
+    exponential backoff (max 5 minutes); when they are used up the URL moves
+    on to the next stage, and after the last one it has failed for good.
+    """
+
+    MAX_DELAY_SECONDS = 300
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def new_state(self):
+        return {"stage": 0, "retries": 0, "delay": self.stages[0]["initial_delay_seconds"]}
+
+    def stage(self, state):
+        return self.stages[state["stage"]]
+
+    def options(self, state):
+        return self.stages[state["stage"]]["options"]
+
+    def total_retries(self):
+        return sum(stage["max_retries"] for stage in self.stages)
+
+    def next_delay(self, state):
+        """
+        Advance state after a failed attempt. Returns the number of seconds to
+        wait before the next attempt, or None when every stage is exhausted.
+        """
+        if state["retries"] >= self.stages[state["stage"]]["max_retries"]:
+            if state["stage"] + 1 >= len(self.stages):
+                return None
+            state["stage"] += 1
+            state["retries"] = 0
+            state["delay"] = self.stages[state["stage"]]["initial_delay_seconds"]
+            if self.stages[state["stage"]]["max_retries"] <= 0:
+                return self.next_delay(state)
+        state["retries"] += 1
+        delay = state["delay"]
+        state["delay"] = min(delay * 2, self.MAX_DELAY_SECONDS)
+        return delay
@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import threading
+import concurrent.futures
+from .utils import log_message
+from .transport import attempt_result, CURL_OK, CURL_PARTIAL_FILE
+from .checksums import new_hasher, READ_CHUNK_SIZE
+
+# Segment progress is saved to the sidecar at most this often per file
+PROGRESS_SAVE_INTERVAL_SECONDS = 5
+
+
+def segments_file_path(output_path):
+    """Sidecar holding per-segment progress for a segmented download of output_path"""
+    return output_path + ".segments"
+
+
+def segmented_bytes_done(output_path):
+    """Bytes of a segmented download of output_path already on disk, from its sidecar (None without one)"""
+    try:
+        with open(segments_file_path(output_path), 'r') as f:
+            return sum(segment[2] for segment in json.load(f)["segments"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def plan_segments(total_size, num_segments):
+    """Split [0, total_size) into num_segments contiguous [start, end] ranges (end inclusive)"""
+    num_segments = max(1, min(num_segments, total_size))
+    base = total_size // num_segments
+    segments = []
+    start = 0
+    for i in range(num_segments):
+        end = total_size - 1 if i == num_segments - 1 else start + base - 1
+        segments.append([start, end, 0]) # start, end, bytes done
+        start = end + 1
+    return segments
+
+
+def _load_progress(output_path, url, total_size, num_segments):
+    """
+    Return the segment list to resume from.
+    Reuses the sidecar when it matches this URL and size. A plain partial file left
+    by a single-stream (-C -) attempt is contiguous from offset 0, so it is kept
+    and credited to the leading segments instead of being thrown away.
+    """
+    sidecar = segments_file_path(output_path)
+    if os.path.exists(sidecar):
+        try:
+            with open(sidecar, 'r') as f:
+                saved = json.load(f)
+            if saved.get("url") == url and saved.get("size") == total_size and os.path.exists(output_path):
+                return saved["segments"]
+        except (OSError, ValueError, KeyError) as e:
+            log_message(f"[SEGMENTS] Ignoring unreadable progress file {sidecar}: {e}")
+        # Layout is stale; the preallocated file contents can't be trusted
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    segments = plan_segments(total_size, num_segments)
+    if os.path.exists(output_path):
+        existing = min(os.path.getsize(output_path), total_size)
+        for segment in segments:
+            segment[2] = max(0, min(existing - segment[0], segment[1] - segment[0] + 1))
+    return segments
+
+
+def _save_progress(output_path, url, total_size, segments):
+    sidecar = segments_file_path(output_path)
+    tmp_path = sidecar + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"url": url, "size": total_size, "segments": segments}, f)
+    os.replace(tmp_path, sidecar)
+
+
+class _PrefixHasher:
+    """
+    Digest of a segmented download, taken over the contiguous prefix of the
+    file as it grows. Bytes arriving at the hashed offset are hashed from
+    memory; a range that arrived out of order is read back from fd once the
+    prefix reaches it. So the file is never read a second time as a whole,
+    only the ranges the leading segment had not covered yet.
+    """
+
+    def __init__(self, algorithm, fd, segments):
+        self._hasher = new_hasher(algorithm)
+        self._fd = fd
+        self._segments = segments # Shared with the segment threads; bytes done only grow
+        self._lock = threading.Lock()
+        self.offset = 0
+        with self._lock:
+            self._catch_up() # Bytes already on disk from an earlier attempt
+
+    def update(self, offset, chunk):
+        """chunk was written at offset (and counted in its segment's bytes done)"""
+        with self._lock:
+            if offset == self.offset:
+                self._hasher.update(chunk)
+                self.offset += len(chunk)
+            self._catch_up()
+
+    def _catch_up(self):
+        # Called with self._lock held
+        for start, end, done in self._segments:
+            if self.offset > end:
+                continue
+            available = start + done
+            while self.offset < available:
+                data = os.pread(self._fd, min(READ_CHUNK_SIZE, available - self.offset), self.offset)
+                if not data:
+                    return
+                self._hasher.update(data)
+                self.offset += len(data)
+            if self.offset <= end:
+                return # The prefix ends inside this segment
+
+    def hexdigest(self, total_size):
+        """Digest of the whole file, or None if not all of its total_size bytes are there"""
+        with self._lock:
+            self._catch_up()
+            return self._hasher.hexdigest() if self.offset == total_size else None
+
+
+def _preallocate(fd, total_size):
+    """Reserve the full file size up front so segments can be written in place"""
+    try:
+        os.posix_fallocate(fd, 0, total_size)
+    except (AttributeError, OSError):
+        # Not supported on this filesystem (or platform); a sparse file works just as well
+        os.ftruncate(fd, total_size)
+
+
+def download_segmented(url, output_path, label, transport, options, total_size,
+                       segments_per_file, segment_max_retries, segment_retry_delay_seconds,
+                       sources=None, on_result=None):
+    """
+    Download url into output_path as parallel byte ranges.
+    The output file is preallocated and every range is written at its own offset,
+    so no merge pass is needed. Each segment retries and resumes independently;
+    progress survives restarts through the .segments sidecar file.
+    sources are URLs of the same object on several mirrors (url if not given):
+    segments are spread over them, and a failed segment moves on to the next
+    mirror at once, waiting only after every mirror has failed it.
+    on_result(source, result) is called after every range request.
+    Returns an attempt result dictionary like transport.fetch.
+    """
+    start_time = time.time()
+    segments = _load_progress(output_path, url, total_size, segments_per_file)
+    remaining = sum(s[1] - s[0] + 1 - s[2] for s in segments)
+    log_message(f"[SEGMENTED] {label}: {len(segments)} segments over {total_size / (1024*1024):.2f} MB, "
+                f"{remaining / (1024*1024):.2f} MB remaining.")
+
+    fd = os.open(output_path, os.O_RDWR | os.O_CREAT, 0o644)
+    progress_lock = threading.Lock()
+    last_save = [time.time()]
+    bytes_this_attempt = [0]
+
+    try:
+        if os.fstat(fd).st_size < total_size:
+            _preallocate(fd, total_size)
+        _save_progress(output_path, url, total_size, segments)
+        digest_algorithm = options.get("digest_algorithm")
+        hasher = _PrefixHasher(digest_algorithm, fd, segments) if digest_algorithm else None
+
+        sources_list = list(sources) if sources else [url]
+
+        def run_segment(index):
+            segment = segments[index]
+            current = index % len(sources_list)
+            failovers = 0 # mirrors tried since the last wait
+
+            def on_progress(n, chunk):
+                with progress_lock:
+                    offset = segment[0] + segment[2]
+                    segment[2] += n
+                    bytes_this_attempt[0] += n
+                    if time.time() - last_save[0] >= PROGRESS_SAVE_INTERVAL_SECONDS:
+                        _save_progress(output_path, url, total_size, segments)
+                        last_save[0] = time.time()
+                if hasher is not None:
+                    hasher.update(offset, chunk)
+
+            retries = 0
+            delay = segment_retry_delay_seconds
+            result = attempt_result(CURL_OK)
+            while segment[0] + segment[2] <= segment[1]:
+                if retries > 0 and failovers == 0:
+                    log_message(f"[SEGMENT RETRY {retries}/{segment_max_retries}] {label} segment {index} "
+                                f"from byte {segment[0] + segment[2]}, waiting {delay}s.")
+                    time.sleep(delay)
+                    delay = min(delay * 2, 60)
+                source = sources_list[current]
+                result = transport.fetch_range(source, fd, segment[0] + segment[2], segment[1], options, on_progress)
+                if on_result:
+                    on_result(source, result)
+                if result["returncode"] == CURL_OK and segment[0] + segment[2] > segment[1]:
+                    break
+                if getattr(transport, "aborted", False):
+                    break # The job is ending; the sidecar keeps where this segment got to
+                if failovers < len(sources_list) - 1:
+                    failovers += 1
+                    current = (current + 1) % len(sources_list)
+                    log_message(f"[SEGMENT FAILOVER] {label} segment {index}: {result['error']}; "
+                                f"continuing from mirror {sources_list[current]}.")
+                    continue
+                failovers = 0
+                retries += 1
+                if retries > segment_max_retries:
+                    break
+            return result
+
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            futures = [executor.submit(run_segment, i) for i in range(len(segments))
+                       if segments[i][0] + segments[i][2] <= segments[i][1]]
+            for future in concurrent.futures.as_completed(futures):
+                results.append(future.result())
+        os.fsync(fd)
+        digest = hasher.hexdigest(total_size) if hasher is not None else None
+    finally:
+        os.close(fd)
+        with progress_lock:
+            if os.path.exists(output_path):
+                _save_progress(output_path, url, total_size, segments)
+
+    elapsed = time.time() - start_time
+    failed = [r for r in results if r["returncode"] != CURL_OK]
+    incomplete = [i for i, s in enumerate(segments) if s[0] + s[2] <= s[1]]
+    if incomplete:
+        first_error = failed[0] if failed else attempt_result(CURL_PARTIAL_FILE, error="Segments incomplete")
+        return attempt_result(first_error["returncode"], first_error.get("http_status"), bytes_this_attempt[0], elapsed,
+                              error=f"{len(incomplete)}/{len(segments)} segments incomplete: {first_error['error']}",
+                              retry_after=first_error.get("retry_after"), effective_url=url)
+
+    os.remove(segments_file_path(output_path))
+    return attempt_result(CURL_OK, 206, bytes_this_attempt[0], elapsed, effective_url=url, digest=digest)
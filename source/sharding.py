@@ -0,0 +1,161 @@
+import os
+import zlib
+import fcntl
+import contextlib
+from .utils import log_message
+
+
+def detect_slurm_task(environ=None):
+    """
+    Return (task_index, task_count) for this process.
+    Job arrays (SLURM_ARRAY_TASK_ID/SLURM_ARRAY_TASK_COUNT) take precedence over
+    multi-task steps (SLURM_PROCID/SLURM_NTASKS). Outside Slurm this is (0, 1).
+    """
+    environ = os.environ if environ is None else environ
+    if "SLURM_ARRAY_TASK_ID" in environ and "SLURM_ARRAY_TASK_COUNT" in environ:
+        # Array indices need not start at 0 (e.g. --array=1-8), so count from the minimum
+        task_id = int(environ["SLURM_ARRAY_TASK_ID"]) - int(environ.get("SLURM_ARRAY_TASK_MIN", 0))
+        return task_id, int(environ["SLURM_ARRAY_TASK_COUNT"])
+    if "SLURM_PROCID" in environ and "SLURM_NTASKS" in environ:
+        return int(environ["SLURM_PROCID"]), int(environ["SLURM_NTASKS"])
+    return 0, 1
+
+
+def slurm_job_key(environ=None):
+    """Identifier shared by all tasks of one job (used to name the shared work queue)"""
+    environ = os.environ if environ is None else environ
+    return environ.get("SLURM_ARRAY_JOB_ID") or environ.get("SLURM_JOB_ID") or "local"
+
+
+def shard_for_url(url, task_count):
+    # crc32 rather than hash(): Python's str hash is randomised per process
+    return zlib.crc32(url.encode("utf-8")) % task_count
+
+
+def partition_links(links, task_index, task_count):
+    """Static hash partitioning: the URLs of links assigned to task_index"""
+    if task_count <= 1:
+        return list(links)
+    return [url for url in links if shard_for_url(url, task_count) == task_index]
+
+
+@contextlib.contextmanager
+def shared_file_lock(lock_path):
+    """Exclusive flock on lock_path, shared by processes on every node of a shared filesystem"""
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class SharedWorkQueue:
+    """
+    Work queue on a shared filesystem for dynamic sharding.
+    The first task to arrive writes the manifest; every task then claims the
+    next claim_batch_size URLs by advancing a cursor file under an flock, so
+    faster nodes simply claim more batches. Requires a filesystem with working
+    flock across nodes (Lustre mounted with -o flock, GPFS, NFSv4).
+    prepare_links(links), if given, is called by the task that creates the
+    queue (e.g. to probe and reorder the URLs) and returns the URLs to write.
+    A task that stops early gives the URLs it claimed but did not finish back
+    (see give_back); they are claimed again before the rest of the manifest.
+    """
+
+    def __init__(self, queue_dir, links, task_index, claim_batch_size=50, prepare_links=None):
+        self.queue_dir = queue_dir
+        self.task_index = task_index
+        self.claim_batch_size = max(1, claim_batch_size)
+        self.manifest_path = os.path.join(queue_dir, "manifest.txt")
+        self.cursor_path = os.path.join(queue_dir, "cursor")
+        self.claims_log_path = os.path.join(queue_dir, "claims.log")
+        self.lock_path = os.path.join(queue_dir, "queue.lock")
+        self.returned_path = os.path.join(queue_dir, "returned.txt")
+        self._unserved = [] # Rest of the batch iter_urls is yielding from
+        os.makedirs(queue_dir, exist_ok=True)
+
+        with shared_file_lock(self.lock_path):
+            if not os.path.exists(self.manifest_path):
+                if prepare_links is not None:
+                    links = prepare_links(links)
+                tmp_path = f"{self.manifest_path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    f.writelines(f"{url}\n" for url in links)
+                os.replace(tmp_path, self.manifest_path)
+                self._write_cursor(0)
+                log_message(f"[QUEUE] Task {task_index} created shared work queue with {len(links)} URLs in {queue_dir}")
+        with open(self.manifest_path, 'r') as f:
+            self.links = [line.strip() for line in f if line.strip()]
+
+    def _read_cursor(self):
+        try:
+            with open(self.cursor_path, 'r') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _write_cursor(self, value):
+        tmp_path = f"{self.cursor_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(str(value))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.cursor_path)
+
+    def claim(self):
+        """Claim the next batch of URLs for this task; an empty list means the queue is drained"""
+        with shared_file_lock(self.lock_path):
+            returned = self._read_returned()
+            if returned:
+                batch, rest = returned[:self.claim_batch_size], returned[self.claim_batch_size:]
+                self._write_returned(rest)
+                with open(self.claims_log_path, 'a') as f:
+                    f.write(f"task={self.task_index} returned={len(batch)}\n")
+                return batch
+            start = self._read_cursor()
+            end = min(start + self.claim_batch_size, len(self.links))
+            if start >= end:
+                return []
+            self._write_cursor(end)
+            with open(self.claims_log_path, 'a') as f:
+                f.write(f"task={self.task_index} start={start} end={end}\n")
+        return self.links[start:end]
+
+    def _read_returned(self):
+        try:
+            with open(self.returned_path, 'r') as f:
+                return [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def _write_returned(self, urls):
+        tmp_path = f"{self.returned_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.writelines(f"{url}\n" for url in urls)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.returned_path)
+
+    def give_back(self, urls):
+        """Return claimed URLs this task will not finish, and the unused rest of its current batch, to the queue"""
+        urls = list(dict.fromkeys(list(urls) + self._unserved))
+        self._unserved = []
+        if not urls:
+            return
+        with shared_file_lock(self.lock_path):
+            self._write_returned(self._read_returned() + urls)
+        log_message(f"[QUEUE] Task {self.task_index} gave {len(urls)} unfinished URLs back to the queue.")
+
+    def remaining(self):
+        return max(0, len(self.links) - self._read_cursor()) + len(self._read_returned())
+
+    def iter_urls(self):
+        """Yield URLs batch by batch, claiming the next batch only when the previous one is used up"""
+        while True:
+            batch = self.claim()
+            if not batch:
+                return
+            self._unserved = batch
+            while self._unserved:
+                yield self._unserved.pop(0)
@@ -0,0 +1,210 @@
+import os
+import time
+import errno
+import shutil
+import ctypes
+import ctypes.util
+import threading
+from .utils import log_message
+from .segmented import segments_file_path
+
+# fallocate(2) mode that reserves blocks without changing the file size, so a
+# resuming transport (curl -C -, Range: bytes=<size>-) still sees what is really there
+_FALLOC_FL_KEEP_SIZE = 0x01
+_libc = None
+
+
+def _fallocate_keep_size(fd, size):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if _libc.fallocate(fd, _FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        raise OSError(ctypes.get_errno(), "fallocate failed")
+
+
+def preallocate(path, size):
+    """Reserve size bytes for the download at path without changing its size (best effort)"""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    except OSError:
+        return False
+    try:
+        _fallocate_keep_size(fd, size)
+        return True
+    except (OSError, AttributeError):
+        return False # Not supported here; the file simply grows as it is written
+    finally:
+        os.close(fd)
+
+
+def move_file(src, dst):
+    """
+    Move src to dst atomically: a rename on the same filesystem, else a copy to
+    a temporary name next to dst, an fsync and a rename, so dst is never seen
+    half written. Returns True if the bytes were copied.
+    """
+    try:
+        os.rename(src, dst)
+        return False
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp_path = os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.{os.getpid()}.flush.tmp")
+    try:
+        shutil.copyfile(src, tmp_path) # copy_file_range/sendfile: large sequential writes
+        fd = os.open(tmp_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.remove(src)
+    return True
+
+
+class StagingArea:
+    """
+    Downloads are written to node-local scratch (staging_dir) and moved into
+    download_dir by one background flusher thread once they are complete, in
+    batches of about flush_batch_bytes or every flush_interval_seconds, so the
+    shared filesystem sees a few large sequential writes per file instead of
+    many small appends from parallel streams.
+
+    Scratch use is bounded by max_bytes: admit() reserves a URL's known size
+    before its download starts and refuses new URLs while the reservations and
+    the files waiting to be flushed would exceed it (the dispatcher then holds
+    them back). A URL counts as COMPLETED only once its file is in download_dir.
+    """
+
+    def __init__(self, staging_dir, download_dir, max_bytes, flush_batch_bytes=4 * 1024**3,
+                 flush_interval_seconds=30):
+        self.staging_dir = staging_dir
+        self.download_dir = download_dir
+        self.max_bytes = max_bytes
+        self.flush_batch_bytes = flush_batch_bytes
+        self.flush_interval_seconds = flush_interval_seconds
+        os.makedirs(staging_dir, exist_ok=True)
+        self._reserved = {} # url -> bytes reserved for a download that hasn't been handed to the flusher
+        self._queue = [] # (queued_at, url, staged path, final path, size, on_flushed)
+        self._queued_bytes = 0
+        self._starved = False
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self.flushed_files = 0
+        self.flushed_bytes = 0
+        self.flush_failures = [] # (url, error)
+
+    def stage_path(self, filename):
+        return os.path.join(self.staging_dir, filename + ".part")
+
+    def used_bytes(self):
+        with self._cond:
+            return sum(self._reserved.values()) + self._queued_bytes
+
+    def admit(self, url, size):
+        """Reserve size bytes of scratch for url; False if that would exceed max_bytes (url must wait)"""
+        with self._cond:
+            if url in self._reserved:
+                return True # A retry keeps its reservation
+            used = sum(self._reserved.values()) + self._queued_bytes
+            if used > 0 and used + (size or 0) > self.max_bytes:
+                if not self._starved:
+                    self._starved = True
+                    self._cond.notify_all() # Flush now rather than at the next batch
+                return False
+            self._reserved[url] = size or 0
+            return True
+
+    def release(self, url, staged_path=None):
+        """Drop url's reservation (skipped or finally failed) and its partial file in scratch, if given"""
+        with self._cond:
+            self._reserved.pop(url, None)
+        for stale in (staged_path, segments_file_path(staged_path)) if staged_path else ():
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    def submit(self, url, staged_path, final_path, on_flushed):
+        """Queue a completed, verified download for the move to final_path; on_flushed() runs after it"""
+        size = os.path.getsize(staged_path)
+        with self._cond:
+            self._reserved.pop(url, None)
+            self._queue.append((time.time(), url, staged_path, final_path, size, on_flushed))
+            self._queued_bytes += size
+            if self._queued_bytes >= self.flush_batch_bytes:
+                self._cond.notify_all()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="staging-flusher", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Flush everything still queued and stop the flusher"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        log_message(f"[FLUSH] {self.flushed_files} staged files ({self.flushed_bytes / (1024**3):.2f} GB) "
+                    f"moved to {self.download_dir}" + (f", {len(self.flush_failures)} failed." if self.flush_failures else "."))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    due = self._queue and (self._closing or self._starved
+                                           or self._queued_bytes >= self.flush_batch_bytes
+                                           or time.time() - self._queue[0][0] >= self.flush_interval_seconds)
+                    if due or (self._closing and not self._queue):
+                        break
+                    timeout = self.flush_interval_seconds - (time.time() - self._queue[0][0]) if self._queue else None
+                    self._cond.wait(timeout)
+                if not self._queue:
+                    return
+                batch, self._queue = self._queue, []
+                self._starved = False
+            self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.time()
+        moved = copied = 0
+        for _, url, staged_path, final_path, size, on_flushed in batch:
+            try:
+                copied += size if move_file(staged_path, final_path) else 0
+                moved += size
+                on_flushed()
+                self.flushed_files += 1
+            except Exception as e:
+                log_message(f"[FLUSH FAILED] {os.path.basename(final_path)} (URL: {url}): {e}")
+                self.flush_failures.append((url, f"Moving the staged file to {self.download_dir} failed: {e}"))
+            finally:
+                with self._cond:
+                    self._queued_bytes -= size
+        self.flushed_bytes += moved
+        elapsed = time.time() - started
+        log_message(f"[FLUSH] Moved {len(batch)} files ({moved / (1024*1024):.1f} MB) to {self.download_dir} in {elapsed:.1f}s"
+                    + (f" ({copied / (1024*1024) / elapsed:.1f} MB/s copied)." if copied and elapsed > 0 else "."))
+
+
+def staging_dir_from_params(main_params):
+    """The configured staging_dir with ~ and environment variables expanded (None if staging is disabled)"""
+    staging_dir = main_params.get("staging_dir")
+    return os.path.expandvars(os.path.expanduser(staging_dir)) if staging_dir else None
+
+
+def staging_from_params(main_params, download_dir):
+    """Build the staging area from the main_params dictionary assembled in hpc_downloader.py (None if disabled)"""
+    staging_dir = staging_dir_from_params(main_params)
+    if not staging_dir:
+        return None
+    staging = StagingArea(staging_dir, download_dir, main_params.get("staging_max_bytes", 50 * 1024**3),
+                          main_params.get("staging_flush_batch_bytes", 4 * 1024**3),
+                          main_params.get("staging_flush_interval_seconds", 30))
+    log_message(f"[FLUSH] Staging downloads in {staging_dir} (up to {staging.max_bytes / (1024**3):.1f} GB), "
+                f"flushed to {download_dir} in batches.")
+    return staging
@@ -0,0 +1,268 @@
+import os
+import time
+import sqlite3
+import threading
+from .utils import log_message
+from .sharding import shared_file_lock
+
+# Download status values stored in the journal
+STATUS_PENDING = "PENDING"
+STATUS_IN_PROGRESS = "IN_PROGRESS"
+STATUS_COMPLETED = "COMPLETED"
+STATUS_FAILED = "FAILED"
+
+# Columns of the downloads table. New columns are added to existing
+# journals automatically when the store is opened.
+_COLUMNS = [
+    ("url", "TEXT PRIMARY KEY"),
+    ("filename", "TEXT"),
+    ("status", "TEXT"),
+    ("bytes_done", "INTEGER"),
+    ("attempts", "INTEGER"),
+    ("last_error", "TEXT"),
+    ("digest", "TEXT"),        # "<algorithm>:<hex>" of the completed file, when an expected digest was given
+    ("content_length", "INTEGER"), # Cached probe results (see source/probing.py)
+    ("accept_ranges", "INTEGER"),
+    ("etag", "TEXT"),
+    ("last_modified", "TEXT"),
+    ("probed_at", "REAL"),
+    ("processing_status", "TEXT"), # Post-processing of the completed file (see source/postprocess.py)
+    ("processing_error", "TEXT"),
+    ("processed_at", "REAL"),
+    ("started_at", "REAL"),
+    ("finished_at", "REAL"),
+    ("updated_at", "REAL"),
+]
+_COLUMN_NAMES = [name for name, _ in _COLUMNS]
+_LEGACY_IMPORT_KEY = "legacy_state_imported"
+# Meta keys that belong to one journal and are not taken over by merge_journals
+_PER_JOURNAL_META = ("checkpoint",)
+
+
+def journal_lock_path(db_path):
+    """File locked (flock) around every write to the journal at db_path, and by readers merging it"""
+    return db_path + ".lock"
+
+
+class StateStore:
+    """
+    Download state journal kept in a single SQLite database (one row per URL).
+    Reads are served from an in-memory copy loaded in bulk; writes are buffered
+    and committed in batches, every commit_batch_size changes or
+    commit_interval_seconds, whichever comes first. Call flush() or close()
+    to commit outstanding changes.
+
+    Writes hold an flock on journal_lock_path(db_path), the same kind of lock
+    the shared work queue relies on, so another task can read a consistent
+    copy of this journal with merge_journals without SQLite's own POSIX locks,
+    which parallel filesystems often don't honour across nodes.
+    """
+
+    def __init__(self, db_path, commit_batch_size=200, commit_interval_seconds=10.0):
+        self.db_path = db_path
+        self.lock_path = journal_lock_path(db_path)
+        self.commit_batch_size = commit_batch_size
+        self.commit_interval_seconds = commit_interval_seconds
+        self._lock = threading.RLock()
+        self._records = {}   # url -> record dict
+        self._dirty = set()  # urls changed since the last commit
+        self._last_commit = time.time()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        # The connection is shared by all worker threads; every access holds self._lock
+        self._conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        # WAL needs shared memory, which parallel filesystems (Lustre/GPFS) do not provide across nodes
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        self._load_all()
+
+    def _create_schema(self):
+        columns_sql = ", ".join(f"{name} {kind}" for name, kind in _COLUMNS)
+        with shared_file_lock(self.lock_path), self._conn:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS downloads ({columns_sql})")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            existing = {row[1] for row in self._conn.execute("PRAGMA table_info(downloads)")}
+            for name, kind in _COLUMNS:
+                if name not in existing:
+                    self._conn.execute(f"ALTER TABLE downloads ADD COLUMN {name} {kind.replace('PRIMARY KEY', '')}")
+
+    def _load_all(self):
+        """Read every row in one query so lookups at resume need no further I/O"""
+        cursor = self._conn.execute(f"SELECT {', '.join(_COLUMN_NAMES)} FROM downloads")
+        self._records = {row[0]: dict(zip(_COLUMN_NAMES, row)) for row in cursor}
+        if self._records:
+            log_message(f"Loaded state for {len(self._records)} URLs from {self.db_path}")
+
+    # ---- reads ----
+
+    def get(self, url):
+        """Return a copy of the record for url, or None if it has never been seen"""
+        with self._lock:
+            record = self._records.get(url)
+            return dict(record) if record else None
+
+    def get_status(self, url):
+        with self._lock:
+            record = self._records.get(url)
+            return record["status"] if record else None
+
+    def all_records(self):
+        """Return copies of every record"""
+        with self._lock:
+            return [dict(record) for record in self._records.values()]
+
+    def count_by_status(self):
+        with self._lock:
+            counts = {}
+            for record in self._records.values():
+                counts[record["status"]] = counts.get(record["status"], 0) + 1
+            return counts
+
+    # ---- writes ----
+
+    def update(self, url, **fields):
+        """Create or update the record for url with the given column values"""
+        unknown = set(fields) - set(_COLUMN_NAMES)
+        if unknown:
+            raise ValueError(f"Unknown state fields: {', '.join(sorted(unknown))}")
+        with self._lock:
+            record = self._records.get(url)
+            if record is None:
+                record = dict.fromkeys(_COLUMN_NAMES)
+                record.update(url=url, status=STATUS_PENDING, bytes_done=0, attempts=0)
+                self._records[url] = record
+            record.update(fields)
+            record["updated_at"] = time.time()
+            self._dirty.add(url)
+            self._maybe_commit()
+
+    def set_status(self, url, status, **fields):
+        self.update(url, status=status, **fields)
+
+    def record_attempt(self, url, error=None, bytes_done=None):
+        """Count one download attempt for url, remembering its error (None on success)"""
+        with self._lock:
+            record = self._records.get(url)
+            attempts = (record["attempts"] or 0) + 1 if record else 1
+            fields = {"attempts": attempts, "last_error": error}
+            if bytes_done is not None:
+                fields["bytes_done"] = bytes_done
+            self.update(url, **fields)
+
+    def set_meta(self, key, value):
+        with self._lock, shared_file_lock(self.lock_path), self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+
+    # ---- commits ----
+
+    def _maybe_commit(self):
+        if len(self._dirty) >= self.commit_batch_size or time.time() - self._last_commit >= self.commit_interval_seconds:
+            self.flush()
+
+    def flush(self):
+        """Commit all buffered changes in one transaction"""
+        with self._lock:
+            if self._dirty:
+                placeholders = ", ".join("?" for _ in _COLUMN_NAMES)
+                rows = [tuple(self._records[url][name] for name in _COLUMN_NAMES) for url in self._dirty]
+                with shared_file_lock(self.lock_path), self._conn:
+                    self._conn.executemany(
+                        f"INSERT OR REPLACE INTO downloads ({', '.join(_COLUMN_NAMES)}) VALUES ({placeholders})", rows)
+                self._dirty.clear()
+            self._last_commit = time.time()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+    # ---- merging ----
+
+    def merge_journals(self, paths):
+        """
+        Take over the records of other journals (e.g. those of the other tasks
+        of a sharded job) that were updated after ours, with their updated_at,
+        and meta entries we don't have. Each journal is read under its lock, so
+        its writer is never caught in the middle of a commit. Returns the
+        number of records taken over.
+        """
+        taken = 0
+        for path in paths:
+            try:
+                with shared_file_lock(journal_lock_path(path)):
+                    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=60)
+                    try:
+                        # An older journal may lack newer columns
+                        columns = [row[1] for row in conn.execute("PRAGMA table_info(downloads)") if row[1] in _COLUMN_NAMES]
+                        rows = conn.execute(f"SELECT {', '.join(columns)} FROM downloads").fetchall()
+                        meta = conn.execute("SELECT key, value FROM meta").fetchall()
+                    finally:
+                        conn.close()
+            except sqlite3.Error as e:
+                log_message(f"Could not merge journal {path}: {e}")
+                continue
+            with self._lock:
+                for row in rows:
+                    other = dict.fromkeys(_COLUMN_NAMES)
+                    other.update(zip(columns, row))
+                    own = self._records.get(other["url"])
+                    if own is None or (other["updated_at"] or 0) > (own["updated_at"] or 0):
+                        self._records[other["url"]] = other
+                        self._dirty.add(other["url"])
+                        taken += 1
+            for key, value in meta:
+                if key not in _PER_JOURNAL_META and self.get_meta(key) is None:
+                    self.set_meta(key, value)
+        self.flush()
+        if taken:
+            log_message(f"Merged {taken} newer records from {len(paths)} other journals into {self.db_path}")
+        return taken
+
+    # ---- migration ----
+
+    def import_legacy_state_dir(self, state_dir, urls, filename_for_url):
+        """
+        One-time import of the old per-file "<filename>.state" files in state_dir.
+        filename_for_url(url) must return the name the old downloader used for url.
+        Old state files were keyed by basename, so URLs sharing a basename all
+        inherit the same status. Runs only once per journal.
+        """
+        if self.get_meta(_LEGACY_IMPORT_KEY):
+            return 0
+        try:
+            # One directory scan instead of an exists() call per URL
+            state_files = {entry.name for entry in os.scandir(state_dir)
+                           if entry.name.endswith(".state") and entry.is_file()}
+        except FileNotFoundError:
+            state_files = set()
+
+        imported = 0
+        if state_files:
+            log_message(f"Importing {len(state_files)} legacy .state files from {state_dir}")
+            for url in urls:
+                if url in self._records:
+                    continue
+                filename = filename_for_url(url)
+                if f"{filename}.state" not in state_files:
+                    continue
+                try:
+                    with open(os.path.join(state_dir, f"{filename}.state"), 'r') as f_state:
+                        content = f_state.read().strip()
+                except OSError as e:
+                    log_message(f"Could not read legacy state file for {filename}: {e}")
+                    continue
+                if content == STATUS_COMPLETED:
+                    self.update(url, filename=filename, status=STATUS_COMPLETED)
+                else:
+                    self.update(url, filename=filename, status=STATUS_FAILED, last_error=content)
+                imported += 1
+            self.flush()
+            log_message(f"Imported legacy state for {imported} URLs.")
+        self.set_meta(_LEGACY_IMPORT_KEY, str(time.time()))
+        return imported
@@ -0,0 +1,264 @@
+import os
+import sys
+import glob
+import json
+import time
+import threading
+import collections
+from datetime import datetime
+from .utils import log_message, atomic_write, format_duration
+
+
+class StatusReporter:
+    """
+    Tracks job progress with counters and sets (O(1) per event) and periodically
+    replaces the status file with a compact snapshot: counts, rates, ETA and the
+    most recent failures. A snapshot is written every snapshot_every_events events
+    and at least every snapshot_interval_seconds by a background timer.
+    Per-URL detail lives in the state journal (see write_detail_report).
+    When merged_status_path is given (sharded jobs), the counters are also
+    written as JSON next to the status file and all tasks' counters are summed
+    into merged_status_path.
+    """
+
+    def __init__(self, status_file_path, urls, snapshot_every_events=100,
+                 snapshot_interval_seconds=30, recent_failures=20, merged_status_path=None):
+        self.status_file_path = status_file_path
+        self.merged_status_path = merged_status_path
+        self.counters_path = os.path.splitext(status_file_path)[0] + ".json" if merged_status_path else None
+        self.snapshot_every_events = max(1, snapshot_every_events)
+        self.snapshot_interval_seconds = snapshot_interval_seconds
+        self.started_at = time.time()
+        self.phase = "Downloading"
+
+        self.total = 0
+        self.pending = set()
+        self.in_flight = set()
+        self.retrying = set() # failed an attempt, waiting on the retry queue
+        self.succeeded = 0
+        self.skipped = 0
+        self.failed = {}  # url -> latest error, for URLs currently failed
+        self.bytes_downloaded = 0
+        self.recent_failures = collections.deque(maxlen=recent_failures)
+
+        self._events_since_snapshot = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+        self.add_urls(urls)
+
+    # ---- events ----
+
+    def add_urls(self, urls):
+        with self._lock:
+            for url in urls:
+                if url not in self.pending:
+                    self.pending.add(url)
+                    self.total += 1
+
+    def set_phase(self, phase):
+        with self._lock:
+            self.phase = phase
+        self.write_snapshot()
+
+    def record_started(self, url):
+        with self._lock:
+            self.retrying.discard(url)
+            self.in_flight.add(url)
+
+    def record_success(self, url, skipped=False, bytes_downloaded=0):
+        with self._lock:
+            self.pending.discard(url)
+            self.in_flight.discard(url)
+            self.retrying.discard(url)
+            self.failed.pop(url, None)
+            if skipped:
+                self.skipped += 1
+            else:
+                self.succeeded += 1
+                self.bytes_downloaded += bytes_downloaded or 0
+            self._event()
+
+    def record_failure(self, url, error):
+        with self._lock:
+            self.pending.discard(url)
+            self.in_flight.discard(url)
+            self.retrying.discard(url)
+            self.failed[url] = error
+            self.recent_failures.append((datetime.now().strftime('%Y-%m-%d %H:%M:%S'), url, error))
+            self._event()
+
+    def record_retry(self, url):
+        """An attempt for url failed and the URL waits for its next attempt"""
+        with self._lock:
+            self.in_flight.discard(url)
+            self.retrying.add(url)
+
+    def _event(self):
+        # Called with self._lock held
+        self._events_since_snapshot += 1
+        if self._events_since_snapshot >= self.snapshot_every_events:
+            self._events_since_snapshot = 0
+            self._write_snapshot_locked()
+
+    # ---- snapshots ----
+
+    def start(self):
+        """Write the first snapshot and start the periodic writer thread"""
+        self.write_snapshot()
+        if self.snapshot_interval_seconds and self._timer is None:
+            self._timer = threading.Thread(target=self._run_timer, name="status-snapshot", daemon=True)
+            self._timer.start()
+
+    def stop(self):
+        """Stop the writer thread and write a final snapshot"""
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        self.write_snapshot()
+
+    def _run_timer(self):
+        while not self._stop.wait(self.snapshot_interval_seconds):
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        with self._lock:
+            self._write_snapshot_locked()
+
+    def _snapshot_lines_locked(self):
+        now = time.time()
+        elapsed = max(now - self.started_at, 1e-6)
+        finished = self.succeeded + self.skipped + len(self.failed)
+        downloaded_rate = self.succeeded / elapsed  # files/s actually transferred
+        if downloaded_rate > 0:
+            eta = f"{format_duration(len(self.pending) / downloaded_rate)}"
+        else:
+            eta = "unknown"
+
+        lines = [
+            f"--- Status ({self.phase} - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---",
+            f"Job started: {datetime.fromtimestamp(self.started_at).strftime('%Y-%m-%d %H:%M:%S')} (elapsed {format_duration(elapsed)})",
+            f"Total URLs: {self.total}",
+            f"Successful: {self.succeeded}",
+            f"Skipped (already completed): {self.skipped}",
+            f"Failed: {len(self.failed)}",
+            f"In progress: {len(self.in_flight)}",
+            f"Waiting to retry: {len(self.retrying)}",
+            f"Still Pending: {len(self.pending)}",
+            f"Finished: {finished}/{self.total} ({100.0 * finished / self.total if self.total else 100.0:.1f}%)",
+            f"Rate: {downloaded_rate * 60:.2f} files/min, {self.bytes_downloaded / elapsed / (1024*1024):.2f} MB/s "
+            f"({self.bytes_downloaded / (1024*1024*1024):.2f} GB downloaded)",
+            f"ETA: {eta}",
+        ]
+        if self.recent_failures:
+            lines.append("")
+            lines.append(f"Recent failures (last {len(self.recent_failures)}):")
+            for when, url, error in self.recent_failures:
+                lines.append(f"  ✗ [{when}] {url} (Error: {error})")
+        lines.append("--- End Status ---")
+        return lines
+
+    def _counters_locked(self):
+        return {
+            "phase": self.phase,
+            "started_at": self.started_at,
+            "updated_at": time.time(),
+            "total": self.total,
+            "succeeded": self.succeeded,
+            "skipped": self.skipped,
+            "failed": len(self.failed),
+            "in_flight": len(self.in_flight),
+            "retrying": len(self.retrying),
+            "pending": len(self.pending),
+            "bytes_downloaded": self.bytes_downloaded,
+            "recent_failures": list(self.recent_failures),
+        }
+
+    def _write_snapshot_locked(self):
+        try:
+            atomic_write(self.status_file_path, "\n".join(self._snapshot_lines_locked()) + "\n")
+            if self.counters_path:
+                atomic_write(self.counters_path, json.dumps(self._counters_locked()))
+                counter_files = glob.glob(os.path.join(os.path.dirname(self.counters_path), "download_status.task*.json"))
+                write_merged_status(counter_files, self.merged_status_path)
+        except OSError as e:
+            log_message(f"Warning: could not write status snapshot {self.status_file_path}: {e}")
+
+
+def write_merged_status(counter_files, out_path):
+    """Sum the JSON counters written by every task of a sharded job into one status file"""
+    tasks = []
+    for path in sorted(counter_files):
+        try:
+            with open(path, 'r') as f:
+                tasks.append((os.path.basename(path), json.load(f)))
+        except (OSError, ValueError):
+            continue # Being replaced by its task right now; picked up next time
+    if not tasks:
+        return
+    keys = ("total", "succeeded", "skipped", "failed", "in_flight", "retrying", "pending", "bytes_downloaded")
+    totals = {key: sum(counters.get(key, 0) for _, counters in tasks) for key in keys}
+    started_at = min(counters["started_at"] for _, counters in tasks)
+    elapsed = max(time.time() - started_at, 1e-6)
+    finished = totals["succeeded"] + totals["skipped"] + totals["failed"]
+    recent = sorted((f for _, counters in tasks for f in counters["recent_failures"]), key=lambda f: f[0])[-20:]
+
+    lines = [
+        f"--- Merged Status ({len(tasks)} tasks - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---",
+        f"Job started: {datetime.fromtimestamp(started_at).strftime('%Y-%m-%d %H:%M:%S')} (elapsed {format_duration(elapsed)})",
+        f"URLs claimed by tasks: {totals['total']}",
+        f"Successful: {totals['succeeded']}",
+        f"Skipped (already completed): {totals['skipped']}",
+        f"Failed: {totals['failed']}",
+        f"In progress: {totals['in_flight']}",
+        f"Waiting to retry: {totals['retrying']}",
+        f"Still Pending: {totals['pending']}",
+        f"Finished: {finished}/{totals['total']}",
+        f"Rate: {totals['succeeded'] / elapsed * 60:.2f} files/min, {totals['bytes_downloaded'] / elapsed / (1024*1024):.2f} MB/s",
+        "",
+        "Per task:",
+    ]
+    for name, counters in tasks:
+        lines.append(f"  {name}: {counters['phase']}, {counters['succeeded'] + counters['skipped']} ok, "
+                     f"{counters['failed']} failed, {counters['pending']} pending")
+    if recent:
+        lines.append("")
+        lines.append(f"Recent failures (last {len(recent)}):")
+        for when, url, error in recent:
+            lines.append(f"  ✗ [{when}] {url} (Error: {error})")
+    lines.append("--- End Merged Status ---")
+    atomic_write(out_path, "\n".join(lines) + "\n")
+
+
+def write_detail_report(state_store, out):
+    """Write the full per-URL status listing from the state journal to the open file out"""
+    records = sorted(state_store.all_records(), key=lambda r: (r["status"] or "", r["url"]))
+    symbols = {"COMPLETED": "✓", "FAILED": "✗", "IN_PROGRESS": "→", "PENDING": "⟳"}
+    out.write(f"--- Per-URL Detail ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')}) ---\n")
+    for status, count in sorted(state_store.count_by_status().items(), key=lambda item: item[0] or ""):
+        out.write(f"{status}: {count}\n")
+    out.write("\n")
+    for record in records:
+        line = f"  {symbols.get(record['status'], '?')} {record['status']} {record['url']}"
+        line += f" [{record['filename']}, {record['bytes_done'] or 0} bytes, {record['attempts'] or 0} attempts]"
+        if record["status"] != "COMPLETED" and record["last_error"]:
+            line += f" (Error: {record['last_error']})"
+        out.write(line + "\n")
+    out.write("--- End Per-URL Detail ---\n")
+
+
+if __name__ == "__main__":
+    # On-demand detail report: python -m source.status <download_dir>/download_state/state.db [output_file]
+    from .state import StateStore
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python -m source.status <state.db> [output_file]")
+    store = StateStore(sys.argv[1])
+    try:
+        if len(sys.argv) > 2:
+            with open(sys.argv[2], 'w') as f:
+                write_detail_report(store, f)
+        else:
+            write_detail_report(store, sys.stdout)
+    finally:
+        store.close()
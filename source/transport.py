@@ -0,0 +1,755 @@
+import io
+import os
+import time
+import socket
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlparse, urljoin
+from .utils import log_message
+from .checksums import new_hasher, update_from_file, file_digest
+from .scheduler import url_host
+
+# Exit codes reported by both backends follow curl's numbering so download_file
+# can treat them the same way regardless of which transport produced them.
+CURL_OK = 0
+CURL_COULDNT_RESOLVE_HOST = 6
+CURL_COULDNT_CONNECT = 7
+CURL_PARTIAL_FILE = 18
+CURL_HTTP_RETURNED_ERROR = 22
+CURL_WRITE_ERROR = 23
+CURL_OPERATION_TIMEDOUT = 28
+CURL_RANGE_ERROR = 33
+CURL_ABORTED_BY_CALLBACK = 42
+CURL_TOO_MANY_REDIRECTS = 47
+CURL_RECV_ERROR = 56
+
+# HTTP statuses curl's --retry treats as transient
+TRANSIENT_HTTP_STATUSES = {408, 429, 500, 502, 503, 504}
+
+CHUNK_SIZE = 256 * 1024
+MAX_REDIRECTS = 50  # Same as curl's default --max-redirs
+USER_AGENT = "hpc-downloader/1.0"
+_WRITE_OUT_MARKER = "__HPCDL_WRITE_OUT__"
+
+
+def attempt_result(returncode, http_status=None, bytes_downloaded=0, elapsed=0.0,
+                   connect_time=None, ttfb=None, error=None, retry_after=None,
+                   effective_url=None, digest=None, etag=None, last_modified=None):
+    """
+    Build the dictionary every transport returns for one download attempt.
+    digest is the hex digest of the whole output file, computed while the bytes
+    were written, when options["digest_algorithm"] asked for one. etag and
+    last_modified are the validators of the response, if it had any.
+    """
+    return {
+        "returncode": returncode,
+        "http_status": http_status,
+        "bytes": bytes_downloaded,
+        "elapsed": elapsed,
+        "connect_time": connect_time,
+        "ttfb": ttfb,
+        "error": error,
+        "retry_after": retry_after,
+        "effective_url": effective_url,
+        "digest": digest,
+        "etag": etag,
+        "last_modified": last_modified,
+    }
+
+
+def probe_result(returncode, http_status=None, content_length=None, accept_ranges=False,
+                 etag=None, last_modified=None, effective_url=None, error=None):
+    """Build the dictionary every transport returns for a HEAD-style probe"""
+    return {
+        "returncode": returncode,
+        "http_status": http_status,
+        "content_length": content_length,
+        "accept_ranges": accept_ranges,
+        "etag": etag,
+        "last_modified": last_modified,
+        "effective_url": effective_url,
+        "error": error,
+    }
+
+
+def probe_from_headers(status, getheader, effective_url):
+    """Fill a probe result from a response status and a header lookup function"""
+    content_length = None
+    accept_ranges = (getheader("Accept-Ranges") or "").strip().lower() == "bytes"
+    content_range = getheader("Content-Range") or ""
+    if status == 206 and "/" in content_range:
+        # Answer to a zero-length "Range: bytes=0-0" probe; the total size follows the slash
+        total = content_range.rsplit("/", 1)[-1].strip()
+        content_length = int(total) if total.isdigit() else None
+        accept_ranges = True
+    else:
+        value = (getheader("Content-Length") or "").strip()
+        content_length = int(value) if value.isdigit() else None
+    return probe_result(CURL_OK, status, content_length, accept_ranges,
+                        getheader("ETag"), getheader("Last-Modified"), effective_url)
+
+
+def if_range_validator(etag=None, last_modified=None):
+    """Value for an If-Range header resuming a partial download, or None (weak ETags are not allowed there)"""
+    if etag and not etag.startswith("W/"):
+        return etag
+    return last_modified or None
+
+
+def conditional_headers(etag=None, last_modified=None):
+    """If-None-Match/If-Modified-Since headers asking the server to answer 304 if the object is unchanged"""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def content_range_total(value):
+    """Total size from a Content-Range header ("bytes 0-9/100" or "bytes */100"), or None"""
+    total = (value or "").rsplit("/", 1)[-1].strip()
+    return int(total) if total.isdigit() else None
+
+
+def parse_retry_after(value):
+    """Return the Retry-After header value in seconds, or None if absent/unparseable"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CurlTransport:
+    """Runs one curl subprocess per attempt. This is the original download path."""
+
+    name = "curl"
+
+    def __init__(self, governor=None):
+        self.governor = governor # bandwidth.BandwidthGovernor or None
+        self.aborted = False
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def _start(self, cmd, **kwargs):
+        process = subprocess.Popen(cmd, **kwargs)
+        with self._lock:
+            self._processes.add(process)
+            if self.aborted:
+                process.terminate()
+        return process
+
+    def _finished(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def abort(self):
+        """End every running transfer (what was written stays on disk) and refuse new ones"""
+        with self._lock:
+            self.aborted = True
+            processes = list(self._processes)
+        for process in processes:
+            process.terminate()
+
+    def fetch(self, url, output_path, label, options):
+        """
+        Download url into output_path with curl -C - (resume).
+        When options["digest_algorithm"] is set, curl writes to a pipe instead
+        and the body is hashed on its way into the file, so no second read of
+        the finished file is needed. With a bandwidth governor the body takes
+        the same path, and reading the pipe more slowly throttles curl; curl
+        does not retry by itself then (download_file's retries resume).
+        options["if_range"] is the validator of a partial file being resumed:
+        if the object has changed since, the partial is deleted.
+        """
+        start = time.time()
+        algorithm = options.get("digest_algorithm")
+        piped = bool(algorithm or self.governor)
+        host = url_host(url)
+        offset = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        cmd = [
+            "curl", "-L", "-C", "-",
+            "--retry", str(options["curl_retry_attempts"]),
+            "--retry-delay", str(options["curl_retry_delay_seconds"]),
+            "--retry-max-time", str(options["curl_retry_max_time_seconds"]),
+            "--connect-timeout", str(options["curl_connect_timeout_seconds"]),
+            "--max-time", str(options["curl_max_time_seconds"]),
+            "--speed-time", str(options["curl_speed_time_seconds"]),
+            "--speed-limit", str(options["curl_speed_limit_bytes_per_sec"]),
+            "-sS", # No progress meter (see logpipeline.ProgressTracker), but errors
+            "-o", output_path, url
+        ]
+        if piped:
+            # An explicit offset, since curl can't look at the size of a pipe
+            cmd[2:4] = ["-C", str(offset)]
+            cmd[-3:-1] = ["-o", "-"]
+            # A curl retry would send that offset again and the pipe would carry the bytes
+            # already written a second time; the next attempt resumes from the file instead
+            cmd[4:6] = ["--retry", "0"]
+        if_range = options.get("if_range") if offset > 0 else None
+        if if_range:
+            # A changed object comes back whole (200), which curl refuses to append (exit 33)
+            cmd[-1:-1] = ["-H", f"If-Range: {if_range}"]
+
+        log_message(f"[CURL CMD] For {label}: {' '.join(cmd)}")
+
+        # Timing/status summary printed by curl after the transfer, and the response
+        # headers (for Retry-After), both parsed below. --fail keeps error pages such
+        # as a 429/503 body out of the output file and makes them count as failures.
+        header_path = f"{output_path}.headers"
+        write_out_format = f"\n{_WRITE_OUT_MARKER} %{{http_code}} %{{time_connect}} %{{time_starttransfer}} %{{size_download}} %{{url_effective}}\n"
+        if piped:
+            write_out_format = "%{stderr}" + write_out_format # stdout carries the body
+        cmd[-1:-1] = ["--fail", "-D", header_path, "-w", write_out_format]
+
+        digest = None
+        if piped:
+            process = self._start(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            write_out = []
+            log_thread = threading.Thread(target=self._log_output, args=(process.stderr, label, write_out), daemon=True)
+            log_thread.start()
+            hasher = new_hasher(algorithm) if algorithm else None
+            if hasher and offset > 0:
+                update_from_file(hasher, output_path, offset)
+            f = None
+            try:
+                while True:
+                    chunk = process.stdout.read1(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if f is None:
+                        # Opened on the first byte, so a failed request leaves no empty file behind
+                        f = open(output_path, "ab" if offset > 0 else "wb")
+                    f.write(chunk)
+                    if hasher:
+                        hasher.update(chunk)
+                    if self.governor:
+                        self.governor.consume(host, len(chunk))
+            finally:
+                if f is not None:
+                    f.close()
+                process.stdout.close()
+                process.wait()
+                self._finished(process)
+                log_thread.join()
+            digest = hasher.hexdigest() if hasher else None
+        else:
+            process = self._start(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, text=True)
+            write_out = []
+            self._log_output(process.stdout, label, write_out)
+            process.wait() # Wait for curl to complete
+            self._finished(process)
+
+        result = attempt_result(process.returncode, elapsed=time.time() - start)
+        if len(write_out) >= 4:
+            try:
+                result["http_status"] = int(write_out[0]) or None
+                result["connect_time"] = float(write_out[1])
+                result["ttfb"] = float(write_out[2])
+                result["bytes"] = int(float(write_out[3]))
+                result["effective_url"] = write_out[4] if len(write_out) > 4 else url
+            except ValueError:
+                pass
+        content_range = None
+        if os.path.exists(header_path):
+            try:
+                with open(header_path, 'r', errors="replace") as f:
+                    # Only the last response's headers matter (earlier blocks are redirects/retries)
+                    last_block = f.read().replace("\r\n", "\n").strip().split("\n\n")[-1]
+                for line in last_block.split("\n"):
+                    if line.lower().startswith("retry-after:"):
+                        result["retry_after"] = parse_retry_after(line.split(":", 1)[1])
+                    elif line.lower().startswith("content-range:"):
+                        content_range = line.split(":", 1)[1]
+                    elif line.lower().startswith("etag:"):
+                        result["etag"] = line.split(":", 1)[1].strip()
+                    elif line.lower().startswith("last-modified:"):
+                        result["last_modified"] = line.split(":", 1)[1].strip()
+            finally:
+                os.remove(header_path)
+        if result["returncode"] == CURL_HTTP_RETURNED_ERROR and result["http_status"] == 416 \
+                and offset > 0 and content_range_total(content_range) == offset:
+            # Resuming a file that is already complete: with --fail curl reports the 416 as an error
+            result["returncode"] = CURL_OK
+            if algorithm:
+                digest = file_digest(output_path, algorithm)
+        if result["returncode"] == CURL_HTTP_RETURNED_ERROR and result["http_status"]:
+            result["error"] = f"The requested URL returned error: {result['http_status']}"
+        elif result["returncode"] == CURL_RANGE_ERROR and if_range and os.path.exists(output_path):
+            os.remove(output_path)
+            result["error"] = "Object changed since the partial file was written (If-Range), partial discarded"
+        elif result["returncode"] < 0 and self.aborted:
+            result["error"] = "Aborted: the job is ending"
+        if result["returncode"] == CURL_OK:
+            result["digest"] = digest
+        return result
+
+    @staticmethod
+    def _log_output(stream, label, write_out):
+        """Log curl's error output line by line; the fields of the -w summary line are appended to write_out"""
+        for line in iter(stream.readline, '' if isinstance(stream, io.TextIOBase) else b''):
+            if isinstance(line, bytes):
+                line = line.decode(errors="replace")
+            if line.startswith(_WRITE_OUT_MARKER):
+                write_out.extend(line.split()[1:])
+                continue
+            if line.strip():
+                log_message(f"  {label} (curl): {line.strip()}", level="WARNING")
+
+    def _curl_base_args(self, options):
+        return [
+            "--connect-timeout", str(options["curl_connect_timeout_seconds"]),
+            "--max-time", str(options["curl_max_time_seconds"]),
+            "--speed-time", str(options["curl_speed_time_seconds"]),
+            "--speed-limit", str(options["curl_speed_limit_bytes_per_sec"]),
+        ]
+
+    def probe(self, url, options, headers=None):
+        """
+        Return size/range/validator information for url using curl -I (falling back to a 0-0 range GET).
+        headers are extra request headers, e.g. conditional_headers() to revalidate a copy.
+        """
+        header_args = [arg for name, value in (headers or {}).items() for arg in ("-H", f"{name}: {value}")]
+        for extra in (["-I"], ["-r", "0-0", "-o", os.devnull, "-D", "-"]):
+            cmd = ["curl", "-sS", "-L", "--connect-timeout", str(options["curl_connect_timeout_seconds"]),
+                   "--max-time", str(options["curl_connect_timeout_seconds"] * 2)] + header_args + extra + [url]
+            process = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            if process.returncode != 0:
+                return probe_result(process.returncode, error=process.stderr.strip(), effective_url=url)
+            # With -L curl prints one header block per hop; the last one is the final response
+            blocks = [b for b in process.stdout.replace("\r\n", "\n").split("\n\n") if b.startswith("HTTP/")]
+            if not blocks:
+                return probe_result(CURL_RECV_ERROR, error="No HTTP response headers", effective_url=url)
+            lines = blocks[-1].split("\n")
+            status = int(lines[0].split()[1])
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    key, value = line.split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+            if status < 400:
+                return probe_from_headers(status, lambda name: headers.get(name.lower()), url)
+        return probe_result(CURL_HTTP_RETURNED_ERROR, status, effective_url=url,
+                            error=f"The requested URL returned error: {status}")
+
+    def fetch_range(self, url, fd, start, end, options, on_progress=None):
+        """
+        Fetch bytes start..end (inclusive) of url with curl -r and write them at their offsets in fd.
+        on_progress(n, chunk) is called after each chunk is written.
+        """
+        t0 = time.time()
+        expected = end - start + 1
+        host = url_host(url)
+        cmd = ["curl", "-sS", "-L", "--fail", "-r", f"{start}-{end}"] + self._curl_base_args(options) + ["-o", "-", url]
+        process = self._start(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        written = 0
+        returncode = None
+        error = None
+        try:
+            while True:
+                chunk = process.stdout.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if written + len(chunk) > expected:
+                    # Server ignored the range and is sending the whole object
+                    process.kill()
+                    returncode, error = CURL_RANGE_ERROR, "Server ignored the byte range request"
+                    break
+                os.pwrite(fd, chunk, start + written)
+                written += len(chunk)
+                if on_progress:
+                    on_progress(len(chunk), chunk)
+                if self.governor:
+                    self.governor.consume(host, len(chunk))
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read().decode(errors="replace").strip()
+            process.stderr.close()
+            process.wait()
+            self._finished(process)
+        if returncode is None:
+            returncode = process.returncode
+            if returncode == 0 and written < expected:
+                returncode, error = CURL_PARTIAL_FILE, f"Range closed with {expected - written} bytes remaining"
+            elif returncode != 0:
+                error = stderr or f"curl exit code {returncode}"
+        return attempt_result(returncode, bytes_downloaded=written, elapsed=time.time() - t0, error=error, effective_url=url)
+
+    def close(self):
+        pass
+
+
+class _TransferError(Exception):
+    """Raised inside HttpTransport with the curl-style exit code to report"""
+
+    def __init__(self, returncode, message, http_status=None, retry_after=None):
+        super().__init__(message)
+        self.returncode = returncode
+        self.http_status = http_status
+        self.retry_after = retry_after
+        self.etag = None          # Validators of a response whose body was cut short
+        self.last_modified = None
+
+
+class HttpTransport:
+    """
+    In-process HTTP/1.1 client built on http.client.
+    Keeps idle keep-alive connections per (scheme, host, port) and reuses them
+    across attempts and files, so repeated downloads from the same host skip
+    the TCP/TLS handshake and no subprocess is spawned.
+    """
+
+    name = "http"
+
+    def __init__(self, max_idle_connections_per_host=4, governor=None):
+        self.max_idle_connections_per_host = max_idle_connections_per_host
+        self.governor = governor # bandwidth.BandwidthGovernor or None
+        self.aborted = False
+        self._idle = {} # (scheme, host, port) -> [HTTPConnection, ...]
+        self._lock = threading.Lock()
+
+    def abort(self):
+        """End every running transfer at its next chunk (what was written stays on disk) and refuse new ones"""
+        self.aborted = True
+
+    # ---- connection pool ----
+
+    def _acquire(self, scheme, host, port, connect_timeout):
+        """Return (connection, reused) for the given origin"""
+        key = (scheme, host, port)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=connect_timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=connect_timeout)
+        return conn, False
+
+    def _release(self, scheme, host, port, conn, reusable):
+        if not reusable:
+            conn.close()
+            return
+        key = (scheme, host, port)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_connections_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            pools, self._idle = self._idle, {}
+        for idle in pools.values():
+            for conn in idle:
+                conn.close()
+
+    # ---- requests ----
+
+    def _request(self, method, url, headers, options, deadline):
+        """
+        Send a request, following redirects like curl -L.
+        Returns (response, conn, origin, effective_url, connect_time, ttfb).
+        The caller must read the body and hand the connection back via _release.
+        """
+        connect_timeout = options["curl_connect_timeout_seconds"]
+        start = time.time()
+        connect_time = None
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            scheme = parsed.scheme.lower()
+            if scheme not in ("http", "https"):
+                raise _TransferError(1, f"Unsupported URL scheme '{parsed.scheme}'")
+            port = parsed.port or (443 if scheme == "https" else 80)
+            origin = (scheme, parsed.hostname, port)
+            path = parsed.path or "/"
+            if parsed.query:
+                path += "?" + parsed.query
+            request_headers = {"User-Agent": USER_AGENT, "Accept": "*/*", "Connection": "keep-alive"}
+            request_headers.update(headers)
+
+            # A pooled connection may have been closed by the server while idle;
+            # retry once on a fresh connection in that case.
+            for _attempt in range(2):
+                conn, reused = self._acquire(*origin, connect_timeout)
+                try:
+                    if conn.sock is None:
+                        conn.timeout = min(connect_timeout, max(0.1, deadline - time.time()))
+                        conn.connect()
+                        if connect_time is None:
+                            connect_time = time.time() - start
+                    elif connect_time is None:
+                        connect_time = 0.0
+                    conn.sock.settimeout(self._read_timeout(options, deadline))
+                    conn.request(method, path, headers=request_headers)
+                    response = conn.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                    conn.close()
+                    if reused:
+                        continue
+                    raise _TransferError(CURL_RECV_ERROR, f"Connection dropped: {e}")
+                except http.client.HTTPException as e:
+                    conn.close()
+                    raise _TransferError(CURL_RECV_ERROR, f"Protocol error from {parsed.hostname}: {e!r}")
+                except socket.gaierror as e:
+                    conn.close()
+                    raise _TransferError(CURL_COULDNT_RESOLVE_HOST, f"Could not resolve host {parsed.hostname}: {e}")
+                except socket.timeout as e:
+                    conn.close()
+                    raise _TransferError(CURL_OPERATION_TIMEDOUT, f"Timed out talking to {parsed.hostname}: {e}")
+                except OSError as e:
+                    conn.close()
+                    raise _TransferError(CURL_COULDNT_CONNECT, f"Failed to connect to {parsed.hostname}: {e}")
+            else:
+                raise _TransferError(CURL_RECV_ERROR, f"Connection to {parsed.hostname} dropped on reuse")
+
+            ttfb = time.time() - start
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                response.read()
+                self._release(*origin, conn, not response.will_close)
+                url = urljoin(url, response.getheader("Location"))
+                if response.status == 303:
+                    method = "GET" if method != "HEAD" else method
+                continue
+            return response, conn, origin, url, connect_time, ttfb
+        raise _TransferError(CURL_TOO_MANY_REDIRECTS, f"More than {MAX_REDIRECTS} redirects")
+
+    @staticmethod
+    def _read_timeout(options, deadline):
+        # A read that stalls for the whole speed-time window is below any speed limit
+        remaining = max(0.1, deadline - time.time())
+        speed_time = options.get("curl_speed_time_seconds") or remaining
+        return min(remaining, max(1.0, speed_time))
+
+    def _stream_body(self, response, write, options, deadline):
+        """Pass the response body to write(chunk), enforcing --max-time and --speed-limit/--speed-time"""
+        speed_limit = options.get("curl_speed_limit_bytes_per_sec") or 0
+        speed_time = options.get("curl_speed_time_seconds") or 0
+        written = 0
+        window_start = time.time()
+        window_bytes = 0
+        while True:
+            if self.aborted:
+                raise _TransferError(CURL_ABORTED_BY_CALLBACK, f"Aborted: the job is ending, {written} bytes received")
+            if time.time() > deadline:
+                raise _TransferError(CURL_OPERATION_TIMEDOUT, f"Operation timed out after {options['curl_max_time_seconds']}s with {written} bytes received")
+            try:
+                # read(amt) (unlike read1) marks the response closed at the end of the body,
+                # which http.client requires before the connection can carry another request
+                chunk = response.read(CHUNK_SIZE)
+            except socket.timeout:
+                raise _TransferError(CURL_OPERATION_TIMEDOUT, f"Read stalled with {written} bytes received")
+            except (http.client.IncompleteRead, ConnectionError, OSError) as e:
+                raise _TransferError(CURL_RECV_ERROR, f"Failure receiving data after {written} bytes: {e}")
+            if not chunk:
+                break
+            try:
+                write(chunk)
+            except OSError as e:
+                raise _TransferError(CURL_WRITE_ERROR, f"Failed writing body: {e}")
+            written += len(chunk)
+            window_bytes += len(chunk)
+
+            now = time.time()
+            if speed_limit and speed_time and now - window_start >= speed_time:
+                if window_bytes / (now - window_start) < speed_limit:
+                    raise _TransferError(CURL_OPERATION_TIMEDOUT, f"Speed below {speed_limit} bytes/sec for {speed_time}s")
+                window_start, window_bytes = now, 0
+
+        expected = response.getheader("Content-Length")
+        if expected is not None and expected.isdigit() and written < int(expected):
+            raise _TransferError(CURL_PARTIAL_FILE, f"Transfer closed with {int(expected) - written} bytes remaining")
+        return written
+
+    def _fetch_once(self, url, output_path, options, deadline):
+        algorithm = options.get("digest_algorithm")
+        offset = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+        if offset > 0 and options.get("if_range"):
+            # A changed object comes back whole (200) and replaces the partial file
+            headers["If-Range"] = options["if_range"]
+        start = time.time()
+        response, conn, origin, effective_url, connect_time, ttfb = self._request("GET", url, headers, options, deadline)
+        reusable = False
+        try:
+            status = response.status
+            if status == 416 and offset > 0:
+                # Nothing left to fetch if the server's size equals what we already have
+                response.read()
+                reusable = not response.will_close
+                if content_range_total(response.getheader("Content-Range")) == offset:
+                    digest = file_digest(output_path, algorithm) if algorithm else None
+                    return attempt_result(CURL_OK, status, 0, time.time() - start, connect_time, ttfb,
+                                          effective_url=effective_url, digest=digest)
+                # The remote object is smaller than our partial file; start over
+                os.remove(output_path)
+                raise _TransferError(CURL_PARTIAL_FILE, "Range not satisfiable, local partial discarded", http_status=status)
+
+            if status >= 400:
+                response.read()
+                reusable = not response.will_close
+                raise _TransferError(CURL_HTTP_RETURNED_ERROR, f"The requested URL returned error: {status}",
+                                     http_status=status, retry_after=parse_retry_after(response.getheader("Retry-After")))
+
+            if status == 206 and offset > 0:
+                mode = "ab"
+            else:
+                # 200 to a ranged request means the server ignored Range; rewrite from the start
+                mode = "wb"
+            hasher = None
+            if algorithm:
+                # Hash what is already on disk, then every chunk as it is written
+                hasher = new_hasher(algorithm)
+                if mode == "ab":
+                    update_from_file(hasher, output_path, offset)
+            host = url_host(url)
+            with open(output_path, mode) as f:
+                def write(chunk):
+                    f.write(chunk)
+                    if hasher:
+                        hasher.update(chunk)
+                    if self.governor:
+                        self.governor.consume(host, len(chunk))
+                try:
+                    written = self._stream_body(response, write, options, deadline)
+                except _TransferError as e:
+                    # What was written is resumable; keep the validators it must be resumed against
+                    e.etag, e.last_modified = response.getheader("ETag"), response.getheader("Last-Modified")
+                    raise
+            reusable = not response.will_close
+            return attempt_result(CURL_OK, status, written, time.time() - start, connect_time, ttfb,
+                                  effective_url=effective_url, digest=hasher.hexdigest() if hasher else None,
+                                  etag=response.getheader("ETag"), last_modified=response.getheader("Last-Modified"))
+        finally:
+            self._release(*origin, conn, reusable)
+
+    def probe(self, url, options, headers=None):
+        """
+        Return size/range/validator information for url with HEAD (falling back to a 0-0 range GET).
+        headers are extra request headers, e.g. conditional_headers() to revalidate a copy.
+        """
+        deadline = time.time() + options["curl_connect_timeout_seconds"] * 2
+        for method, method_headers in (("HEAD", {}), ("GET", {"Range": "bytes=0-0"})):
+            try:
+                response, conn, origin, effective_url, _, _ = self._request(method, url, dict(headers or {}, **method_headers),
+                                                                            options, deadline)
+            except _TransferError as e:
+                return probe_result(e.returncode, e.http_status, effective_url=url, error=str(e))
+            try:
+                response.read()
+            finally:
+                self._release(*origin, conn, not response.will_close)
+            if response.status < 400:
+                return probe_from_headers(response.status, response.getheader, effective_url)
+        return probe_result(CURL_HTTP_RETURNED_ERROR, response.status, effective_url=effective_url,
+                            error=f"The requested URL returned error: {response.status}")
+
+    def fetch_range(self, url, fd, start, end, options, on_progress=None):
+        """
+        Fetch bytes start..end (inclusive) of url over a pooled connection and write them at their offsets in fd.
+        on_progress(n, chunk) is called after each chunk is written.
+        """
+        t0 = time.time()
+        deadline = t0 + options["curl_max_time_seconds"]
+        written = 0
+        host = url_host(url)
+
+        def write(chunk):
+            nonlocal written
+            if written + len(chunk) > end - start + 1:
+                raise _TransferError(CURL_RANGE_ERROR, "Server sent more bytes than the requested range")
+            os.pwrite(fd, chunk, start + written)
+            written += len(chunk)
+            if on_progress:
+                on_progress(len(chunk), chunk)
+            if self.governor:
+                self.governor.consume(host, len(chunk))
+
+        origin = conn = None
+        reusable = False
+        try:
+            response, conn, origin, effective_url, connect_time, ttfb = self._request(
+                "GET", url, {"Range": f"bytes={start}-{end}"}, options, deadline)
+            if response.status >= 400:
+                response.read()
+                reusable = not response.will_close
+                raise _TransferError(CURL_HTTP_RETURNED_ERROR, f"The requested URL returned error: {response.status}",
+                                     http_status=response.status, retry_after=parse_retry_after(response.getheader("Retry-After")))
+            content_range = response.getheader("Content-Range") or ""
+            if response.status != 206 or not content_range.startswith(f"bytes {start}-"):
+                raise _TransferError(CURL_RANGE_ERROR, "Server ignored the byte range request", http_status=response.status)
+            self._stream_body(response, write, options, deadline)
+            reusable = not response.will_close
+            return attempt_result(CURL_OK, response.status, written, time.time() - t0, connect_time, ttfb, effective_url=effective_url)
+        except _TransferError as e:
+            return attempt_result(e.returncode, e.http_status, written, time.time() - t0,
+                                  error=str(e), retry_after=e.retry_after, effective_url=url)
+        finally:
+            if conn is not None:
+                self._release(*origin, conn, reusable)
+
+    def fetch(self, url, output_path, label, options):
+        """
+        Download url into output_path, resuming from the existing file size with Range
+        (and If-Range, when options["if_range"] holds the partial file's validator).
+        Transient failures are retried in-process the way curl --retry does.
+        """
+        start = time.time()
+        deadline = start + options["curl_max_time_seconds"]
+        retry_attempts = options.get("curl_retry_attempts", 0)
+        retry_delay = options.get("curl_retry_delay_seconds", 0)
+        retry_max_time = options.get("curl_retry_max_time_seconds", 0)
+        backoff = 1.0 # curl doubles from 1s when no fixed --retry-delay is given
+
+        attempt = 0
+        while True:
+            try:
+                result = self._fetch_once(url, output_path, options, deadline)
+                result["elapsed"] = time.time() - start
+                return result
+            except _TransferError as e:
+                failure = attempt_result(e.returncode, e.http_status, elapsed=time.time() - start,
+                                         error=str(e), retry_after=e.retry_after, effective_url=url,
+                                         etag=e.etag, last_modified=e.last_modified)
+
+            transient = failure["returncode"] in (CURL_OPERATION_TIMEDOUT, CURL_RECV_ERROR, CURL_PARTIAL_FILE, CURL_COULDNT_CONNECT) \
+                or failure["http_status"] in TRANSIENT_HTTP_STATUSES
+            if not transient or attempt >= retry_attempts or self.aborted:
+                break
+            wait = retry_delay if retry_delay else backoff
+            if failure["retry_after"] is not None:
+                wait = max(wait, failure["retry_after"])
+            if retry_max_time and time.time() + wait - start > retry_max_time:
+                break
+            if time.time() + wait >= deadline:
+                break
+            attempt += 1
+            log_message(f"  {label} (http): {failure['error']}. Will retry in {wait:.0f}s. {retry_attempts - attempt + 1} retries left.")
+            time.sleep(wait)
+            backoff = min(backoff * 2, 600)
+
+        log_message(f"  {label} (http): {failure['error']}")
+        return failure
+
+
+def get_transport(backend, max_idle_connections_per_host=4, governor=None):
+    """
+    Return the transport instance for the configured download_backend ("curl" or "http").
+    governor (see bandwidth.BandwidthGovernor) throttles every download it makes.
+    """
+    backend = (backend or "curl").lower()
+    if backend == "curl":
+        return CurlTransport(governor=governor)
+    if backend == "http":
+        return HttpTransport(max_idle_connections_per_host=max_idle_connections_per_host, governor=governor)
+    raise ValueError(f"Unknown download_backend '{backend}' (expected 'curl' or 'http')")
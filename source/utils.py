@@ -1,7 +1,10 @@
 import os
 import sys
+import glob
+import gzip
+import time
 from urllib.parse import urlparse
-from datetime import datetime
+from .logpipeline import log
 
 
 def load_config(config_dict_from_file): # Renamed input to avoid confusion
@@ -22,61 +25,248 @@ def load_config(config_dict_from_file): # Renamed input to avoid confusion
     # Return the full config, download_dir, and the derived state_dir
     return config_dict_from_file, download_dir, state_dir
 
-def download_file_handler(links_file_path):
-    links = []
+# Digest algorithms accepted in the links file and checksum manifests
+SUPPORTED_ALGORITHMS = ("sha256", "md5")
+
+
+def expectation(size=None, algorithm=None, digest=None):
+    """Expected size and/or digest of one download (any of them may be None)"""
+    return {"size": size, "algorithm": algorithm, "digest": digest.lower() if digest else None}
+
+
+def parse_links_line(line):
+    """
+    Split one links file line into (url, expectation or None, mirrors).
+    A line is a URL optionally followed by "size=<bytes>" and "sha256=<hex>"
+    or "md5=<hex>" tokens and by alternative URLs of the same object on other
+    mirrors, separated by whitespace. The first URL names the file and keys
+    its state; mirrors is a (possibly empty) list of the others.
+    """
+    tokens = line.split()
+    url = tokens[0]
+    size = algorithm = digest = None
+    mirrors = []
+    for token in tokens[1:]:
+        key, _, value = token.partition("=")
+        key = key.lower()
+        if "://" in key: # A URL (which may itself contain "=" in its query)
+            if token != url and token not in mirrors:
+                mirrors.append(token)
+        elif key == "size" and value.isdigit():
+            size = int(value)
+        elif key in SUPPORTED_ALGORITHMS and value:
+            algorithm, digest = key, value
+        else:
+            log_message(f"Warning: ignoring unknown token '{token}' for {url} in links file")
+    if size is None and digest is None:
+        return url, None, mirrors
+    return url, expectation(size, algorithm, digest), mirrors
+
+
+def iter_links_files(links_file_paths):
+    """
+    Yield (url, expectation or None, mirrors) for every line of the links files, reading
+    them lazily one after the other. links_file_paths is a path or a list of
+    paths, each of which may be a glob pattern; files ending in .gz are
+    decompressed on the fly.
+    """
+    if isinstance(links_file_paths, str):
+        links_file_paths = [links_file_paths]
+    for pattern in links_file_paths:
+        paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if not paths:
+            raise FileNotFoundError(f"No links files match '{pattern}'")
+        for path in paths:
+            opener = gzip.open if path.endswith(".gz") else open
+            with opener(path, 'rt') as f:
+                for line in f:
+                    line = line.strip() # Remove whitespace; skip empty lines
+                    if line:
+                        yield parse_links_line(line)
+
+
+class LinkIndex:
+    """
+    The deduplicated manifest: unique URLs in file order, their expectations,
+    mirrors and local filenames, built in one streaming pass over the links files.
+    Reading is streamed, but the index itself is O(N) in memory: every unique
+    URL is kept (once; the seen set refers to the same strings), and the
+    filenames are held in a set while it is built.
+
+    Filenames are the last part of the URL path. URLs without one are named
+    file_<n>.download after the position of their first line, as before. When
+    two different URLs would end up with the same filename, the later one gets
+    a numbered name (data.nc -> data_1.nc) instead of overwriting the first.
+    Only those renamed URLs are stored, so looking up a filename is O(1).
+    """
+
+    def __init__(self, entries):
+        self.urls = [] # unique URLs in first-seen order
+        self.expectations = {}
+        self.mirrors = {} # url -> alternative URLs of the same object, only for URLs that have them
+        self.duplicates = 0
+        self.renamed = 0
+        self._names = {} # url -> filename, only where it differs from the URL's basename
+        self._seen = set()
+        taken = set()
+        for position, (url, expected, mirrors) in enumerate(entries):
+            if mirrors:
+                known = self.mirrors.setdefault(url, [])
+                known.extend(mirror for mirror in mirrors if mirror not in known)
+            if url in self._seen:
+                self.duplicates += 1
+                if expected and url not in self.expectations:
+                    self.expectations[url] = expected
+                continue
+            self._seen.add(url)
+            self.urls.append(url)
+            if expected:
+                self.expectations[url] = expected
+            filename = os.path.basename(urlparse(url).path) or f"file_{position}.download"
+            if filename in taken:
+                stem, ext = os.path.splitext(filename)
+                number = 1
+                while f"{stem}_{number}{ext}" in taken:
+                    number += 1
+                filename = f"{stem}_{number}{ext}"
+                self.renamed += 1
+            taken.add(filename)
+            if filename != os.path.basename(urlparse(url).path):
+                self._names[url] = filename
+
+    @classmethod
+    def from_urls(cls, urls):
+        return cls((url, None, ()) for url in urls)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def __iter__(self):
+        return iter(self.urls)
+
+    def __contains__(self, url):
+        return url in self._seen
+
+    def filename(self, url):
+        """Local filename for url"""
+        filename = self._names.get(url)
+        if filename is None:
+            filename = os.path.basename(urlparse(url).path)
+            if not filename: # Not in the manifest (should not happen)
+                filename = f"file_unknown_{int(time.time())}.download"
+        return filename
+
 
+def download_file_handler(links_file_path):
+    """
+    Read the links file(s) (see iter_links_files). Returns (links, expectations):
+    a LinkIndex of the unique URLs in file order and a dict of url -> expected
+    size/digest for lines that carry them.
+    """
     try:
-        with open(links_file_path, 'r') as f:
-            links = [line.strip() for line in f if line.strip()] # Read lines and remove whitespace/empty lines
-        if not links:
-            log_message(f"No links found in {links_file_path}. Exiting.")
-            exit()
-        log_message(f"Loaded {len(links)} URLs from {links_file_path}")
-    except FileNotFoundError:
-        log_message(f"Error: Links file '{links_file_path}' not found. Exiting.")
+        links = LinkIndex(iter_links_files(links_file_path))
+    except FileNotFoundError as e:
+        log_message(f"Error: Links file not found: {e}. Exiting.")
         exit(1)
     except Exception as e:
         log_message(f"Error reading links file '{links_file_path}': {e}. Exiting.")
         exit(1)
 
-    # The rest of your script remains the same
-    if not links: # This check is now somewhat redundant due to earlier checks but good for safety
-        log_message("No links provided. Exiting.")
+    if not links:
+        log_message(f"No links found in {links_file_path}. Exiting.")
         exit()
-    
-    return links
+    log_message(f"Loaded {len(links)} URLs from {links_file_path}")
+    if links.duplicates:
+        log_message(f"Ignored {links.duplicates} duplicate URLs")
+    if links.renamed:
+        log_message(f"Renamed {links.renamed} files whose names collide with another URL's (e.g. data.nc -> data_1.nc)")
+    if links.mirrors:
+        log_message(f"{len(links.mirrors)} URLs have mirrors ({sum(len(m) for m in links.mirrors.values())} alternative URLs)")
+    return links, links.expectations
+
+
+def url_to_filename(url, links_list):
+    """Local filename for url; URLs without a clear filename part are named after their position in links_list"""
+    if isinstance(links_list, LinkIndex):
+        return links_list.filename(url)
+    filename = os.path.basename(urlparse(url).path)
+    if not filename: # Fallback for URLs without a clear filename part
+        try:
+            idx = links_list.index(url) # Use original list for consistent naming
+            filename = f"file_{idx}.download"
+        except ValueError: # Should not happen if links_list is the original list
+            timestamp = int(time.time())
+            filename = f"file_unknown_{timestamp}.download"
+    return filename
+
+
+def log_message(message, level=None, **fields):
+    """
+    Log a message with timestamp. Once the log pipeline is started (see
+    source/logpipeline.py) this only queues the record; level defaults to one
+    derived from the message's [TAG], and fields are extra structured values.
+    """
+    log(message, level, **fields)
+
 
+def format_duration(seconds):
+    """Duration as "01h02m03s", or "2d 01h02m" from a day on"""
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return f"{days}d {hours:02d}h{minutes:02d}m"
+    return f"{hours:02d}h{minutes:02d}m{seconds:02d}s"
 
-def log_message(message):
-    """Log a message with timestamp"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] {message}")
-    sys.stdout.flush()  # Force immediate output
 
+def atomic_write(path, text):
+    """Write text to path through a temporary file and a rename, so readers never see a partial file"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
 
-def verify_downloads(download_dir, links):
-    """Verify all downloads are complete and consistent"""
+
+def verify_downloads(download_dir, links, links_list=None, expectations=None, state_store=None,
+                     suspicious_size_bytes=1024*1024):
+    """
+    Verify all downloads are complete and consistent. links_list is the full manifest used for naming (defaults to links).
+    Files with an expected size must match it exactly; others below suspicious_size_bytes are reported.
+    Expected digests are checked against the digest recorded in state_store when the file was downloaded,
+    so no file is read again here.
+    """
     log_message("Verifying downloaded files...")
-    
-    all_files = []
-    for url in links:
-        filename = os.path.basename(urlparse(url).path)
-        filepath = os.path.join(download_dir, filename)
-        all_files.append((filename, filepath, url))
+    expectations = expectations or {}
     
     missing = []
     zero_size = []
     suspicious_size = []
+    wrong_size = []
+    unverified = []
     
-    for filename, filepath, url in all_files:
-        if not os.path.exists(filepath):
+    for url in links:
+        filename = url_to_filename(url, links_list if links_list is not None else links)
+        filepath = os.path.join(download_dir, filename)
+        try:
+            size = os.stat(filepath).st_size # One stat per file
+        except FileNotFoundError:
             missing.append((filename, url))
-        elif os.path.getsize(filepath) == 0:
+            continue
+        expected = expectations.get(url)
+        if size == 0:
             zero_size.append((filename, url))
-        elif os.path.getsize(filepath) < 1024*1024:  # Less than 1MB may be suspicious for these files
-            suspicious_size.append((filename, os.path.getsize(filepath), url))
+        elif expected and expected["size"] is not None:
+            if size != expected["size"]:
+                wrong_size.append((filename, size, expected["size"], url))
+        elif size < suspicious_size_bytes:  # Small files may be error pages rather than data
+            suspicious_size.append((filename, size, url))
+        if expected and expected["digest"] and state_store is not None:
+            record = state_store.get(url)
+            if not record or record["digest"] != f"{expected['algorithm']}:{expected['digest']}":
+                unverified.append((filename, url))
     
-    if not missing and not zero_size and not suspicious_size:
+    if not missing and not zero_size and not suspicious_size and not wrong_size and not unverified:
         log_message("✓ All files appear to be downloaded correctly")
         return True
     
@@ -91,9 +281,19 @@ def verify_downloads(download_dir, links):
         for filename, url in zero_size:
             log_message(f"    - {filename} ({url})")
     
+    if wrong_size:
+        log_message("  Files with unexpected size:")
+        for filename, size, expected_size, url in wrong_size:
+            log_message(f"    - {filename}: {size} bytes, expected {expected_size} ({url})")
+    
+    if unverified:
+        log_message("  Files without a matching checksum:")
+        for filename, url in unverified:
+            log_message(f"    - {filename} ({url})")
+    
     if suspicious_size:
         log_message("  Suspiciously small files:")
         for filename, size, url in suspicious_size:
             log_message(f"    - {filename}: {size/1024:.2f} KB ({url})")
     
-    return False
\ No newline at end of file
+    return False
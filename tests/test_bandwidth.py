@@ -0,0 +1,78 @@
+import time
+import threading
+from datetime import datetime
+
+from source.bandwidth import TokenBucket, BandwidthGovernor, scheduled_limit
+
+MB = 1024 * 1024
+
+
+def _stream(buckets, total, chunk=64 * 1024):
+    """Push total bytes through each bucket from its own thread; returns the elapsed seconds"""
+    def run(bucket):
+        for _ in range(total // chunk):
+            bucket.consume(chunk)
+    threads = [threading.Thread(target=run, args=(bucket,)) for bucket in buckets]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started
+
+
+def test_debit_refills_up_to_one_burst():
+    tokens, wait = TokenBucket._debit(0.0, time.time() - 100, 150, 100)
+    assert round(tokens) == -50 and round(wait, 1) == 0.5
+    tokens, wait = TokenBucket._debit(0.0, time.time() - 0.5, 10, 100)
+    assert round(tokens) == 40 and wait == 0.0
+
+
+def test_unlimited_bucket_never_waits():
+    assert _stream([TokenBucket(lambda: None)], 64 * MB) < 0.5
+
+
+def test_consumers_share_the_rate():
+    bucket = TokenBucket(lambda: 4 * MB)
+    # Two streams of 1 MB each at 4 MB/s together, starting from an empty bucket
+    assert 0.35 < _stream([bucket, bucket], 1 * MB) < 1.5
+
+
+def test_bucket_file_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "total.bucket")
+    buckets = [TokenBucket(lambda: 4 * MB, path), TokenBucket(lambda: 4 * MB, path)]
+    try:
+        assert 0.35 < _stream(buckets, 1 * MB) < 1.5
+    finally:
+        for bucket in buckets:
+            bucket.close()
+
+
+def test_governor_limits_listed_hosts_only(tmp_path):
+    governor = BandwidthGovernor(host_limits={"Slow.example": 2 * MB}, bucket_dir=str(tmp_path))
+    try:
+        assert governor.current_limit() is None
+        started = time.time()
+        for _ in range(16):
+            governor.consume("fast.example", 64 * 1024)
+        assert time.time() - started < 0.2
+        for _ in range(16):
+            governor.consume("slow.example", 64 * 1024)
+        assert time.time() - started > 0.3
+        assert (tmp_path / "host-slow.example.bucket").exists()
+    finally:
+        governor.close()
+
+
+def test_scheduled_limit():
+    schedule = [{"start": "08:00", "end": "18:00", "days": "mon-fri", "bytes_per_sec": 100},
+                {"start": "22:00", "end": "06:00", "bytes_per_sec": None}]
+    monday, saturday = datetime(2024, 1, 1), datetime(2024, 1, 6)
+    assert scheduled_limit(schedule, 5, monday.replace(hour=9)) == 100
+    assert scheduled_limit(schedule, 5, monday.replace(hour=18)) == 5
+    assert scheduled_limit(schedule, 5, saturday.replace(hour=9)) == 5
+    # A window ending before it starts wraps past midnight
+    assert scheduled_limit(schedule, 5, saturday.replace(hour=23)) is None
+    assert scheduled_limit(schedule, 5, saturday.replace(hour=5, minute=59)) is None
+    assert scheduled_limit([{"start": "20:00", "end": "8:00", "days": ["sat", "sun"], "bytes_per_sec": 1}], 5,
+                           saturday.replace(hour=21)) == 1
@@ -0,0 +1,83 @@
+import os
+
+from source.cache import ContentCache, cache_from_params, is_unchanged, link_or_copy
+
+
+def _probe(**fields):
+    return dict({"returncode": 0, "http_status": 200, "etag": None, "last_modified": None}, **fields)
+
+
+def test_link_or_copy_shares_blocks_on_the_same_filesystem(tmp_path):
+    src = tmp_path / "src"
+    src.write_bytes(b"data")
+    assert link_or_copy(str(src), str(tmp_path / "dst")) == "hardlink"
+    assert (tmp_path / "dst").read_bytes() == b"data"
+
+
+def test_is_unchanged():
+    assert is_unchanged(_probe(http_status=304), '"a"', None)
+    assert is_unchanged(_probe(etag='"a"'), '"a"', None)
+    assert not is_unchanged(_probe(etag='"b"', last_modified="Mon"), '"a"', "Mon")
+    # Last-Modified only counts without an ETag
+    assert is_unchanged(_probe(last_modified="Mon"), None, "Mon")
+    assert not is_unchanged(_probe(), None, None)
+    assert not is_unchanged(_probe(returncode=28, http_status=304), '"a"', None)
+
+
+def test_store_lookup_and_serve(tmp_path):
+    cache = ContentCache(str(tmp_path / "cache"))
+    download = tmp_path / "a.nc"
+    download.write_bytes(b"x" * 100)
+    # Without a validator a hit could never be revalidated
+    assert not cache.store("http://h/a.nc", str(download))
+    assert cache.lookup("http://h/a.nc") is None
+
+    assert cache.store("http://h/a.nc", str(download), etag='"v1"', digest="d")
+    entry = cache.lookup("http://h/a.nc")
+    assert (entry["etag"], entry["size"], entry["digest"]) == ('"v1"', 100, "d")
+    assert cache.lookup("http://h/other.nc") is None
+
+    served = tmp_path / "out" / "a.nc"
+    served.parent.mkdir()
+    assert cache.serve(entry, str(served)) == "hardlink"
+    assert served.read_bytes() == b"x" * 100
+    assert (cache.hits, cache.stores) == (1, 1)
+
+
+def test_new_version_replaces_the_old_data(tmp_path):
+    cache = ContentCache(str(tmp_path / "cache"))
+    download = tmp_path / "a.nc"
+    download.write_bytes(b"old")
+    cache.store("http://h/a.nc", str(download), etag='"v1"')
+    old = cache.lookup("http://h/a.nc")
+    download.unlink() # Downloads linked from the cache are re-created, not modified in place
+    download.write_bytes(b"newer")
+    cache.store("http://h/a.nc", str(download), etag='"v2"')
+    new = cache.lookup("http://h/a.nc")
+    assert new["etag"] == '"v2"' and new["size"] == 5
+    assert not os.path.exists(old["data_path"])
+    # An entry whose data is gone is a miss
+    os.remove(new["data_path"])
+    assert cache.lookup("http://h/a.nc") is None
+    assert cache.serve(new, str(tmp_path / "b.nc")) is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = ContentCache(str(tmp_path / "cache"))
+    for i in range(4):
+        download = tmp_path / f"f{i}"
+        download.write_bytes(b"x" * 100)
+        cache.store(f"http://h/f{i}", str(download), etag=f'"{i}"')
+        meta = os.path.join(*cache._entry_paths(f"http://h/f{i}")) + ".json"
+        os.utime(meta, (1000 + i, 1000 + i))
+    cache.serve(cache.lookup("http://h/f0"), str(tmp_path / "served")) # f0 becomes the most recent
+    cache.max_bytes = 250
+    assert cache.evict() == 2
+    assert [cache.lookup(f"http://h/f{i}") is not None for i in range(4)] == [True, False, False, True]
+    assert cache.evict() == 0
+
+
+def test_cache_from_params(tmp_path):
+    assert cache_from_params({"cache_dir": None}) is None
+    cache = cache_from_params({"cache_dir": str(tmp_path / "cache"), "cache_max_bytes": 10})
+    assert cache.max_bytes == 10 and os.path.isdir(cache.objects_dir)
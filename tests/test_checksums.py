@@ -0,0 +1,52 @@
+import hashlib
+
+from source.checksums import load_checksum_manifest, check_download, verify_existing_downloads, format_digest
+from source.state import StateStore, STATUS_COMPLETED, STATUS_PENDING
+from source.utils import expectation
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_manifest_algorithm_follows_from_digest_length(tmp_path):
+    manifest = tmp_path / "SHA256SUMS"
+    manifest.write_text(f"# comment\n{'A' * 64}  sub/a.nc\n{'b' * 32} *b.nc\nnot-a-digest c.nc\n")
+    assert load_checksum_manifest(str(manifest)) == {"a.nc": expectation(algorithm="sha256", digest="a" * 64),
+                                                     "b.nc": expectation(algorithm="md5", digest="b" * 32)}
+
+
+def test_check_download(tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(b"hello")
+    good = expectation(5, "sha256", _sha256(b"hello"))
+    assert check_download(str(path), None, 5) == (None, None)
+    assert check_download(str(path), good, 5) == (None, _sha256(b"hello"))
+    assert check_download(str(path), good, 4)[0].startswith("Size mismatch")
+    # A digest computed while streaming is trusted instead of reading the file again
+    assert check_download(str(path), good, 5, "0" * 64)[0].startswith("Checksum mismatch")
+
+
+def test_existing_files_are_verified_adopted_or_redownloaded(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    files = {"ok": b"fine", "copied": b"copied in", "bad": b"corrupt", "partial": b"par", "missing": None}
+    expectations = {}
+    for name, data in files.items():
+        full = data or b"x"
+        expectations[name] = expectation(len(full) if name != "partial" else 10, "sha256", _sha256(full))
+        if data is not None:
+            (tmp_path / name).write_bytes(data)
+    expectations["bad"] = expectation(7, "sha256", _sha256(b"correct"))
+    for name in ("ok", "bad", "missing"):
+        store.set_status(name, STATUS_COMPLETED, bytes_done=len(files[name] or b""))
+    # Verified at download time: the recorded digest spares the hash
+    store.update("ok", digest=format_digest("sha256", expectations["ok"]["digest"]))
+
+    redownload = verify_existing_downloads(store, str(tmp_path), list(files), lambda url: url, expectations, processes=1)
+    assert redownload == 2
+    assert store.get_status("copied") == STATUS_COMPLETED
+    assert store.get_status("ok") == STATUS_COMPLETED
+    assert store.get_status("bad") == STATUS_PENDING and not (tmp_path / "bad").exists()
+    assert store.get_status("missing") == STATUS_PENDING
+    # A smaller file is a partial download to resume
+    assert (tmp_path / "partial").exists() and store.get("partial") is None
@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import subprocess
+
+import pytest
+
+from benchmarks.server import BenchmarkServer, expected_content_digest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAULTS = {"disconnect_probability": 0.1, "unavailable_probability": 0.05, "throttle_probability": 0.05,
+          "retry_after_seconds": 0, "seed": 1}
+# Run hpc_downloader.py as a job would, with configs.config overridden
+BOOTSTRAP = """
+import sys, json, runpy
+sys.path.insert(0, sys.argv[1])
+import configs
+configs.config.update(json.loads(sys.argv[2]))
+runpy.run_path(sys.argv[1] + "/hpc_downloader.py", run_name="__main__")
+"""
+
+
+def _run(tmp_path, config):
+    process = subprocess.run([sys.executable, "-c", BOOTSTRAP, REPO_ROOT, json.dumps(config)], cwd=tmp_path,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=300)
+    return process.stdout
+
+
+@pytest.mark.parametrize("backend", ["http"] + (["curl"] if shutil.which("curl") else []))
+def test_run_against_a_faulty_server_completes_and_downloads_nothing_twice(tmp_path, backend):
+    server = BenchmarkServer(FAULTS).start()
+    try:
+        paths = [f"/e2e/small{i}_{20000 + i}.bin" for i in range(30)] + [f"/e2e/large{i}_{3000000 + i}.bin" for i in range(2)]
+        lines = []
+        for path in paths:
+            size = int(path.rsplit("_", 1)[1].split(".")[0])
+            lines.append(f"{server.base_url}{path} size={size} sha256={expected_content_digest(path)}")
+        (tmp_path / "links.txt").write_text("\n".join(lines) + "\n")
+        download_dir = tmp_path / "downloads"
+        config = {"download_dir": str(download_dir), "links_file_path": str(tmp_path / "links.txt"),
+                  "download_backend": backend, "max_concurrent_downloads": 4,
+                  "segments_per_file": 4, "segmented_min_size_bytes": 1000000, "segment_retry_delay_seconds": 0,
+                  "downloader_max_retries": 10, "downloader_initial_retry_delay_seconds": 0,
+                  "curl_retry_attempts": 0, "curl_connect_timeout_seconds": 5, "curl_max_time_seconds": 60,
+                  "progress_interval_seconds": 0}
+        output = _run(tmp_path, config)
+        for path in paths:
+            name = path.rsplit("/", 1)[1]
+            with open(download_dir / name, 'rb') as f:
+                assert hashlib.sha256(f.read()).hexdigest() == expected_content_digest(path), output[-3000:]
+        assert "[FAILED ATTEMPT]" in output # The faults did hit
+        assert "[SEGMENTED]" in output
+
+        # Everything is in the journal now, so a second run downloads nothing
+        output = _run(tmp_path, config)
+        assert "[STARTED]" not in output, output[-3000:]
+        assert output.count("[SKIPPED]") == len(paths)
+    finally:
+        server.stop()
@@ -0,0 +1,59 @@
+import time
+import signal
+
+from source.jobcontrol import JobControl, job_end_time
+
+
+def test_job_end_time_from_the_environment():
+    assert job_end_time({"SLURM_JOB_END_TIME": "1700000000"}) == 1700000000.0
+    assert job_end_time({}) is None
+
+
+def test_no_time_limit_never_stops():
+    control = JobControl()
+    assert not control.stopping and not control.aborted
+    assert control.can_finish(10**12)
+    assert "no time limit" in control.describe()
+
+
+def test_stop_and_abort_margins():
+    control = JobControl(end_time=time.time() + 200, stop_margin_seconds=300, abort_margin_seconds=60)
+    aborts = []
+    control.on_abort(lambda: aborts.append(1))
+    assert control.stopping and not control.can_finish(1)
+    assert not control.aborted and aborts == []
+
+    control.end_time = time.time() + 30
+    control._check()
+    assert control.aborted and aborts == [1]
+    control._check()
+    assert aborts == [1] # Only once
+    # A transport registered after the abort is aborted right away
+    control.on_abort(lambda: aborts.append(2))
+    assert aborts == [1, 2]
+
+
+def test_signals():
+    control = JobControl(signal_lead_seconds=120)
+    control._on_signal(signal.SIGUSR1, None)
+    assert control.stopping and control.reason == "received SIGUSR1"
+    # SIGUSR1 arrives signal_lead_seconds before the end
+    assert 110 < control.time_left() <= 120
+    assert not control.aborted
+
+    control = JobControl(end_time=time.time() + 3600)
+    control._on_signal(signal.SIGTERM, None)
+    assert control.stopping and control.aborted
+
+
+def test_can_finish_from_the_download_rate():
+    control = JobControl(end_time=time.time() + 1000, stop_margin_seconds=300, abort_margin_seconds=60)
+    # Too small to say anything about the rate
+    control.record_attempt({"returncode": 0, "bytes": 1000, "elapsed": 1.0, "ttfb": 0.1})
+    assert control.can_finish(10**12)
+    # 10 MiB/s once the time to the first byte is taken off
+    control.record_attempt({"returncode": 0, "bytes": 10 * 1024**2, "elapsed": 1.5, "ttfb": 0.5})
+    control.record_attempt({"returncode": 28, "bytes": 50 * 1024**2, "elapsed": 100.0, "ttfb": 0.5})
+    assert control.can_finish(5000 * 1024**2)
+    assert not control.can_finish(10000 * 1024**2)
+    assert control.can_finish(None)
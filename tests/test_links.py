@@ -0,0 +1,52 @@
+import gzip
+
+from source.utils import parse_links_line, iter_links_files, LinkIndex, expectation
+
+DIGEST = "ab" * 32
+
+
+def test_plain_url():
+    assert parse_links_line("https://example.org/a.nc") == ("https://example.org/a.nc", None, [])
+
+
+def test_size_digest_and_mirrors():
+    url, expected, mirrors = parse_links_line(f"https://a.org/x.nc size=100 SHA256={DIGEST.upper()} "
+                                              f"https://b.org/x.nc?sig=1 https://a.org/x.nc https://b.org/x.nc?sig=1")
+    assert url == "https://a.org/x.nc"
+    assert expected == expectation(100, "sha256", DIGEST)
+    # The line's own URL and repeated mirrors are dropped; "=" in a mirror's query is not a token
+    assert mirrors == ["https://b.org/x.nc?sig=1"]
+
+
+def test_unknown_tokens_are_ignored():
+    assert parse_links_line("https://a.org/x.nc size=big colour=red") == ("https://a.org/x.nc", None, [])
+
+
+def test_links_files_are_streamed_from_globs_and_gzip(tmp_path):
+    (tmp_path / "links1.txt").write_text("https://a.org/1.nc\n\n  https://a.org/2.nc size=5  \n")
+    with gzip.open(tmp_path / "links2.txt.gz", 'wt') as f:
+        f.write("https://a.org/3.nc\n")
+    entries = list(iter_links_files(str(tmp_path / "links*")))
+    assert [url for url, _, _ in entries] == ["https://a.org/1.nc", "https://a.org/2.nc", "https://a.org/3.nc"]
+    assert entries[1][1] == expectation(size=5)
+
+
+def test_index_deduplicates_and_keeps_the_first_expectation():
+    index = LinkIndex([("https://a.org/1.nc", None, ["https://m.org/1.nc"]),
+                       ("https://a.org/1.nc", expectation(size=7), ["https://n.org/1.nc"]),
+                       ("https://a.org/2.nc", expectation(size=3), ()),
+                       ("https://a.org/2.nc", expectation(size=4), ())])
+    assert list(index) == ["https://a.org/1.nc", "https://a.org/2.nc"]
+    assert index.duplicates == 2
+    assert index.expectations["https://a.org/1.nc"]["size"] == 7
+    assert index.expectations["https://a.org/2.nc"]["size"] == 3
+    assert index.mirrors["https://a.org/1.nc"] == ["https://m.org/1.nc", "https://n.org/1.nc"]
+
+
+def test_index_renames_colliding_filenames():
+    index = LinkIndex.from_urls(["https://a.org/data.nc", "https://b.org/data.nc", "https://c.org/data.nc",
+                                 "https://a.org/data_1.nc", "https://a.org/"])
+    assert [index.filename(url) for url in index] == ["data.nc", "data_1.nc", "data_2.nc", "data_1_1.nc",
+                                                      "file_4.download"]
+    assert index.renamed == 3
+    assert "https://b.org/data.nc" in index and "https://d.org/data.nc" not in index
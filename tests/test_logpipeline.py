@@ -0,0 +1,37 @@
+from source.logpipeline import ProgressTracker, classify
+
+
+def test_classify_uses_the_leading_tag():
+    assert classify("[COMPLETED] a.bin") == ("INFO", "COMPLETED")
+    assert classify("[FAILED] a.bin (URL: x)") == ("WARNING", "FAILED")
+    assert classify("[ERROR] disk full") == ("ERROR", "ERROR")
+    assert classify("no tag here") == ("INFO", None)
+
+
+def test_progress_counts_every_byte_once():
+    tracker = ProgressTracker(interval_seconds=0)
+    size = [100]
+    tracker.begin("u", "a.bin", 1000, lambda: size[0])
+    size[0] = 400
+    tracker.report()
+    size[0] = 1000
+    tracker.end("u")
+    assert tracker.bytes_total == 900
+    assert tracker.finished == 1
+
+
+def test_transfer_ending_during_a_report_is_counted_once():
+    tracker = ProgressTracker(interval_seconds=0)
+    size = [0]
+
+    def sample():
+        # The transfer finishes while report() is sampling it
+        size[0] = 500
+        tracker.end("u")
+        return size[0]
+
+    tracker.begin("u", "a.bin", 500, lambda: size[0])
+    tracker._active["u"][2] = sample
+    tracker.report()
+    assert tracker.bytes_total == 500
+    assert tracker.finished == 1
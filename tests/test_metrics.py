@@ -0,0 +1,63 @@
+import io
+import json
+
+from source.metrics import MetricsRecorder, percentile, summarize_attempts
+from source.transport import attempt_result
+
+
+def _job(attempts, failovers=0, source_index=0):
+    return {"url": "http://a/f.nc", "host": "a", "filename": "f.nc", "attempts": attempts,
+            "failovers": failovers, "source_index": source_index, "segmented_size": None}
+
+
+def test_percentile():
+    assert percentile([], 0.5) is None
+    assert percentile([1, 2, 3, 4], 0.5) in (2, 3)
+    assert percentile([1, 2, 3, 4], 0.95) == 4
+
+
+def test_attempts_are_logged_and_aggregated(tmp_path):
+    recorder = MetricsRecorder(str(tmp_path / "attempts.jsonl"), str(tmp_path / "summary.json"),
+                               str(tmp_path / "downloader.prom"), labels={"job": "1"})
+    recorder.record_attempt(_job(1), attempt_result(56, error="reset"), False, "reset")
+    recorder.record_retry_scheduled("a", 10)
+    recorder.record_attempt(_job(2), attempt_result(0, 200, 1000, elapsed=2.0, ttfb=0.5), True)
+    recorder.stop()
+
+    with open(tmp_path / "attempts.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    assert [(r["retry"], r["success"], r["returncode"]) for r in records] == [(0, False, 56), (1, True, 0)]
+    assert records[1]["transfer_time"] == 1.5 and records[1]["job"] == "1"
+    with open(tmp_path / "summary.json") as f:
+        summary = json.load(f)
+    assert summary["attempts_total"] == {"failure": 1, "success": 1} and summary["bytes_total"] == 1000
+    assert summary["retries_scheduled_total"] == 1 and summary["backoff_seconds_total"] == 10
+    assert 'hpc_downloader_bytes_total{job="1"} 1000' in (tmp_path / "downloader.prom").read_text()
+
+
+def test_failovers_are_not_counted_as_retries(tmp_path):
+    recorder = MetricsRecorder(str(tmp_path / "attempts.jsonl"), str(tmp_path / "summary.json"),
+                               str(tmp_path / "downloader.prom"), labels={"job": "1"})
+    recorder.record_attempt(_job(1), attempt_result(7, error="refused"), False, "refused")
+    recorder.record_failover("a")
+    recorder.record_attempt(_job(2, failovers=1, source_index=1), attempt_result(28), False, "timeout")
+    recorder.record_retry_scheduled("a", 10)
+    # Every mirror failed; the retry starts again from the first source
+    recorder.record_attempt(_job(3, failovers=1), attempt_result(0, 200, 1000, elapsed=1.0, ttfb=0.2), True)
+    recorder.stop()
+
+    with open(tmp_path / "attempts.jsonl") as f:
+        records = [json.loads(line) for line in f]
+    assert [(r["retry"], r["failover"]) for r in records] == [(0, False), (0, True), (1, False)]
+    assert records[0]["job"] == "1"
+    with open(tmp_path / "summary.json") as f:
+        summary = json.load(f)
+    assert summary["failovers_total"] == 1 and summary["retries_scheduled_total"] == 1
+    assert summary["attempts_total"] == {"failure": 2, "success": 1} and summary["bytes_total"] == 1000
+    prometheus = (tmp_path / "downloader.prom").read_text()
+    assert 'hpc_downloader_failovers_total{job="1"} 1' in prometheus
+    assert 'hpc_downloader_attempts_total{job="1",outcome="success"} 1' in prometheus
+
+    out = io.StringIO()
+    summarize_attempts([str(tmp_path / "attempts.jsonl")], out)
+    assert "a: 3 attempts (2 failed, 1 retries, 1 failovers)" in out.getvalue()
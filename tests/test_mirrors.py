@@ -0,0 +1,64 @@
+import source.mirrors as mirrors
+from source.mirrors import MirrorRanker, source_key
+from source.transport import probe_result, attempt_result
+
+MB = 1024 * 1024
+
+
+class FakeTransport:
+    """Answers probes from a table of url -> probe result and counts them"""
+
+    def __init__(self, probes):
+        self.probes = probes
+        self.calls = []
+
+    def probe(self, url, options, headers=None):
+        self.calls.append(url)
+        return self.probes.get(url) or probe_result(7, error="Failed to connect")
+
+
+def _probe(size, ranges=True):
+    return probe_result(0, 200, size, ranges)
+
+
+def test_source_key():
+    assert source_key("https://Mirror.org:8443/a/b.nc") == "mirror.org:8443"
+
+
+def test_unmeasured_hosts_are_probed_once_and_measured_ones_ranked_by_speed():
+    urls = ["http://a/f", "http://b/f", "http://c/f"]
+    transport = FakeTransport({url: _probe(100 * MB) for url in urls})
+    ranker = MirrorRanker(transport, {})
+    ranker.rank(urls, 100 * MB)
+    assert sorted(transport.calls) == urls
+    ranker.record("http://a/f", attempt_result(0, 200, 10 * MB, elapsed=10.1, ttfb=0.1)) # 1 MB/s
+    ranker.record("http://b/f", attempt_result(0, 200, 10 * MB, elapsed=1.1, ttfb=0.1))  # 10 MB/s
+    ranker.record("http://c/f", attempt_result(28, error="timeout"))
+    assert ranker.rank(urls, 100 * MB) == ["http://b/f", "http://a/f", "http://c/f"]
+    assert len(transport.calls) == 3
+    assert ranker.describe("http://b/f").startswith("b (")
+
+
+def test_range_sources_need_ranges_and_the_same_size():
+    urls = ["http://a/f", "http://b/f", "http://c/f", "http://d/f"]
+    transport = FakeTransport({"http://b/f": _probe(100), "http://c/f": _probe(100, ranges=False),
+                               "http://d/f": _probe(99)})
+    ranker = MirrorRanker(transport, {})
+    assert ranker.range_sources(urls, 100) == ["http://a/f", "http://b/f"]
+    # The first URL was checked by the caller; mirror probes are reused
+    assert ranker.range_sources(urls, 100) == ["http://a/f", "http://b/f"]
+    assert sorted(transport.calls) == urls[1:]
+
+
+def test_probe_cache_expires_and_is_bounded(monkeypatch):
+    transport = FakeTransport({f"http://m{i}/f": _probe(100) for i in range(10)})
+    ranker = MirrorRanker(transport, {}, probe_max_age_seconds=0)
+    ranker.range_sources(["http://a/f", "http://m0/f"], 100)
+    ranker.range_sources(["http://a/f", "http://m0/f"], 100)
+    assert transport.calls == ["http://m0/f"] * 2
+
+    monkeypatch.setattr(mirrors, "_MAX_CACHED_PROBES", 3)
+    ranker = MirrorRanker(transport, {})
+    for i in range(10):
+        ranker.range_sources(["http://a/f", f"http://m{i}/f"], 100)
+    assert list(ranker._probes) == ["http://m7/f", "http://m8/f", "http://m9/f"]
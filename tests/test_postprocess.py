@@ -0,0 +1,80 @@
+import io
+import gzip
+import tarfile
+import zipfile
+
+import pytest
+
+from source.postprocess import extract_file, run_hook
+
+
+def _tar(path, members, links=()):
+    with tarfile.open(path, 'w:gz') as archive:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+        for name, target in links:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.SYMTYPE
+            info.linkname = target
+            archive.addfile(info)
+
+
+def test_tar_is_extracted_into_a_directory_named_after_it(tmp_path):
+    _tar(tmp_path / "data.tar.gz", {"a.txt": b"a", "sub/b.txt": b"b"})
+    out = tmp_path / "out"
+    assert extract_file(str(tmp_path / "data.tar.gz"), str(out)).startswith("extracted 2 members")
+    assert (out / "data" / "sub" / "b.txt").read_bytes() == b"b"
+    # Extracting again replaces the directory as a whole
+    _tar(tmp_path / "data.tar.gz", {"c.txt": b"c"})
+    extract_file(str(tmp_path / "data.tar.gz"), str(out))
+    assert sorted(p.name for p in (out / "data").iterdir()) == ["c.txt"]
+
+
+def test_zip_and_single_compressed_files(tmp_path):
+    with zipfile.ZipFile(tmp_path / "set.ZIP", 'w') as archive:
+        archive.writestr("x/y.txt", "y")
+    with gzip.open(tmp_path / "table.csv.gz", 'wb') as f:
+        f.write(b"1,2\n")
+    (tmp_path / "plain.nc").write_bytes(b"nc")
+    out = tmp_path / "out"
+    extract_file(str(tmp_path / "set.ZIP"), str(out))
+    assert extract_file(str(tmp_path / "table.csv.gz"), str(out)) == f"decompressed to {out / 'table.csv'}"
+    assert extract_file(str(tmp_path / "plain.nc"), str(out)) == "nothing to extract"
+    assert (out / "set" / "x" / "y.txt").read_text() == "y"
+    assert (out / "table.csv").read_bytes() == b"1,2\n"
+
+
+@pytest.mark.parametrize("members, links", [
+    ({"../escaped.txt": b"x"}, ()),
+    ({"/tmp/escaped.txt": b"x"}, ()),
+    ({}, [("etc", "/etc")]),
+    ({}, [("sub/up", "../../..")]),
+])
+def test_tar_members_outside_the_target_are_refused(tmp_path, members, links):
+    _tar(tmp_path / "evil.tar.gz", members, links)
+    out = tmp_path / "out"
+    with pytest.raises(ValueError, match="would land outside"):
+        extract_file(str(tmp_path / "evil.tar.gz"), str(out))
+    # Nothing is left behind, not even the temporary directory
+    assert list(out.iterdir()) == []
+
+
+def test_zip_members_outside_the_target_are_refused(tmp_path):
+    with zipfile.ZipFile(tmp_path / "evil.zip", 'w') as archive:
+        archive.writestr("../../escaped.txt", "x")
+    with pytest.raises(ValueError, match="would land outside"):
+        extract_file(str(tmp_path / "evil.zip"), str(tmp_path / "out"))
+    assert not (tmp_path / "escaped.txt").exists()
+
+
+def test_shell_hook_quotes_its_arguments(tmp_path):
+    path = tmp_path / "it's here.txt"
+    path.write_text("x")
+    assert run_hook("shell:test -f {path} && test {url} = 'http://a/?b=1&c'", str(path), "http://a/?b=1&c") \
+        .startswith("ran ")
+    with pytest.raises(RuntimeError):
+        run_hook("shell:false", str(path), "u")
+    with pytest.raises(ValueError):
+        run_hook("unknown:x", str(path), "u")
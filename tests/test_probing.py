@@ -0,0 +1,67 @@
+import pytest
+
+from benchmarks.server import BenchmarkServer
+from source.probing import cached_probe, store_probe, probe_urls, order_urls, project_eta
+from source.state import StateStore, STATUS_COMPLETED
+from source.transport import get_transport, probe_result
+from source.utils import format_duration
+
+OPTIONS = {"curl_connect_timeout_seconds": 5, "curl_max_time_seconds": 30}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    yield store
+    store.close()
+
+
+def _sizes(store, sizes):
+    for url, size in sizes.items():
+        store_probe(store, url, probe_result(0, 200, size, True))
+
+
+def test_probe_cache_expires(store):
+    _sizes(store, {"http://a/1": 10})
+    assert cached_probe(store, "http://a/1", 60)["content_length"] == 10
+    store.update("http://a/1", probed_at=1.0)
+    assert cached_probe(store, "http://a/1", 60) is None
+    assert cached_probe(store, "http://a/2") is None
+
+
+def test_probe_urls_skips_completed_and_cached(store):
+    server = BenchmarkServer().start()
+    transport = get_transport("http")
+    try:
+        urls = [f"{server.base_url}/p/f{i}_{1000 * (i + 1)}.bin" for i in range(5)]
+        store.set_status(urls[0], STATUS_COMPLETED)
+        _sizes(store, {urls[1]: 1})
+        assert probe_urls(urls, store, transport, OPTIONS, concurrency=2) == 3
+        assert [store.get(url)["content_length"] for url in urls[1:]] == [1, 3000, 4000, 5000]
+    finally:
+        transport.close()
+        server.stop()
+
+
+def test_orders(store):
+    urls = ["http://a/1", "http://a/2", "http://b/3", "http://b/4", "http://a/5", "http://c/6", "http://a/7"]
+    _sizes(store, {"http://a/1": 100, "http://a/2": 90, "http://b/3": 60, "http://b/4": 50, "http://a/5": 5,
+                   "http://a/7": 10})
+    store.set_status("http://a/5", STATUS_COMPLETED)
+    store.update("http://a/2", bytes_done=10) # Only what is left counts
+    assert order_urls(urls, store) == urls
+    # http://c/6 has no known size and counts as the average of the remaining known sizes (300 / 5 = 60)
+    assert order_urls(urls, store, "largest_first") == ["http://a/1", "http://a/2", "http://b/3", "http://c/6",
+                                                        "http://b/4", "http://a/7", "http://a/5"]
+    # Host a's two largest files outrank all of b's, but once a/1 is taken b has more bytes left than a
+    assert order_urls(urls, store, "host_balanced") == ["http://a/1", "http://b/3", "http://a/2", "http://c/6",
+                                                        "http://b/4", "http://a/7", "http://a/5"]
+    with pytest.raises(ValueError):
+        order_urls(urls, store, "random")
+
+
+def test_project_eta(store):
+    _sizes(store, {"http://a/1": 100, "http://a/2": 60, "http://a/3": 50})
+    projection = project_eta(["http://a/1", "http://a/2", "http://a/3", "http://a/4"], store, 2, 10)
+    assert projection == {"urls": 4, "unknown_size": 1, "bytes": 210, "largest_bytes": 100, "eta_seconds": 11.0}
+    assert format_duration(projection["eta_seconds"]) == "00h00m11s"
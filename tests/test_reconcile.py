@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+from benchmarks.server import BenchmarkServer, file_pattern
+from source.reconcile import (reconcile_partial_downloads, RECONCILE_COMPLETE, RECONCILE_RESUME,
+                              RECONCILE_TRUNCATED, RECONCILE_RESTART)
+from source.state import StateStore, STATUS_COMPLETED, STATUS_PENDING
+from source.transport import get_transport
+
+SIZE = 200000
+OPTIONS = {"curl_connect_timeout_seconds": 5, "curl_max_time_seconds": 30,
+           "curl_speed_time_seconds": 0, "curl_speed_limit_bytes_per_sec": 0}
+
+
+def _content(path):
+    pattern = file_pattern(path)
+    return (pattern * (SIZE // len(pattern) + 1))[:SIZE]
+
+
+@pytest.fixture
+def server():
+    server = BenchmarkServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def transport():
+    transport = get_transport("http")
+    yield transport
+    transport.close()
+
+
+def _reconcile(server, transport, tmp_path, files, staged=None):
+    """Write files (name -> bytes) to download_dir and staged ones to staging_dir, then reconcile them"""
+    download_dir, staging_dir = tmp_path / "downloads", tmp_path / "staging"
+    download_dir.mkdir()
+    staging_dir.mkdir()
+    for name, data in files.items():
+        (download_dir / name).write_bytes(data)
+    for name, data in (staged or {}).items():
+        (staging_dir / (name + ".part")).write_bytes(data)
+    urls = [f"{server.base_url}/r/{name}" for name in sorted(set(files) | set(staged or {}))]
+    store = StateStore(str(tmp_path / "state.db"))
+    outcomes = reconcile_partial_downloads(store, str(download_dir), urls, lambda url: url.rsplit("/", 1)[1],
+                                           transport, OPTIONS, tail_bytes=4096,
+                                           staging_dir=str(staging_dir) if staged is not None else None)
+    return store, outcomes, download_dir, staging_dir
+
+
+def test_matching_partial_is_resumed_and_whole_file_completed(server, transport, tmp_path):
+    partial, whole = f"a_{SIZE}.bin", f"b_{SIZE}.bin"
+    files = {partial: _content(f"/r/{partial}")[:SIZE // 2], whole: _content(f"/r/{whole}")}
+    store, outcomes, _, _ = _reconcile(server, transport, tmp_path, files)
+    assert outcomes == {RECONCILE_RESUME: 1, RECONCILE_COMPLETE: 1}
+    assert store.get(f"{server.base_url}/r/{partial}")["bytes_done"] == SIZE // 2
+    assert store.get_status(f"{server.base_url}/r/{whole}") == STATUS_COMPLETED
+
+
+def test_mismatching_tail_is_cut_back(server, transport, tmp_path):
+    name = f"c_{SIZE}.bin"
+    data = bytearray(_content(f"/r/{name}")[:100000])
+    data[-1000:] = bytes(1000) # A crash left unwritten (zeroed) blocks at the end
+    store, outcomes, download_dir, _ = _reconcile(server, transport, tmp_path, {name: bytes(data)})
+    assert outcomes == {RECONCILE_TRUNCATED: 1}
+    verified = os.path.getsize(download_dir / name)
+    assert 100000 - 1000 <= verified < 100000
+    assert store.get(f"{server.base_url}/r/{name}")["bytes_done"] == verified
+
+
+def test_file_larger_than_the_object_restarts(server, transport, tmp_path):
+    name = f"d_{SIZE}.bin"
+    store, outcomes, download_dir, _ = _reconcile(server, transport, tmp_path, {name: _content(f"/r/{name}") + b"x"})
+    assert outcomes == {RECONCILE_RESTART: 1}
+    assert not (download_dir / name).exists()
+    assert store.get_status(f"{server.base_url}/r/{name}") == STATUS_PENDING
+
+
+def test_staged_partials_are_checked_before_download_dir(server, transport, tmp_path):
+    damaged, whole = f"e_{SIZE}.bin", f"f_{SIZE}.bin"
+    staged_data = bytearray(_content(f"/r/{damaged}")[:50000])
+    staged_data[-10:] = bytes(10)
+    # A stale copy in download_dir is not what the staged download resumes
+    files = {damaged: b"stale"}
+    staged = {damaged: bytes(staged_data), whole: _content(f"/r/{whole}")}
+    store, outcomes, download_dir, staging_dir = _reconcile(server, transport, tmp_path, files, staged)
+    # A whole staged file still has to be flushed, so it is only marked resumable
+    assert outcomes == {RECONCILE_TRUNCATED: 1, RECONCILE_RESUME: 1}
+    assert os.path.getsize(staging_dir / (damaged + ".part")) < 50000
+    assert (download_dir / damaged).read_bytes() == b"stale"
+    assert store.get_status(f"{server.base_url}/r/{whole}") != STATUS_COMPLETED
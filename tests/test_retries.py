@@ -0,0 +1,75 @@
+import itertools
+import threading
+
+from source.downloader import _run_downloads, retry_policy_from_params
+from source.scheduler import AdaptiveConcurrencyController, RetryPolicy
+
+
+def _policy():
+    return RetryPolicy([{"name": "normal", "label": "SCRIPT RETRY", "options": {"stage": 1},
+                         "max_retries": 3, "initial_delay_seconds": 10},
+                        {"name": "skipped", "label": "NONE", "options": {}, "max_retries": 0,
+                         "initial_delay_seconds": 1},
+                        {"name": "aggressive", "label": "AGGRESSIVE RETRY", "options": {"stage": 2},
+                         "max_retries": 2, "initial_delay_seconds": 200}])
+
+
+def test_delays_double_per_stage_and_run_out():
+    policy = _policy()
+    state = policy.new_state()
+    delays = []
+    delay = policy.next_delay(state)
+    while delay is not None:
+        delays.append((delay, policy.options(state)["stage"]))
+        delay = policy.next_delay(state)
+    # Empty stages are passed over; backoff is capped at five minutes
+    assert delays == [(10, 1), (20, 1), (40, 1), (200, 2), (300, 2)]
+    assert policy.total_retries() == 5
+
+
+def test_aggressive_stage_from_params():
+    policy = retry_policy_from_params({"curl_max_time_seconds": 60}, {"downloader_max_retries": 1},
+                                      {"downloader_max_retries": 2, "curl_max_time_seconds": 600})
+    state = policy.new_state()
+    assert policy.next_delay(state) == 10
+    policy.next_delay(state)
+    assert policy.stage(state)["name"] == "aggressive"
+    assert policy.options(state)["curl_max_time_seconds"] == 600
+    # A fresh attempt plus downloader_max_retries retries
+    assert policy.total_retries() == 1 + 3
+
+
+def test_failed_urls_are_retried_from_the_delay_queue():
+    urls = [f"http://host{i % 3}.example/f{i}.bin" for i in range(30)]
+    runs = {}
+    lock = threading.Lock()
+
+    def run_download(url):
+        with lock:
+            runs[url] = runs.get(url, 0) + 1
+            return runs[url]
+
+    def on_result(url, future):
+        # Every URL fails twice and is retried after a short delay
+        return 0.01 if future.result() < 3 else None
+
+    controller = AdaptiveConcurrencyController(4, adaptive=False)
+    left = _run_downloads(iter(urls), run_download, on_result, controller)
+    assert left == []
+    assert runs == {url: 3 for url in urls}
+    assert controller.in_flight == 0
+
+
+def test_stop_returns_urls_that_never_ran():
+    urls = [f"http://host.example/f{i}.bin" for i in range(100)]
+    started = itertools.count()
+    stop = threading.Event()
+
+    def run_download(url):
+        if next(started) >= 5:
+            stop.set()
+
+    controller = AdaptiveConcurrencyController(1, adaptive=False)
+    left = _run_downloads(iter(urls), run_download, lambda url, future: None, controller, should_stop=stop.is_set)
+    assert 0 < len(left) < 100
+    assert set(left) <= set(urls)
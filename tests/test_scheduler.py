@@ -0,0 +1,70 @@
+from source.scheduler import AdaptiveConcurrencyController, url_host
+
+OK = {"returncode": 0, "bytes": 1000}
+THROTTLED = {"returncode": 22, "http_status": 429, "retry_after": 60}
+TIMEOUT = {"returncode": 28, "http_status": None}
+
+
+def test_url_host():
+    assert url_host("https://Data.Example.org:8443/a/b.nc?x=1") == "data.example.org"
+
+
+def test_fixed_pool_limits_only_the_total():
+    controller = AdaptiveConcurrencyController(3, adaptive=False)
+    assert all(controller.try_acquire("a") for _ in range(3))
+    assert not controller.try_acquire("b")
+    controller.release("a")
+    assert controller.try_acquire("b")
+
+
+def test_host_limit_grows_on_success_and_halves_on_throttling():
+    controller = AdaptiveConcurrencyController(16, per_host_initial=2, per_host_max=4, adjust_interval_seconds=3600)
+    assert controller.try_acquire("a") and controller.try_acquire("a")
+    assert not controller.try_acquire("a")
+    assert controller.try_acquire("b") # Other hosts are not affected
+    for _ in range(10):
+        controller.record_attempt("a", OK)
+    assert controller.try_acquire("a") and controller.try_acquire("a")
+    assert not controller.try_acquire("a") # per_host_max
+    controller.record_attempt("a", THROTTLED)
+    for _ in range(4):
+        controller.release("a")
+    # Halved and paused for Retry-After
+    assert not controller.host_available("a")
+    assert 59 <= controller.host_backoff_remaining("a") <= 60
+    assert 59 <= controller.next_unblock_in() <= 60
+    controller._hosts["a"].blocked_until = 0
+    assert controller.try_acquire("a") and controller.try_acquire("a")
+    assert not controller.try_acquire("a")
+
+
+def test_throttling_pauses_hosts_in_a_fixed_pool_too():
+    controller = AdaptiveConcurrencyController(4, adaptive=False)
+    controller.record_attempt("a", THROTTLED)
+    assert not controller.try_acquire("a")
+    assert controller.try_acquire("b")
+
+
+def test_network_errors_cut_the_total_limit():
+    controller = AdaptiveConcurrencyController(8, min_total=2, max_total=16, adjust_interval_seconds=0)
+    for _ in range(5):
+        controller.record_attempt("a", TIMEOUT)
+    controller.try_acquire("a") # Re-evaluates the limit
+    assert controller.total_limit == 6
+    # Throttle responses are the host's business and leave the total alone
+    controller.release("a")
+    for _ in range(5):
+        controller.record_attempt("b", THROTTLED)
+    controller.try_acquire("c")
+    assert controller.total_limit == 6
+
+
+def test_total_limit_grows_while_it_is_the_bottleneck():
+    controller = AdaptiveConcurrencyController(2, max_total=4, per_host_initial=8, adjust_interval_seconds=30)
+    for expected in (3, 4, 4):
+        while controller.try_acquire("a"):
+            pass
+        controller.record_attempt("a", OK)
+        controller._window_start -= 30 # The interval is over
+        controller.try_acquire("a") # Re-evaluates the limit
+        assert controller.total_limit == expected
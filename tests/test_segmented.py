@@ -0,0 +1,111 @@
+import os
+import json
+
+import pytest
+
+from benchmarks.server import BenchmarkServer, file_pattern, expected_content_digest
+from source.segmented import (plan_segments, segments_file_path, segmented_bytes_done, _load_progress,
+                              _save_progress, download_segmented)
+from source.transport import get_transport
+
+SIZE = 1000003
+OPTIONS = {"curl_connect_timeout_seconds": 5, "curl_max_time_seconds": 30,
+           "curl_speed_time_seconds": 0, "curl_speed_limit_bytes_per_sec": 0, "digest_algorithm": "sha256"}
+
+
+def _content(path):
+    pattern = file_pattern(path)
+    return (pattern * (SIZE // len(pattern) + 1))[:SIZE]
+
+
+@pytest.fixture
+def server():
+    server = BenchmarkServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def transport():
+    transport = get_transport("http")
+    yield transport
+    transport.close()
+
+
+def test_plan_segments_covers_the_file():
+    segments = plan_segments(10, 3)
+    assert segments == [[0, 2, 0], [3, 5, 0], [6, 9, 0]]
+    assert plan_segments(2, 8) == [[0, 0, 0], [1, 1, 0]]
+
+
+def test_single_stream_partial_is_credited_to_leading_segments(tmp_path):
+    path = str(tmp_path / "f.bin")
+    with open(path, 'wb') as f:
+        f.write(b"x" * 25)
+    assert _load_progress(path, "u", 100, 4) == [[0, 24, 25], [25, 49, 0], [50, 74, 0], [75, 99, 0]]
+
+
+def test_sidecar_is_reused_only_for_the_same_url_and_size(tmp_path):
+    path = str(tmp_path / "f.bin")
+    with open(path, 'wb') as f:
+        f.truncate(100)
+    segments = [[0, 49, 10], [50, 99, 20]]
+    _save_progress(path, "u", 100, segments)
+    assert segmented_bytes_done(path) == 30
+    assert _load_progress(path, "u", 100, 4) == segments
+    # Another size means another layout: the preallocated file can't be trusted
+    assert _load_progress(path, "u", 120, 2) == [[0, 59, 0], [60, 119, 0]]
+    assert not os.path.exists(path)
+
+
+def test_segmented_download_is_hashed_while_written(server, transport, tmp_path):
+    name = f"/s/a_{SIZE}.bin"
+    path = str(tmp_path / "a.bin")
+    result = download_segmented(server.base_url + name, path, "a.bin", transport, OPTIONS, SIZE, 4, 0, 0)
+    assert result["returncode"] == 0 and result["bytes"] == SIZE
+    assert result["digest"] == expected_content_digest(name)
+    with open(path, 'rb') as f:
+        assert f.read() == _content(name)
+    assert not os.path.exists(segments_file_path(path))
+
+
+def test_resume_fetches_only_missing_ranges(server, transport, tmp_path):
+    name = f"/s/b_{SIZE}.bin"
+    url = server.base_url + name
+    path = str(tmp_path / "b.bin")
+    content = _content(name)
+    segments = plan_segments(SIZE, 3)
+    # An earlier attempt got half of the first segment and all of the last one
+    segments[0][2] = 1000
+    segments[2][2] = segments[2][1] - segments[2][0] + 1
+    with open(path, 'wb') as f:
+        f.truncate(SIZE)
+        f.seek(0)
+        f.write(content[:1000])
+        f.seek(segments[2][0])
+        f.write(content[segments[2][0]:])
+    _save_progress(path, url, SIZE, segments)
+    result = download_segmented(url, path, "b.bin", transport, OPTIONS, SIZE, 3, 0, 0)
+    assert result["returncode"] == 0
+    assert result["bytes"] == segments[2][0] - 1000
+    assert result["digest"] == expected_content_digest(name)
+
+
+def test_failed_segments_move_on_to_the_next_mirror(server, transport, tmp_path):
+    name = f"/s/c_{SIZE}.bin"
+    sources = ["http://127.0.0.1:9" + name, server.base_url + name]
+    seen = []
+    path = str(tmp_path / "c.bin")
+    result = download_segmented(sources[0], path, "c.bin", transport, OPTIONS, SIZE, 4, 0, 0,
+                                sources=sources, on_result=lambda source, r: seen.append((source, r["returncode"])))
+    assert result["returncode"] == 0
+    assert result["digest"] == expected_content_digest(name)
+    assert {source for source, returncode in seen if returncode != 0} == {sources[0]}
+
+
+def test_incomplete_download_keeps_its_progress(transport, tmp_path):
+    path = str(tmp_path / "d.bin")
+    result = download_segmented(f"http://127.0.0.1:9/s/d_{SIZE}.bin", path, "d.bin", transport, OPTIONS, SIZE, 2, 0, 0)
+    assert result["returncode"] != 0 and "2/2 segments incomplete" in result["error"]
+    with open(segments_file_path(path), 'r') as f:
+        assert json.load(f)["size"] == SIZE
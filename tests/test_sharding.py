@@ -0,0 +1,96 @@
+import os
+import multiprocessing
+
+from source.sharding import detect_slurm_task, partition_links, SharedWorkQueue
+from source.state import StateStore, STATUS_COMPLETED
+
+URLS = [f"http://example.org/data/file{i}.bin" for i in range(500)]
+
+
+def _claim_all(queue_dir, task_index, out_path):
+    queue = SharedWorkQueue(queue_dir, URLS, task_index, claim_batch_size=7)
+    with open(out_path, 'w') as f:
+        for url in queue.iter_urls():
+            f.write(url + "\n")
+
+
+def _download_share(state_dir, task_index, task_count):
+    store = StateStore(os.path.join(state_dir, f"state.task{task_index}.db"), commit_batch_size=10)
+    for url in partition_links(URLS, task_index, task_count):
+        store.set_status(url, STATUS_COMPLETED, bytes_done=1)
+    store.close()
+
+
+def _run(target, args_list):
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=target, args=args) for args in args_list]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+
+def test_detect_slurm_task():
+    assert detect_slurm_task({}) == (0, 1)
+    assert detect_slurm_task({"SLURM_PROCID": "2", "SLURM_NTASKS": "4"}) == (2, 4)
+    # Array indices count from SLURM_ARRAY_TASK_MIN and take precedence over srun tasks
+    assert detect_slurm_task({"SLURM_ARRAY_TASK_ID": "3", "SLURM_ARRAY_TASK_COUNT": "3", "SLURM_ARRAY_TASK_MIN": "1",
+                              "SLURM_PROCID": "0", "SLURM_NTASKS": "1"}) == (2, 3)
+
+
+def test_static_partition_covers_every_url_once():
+    shares = [partition_links(URLS, i, 4) for i in range(4)]
+    assert sorted(url for share in shares for url in share) == sorted(URLS)
+    assert partition_links(URLS, 0, 1) == URLS
+
+
+def test_every_url_is_claimed_exactly_once_by_concurrent_tasks(tmp_path):
+    queue_dir = str(tmp_path / "queue")
+    outputs = [str(tmp_path / f"claimed.{i}.txt") for i in range(4)]
+    _run(_claim_all, [(queue_dir, i, out) for i, out in enumerate(outputs)])
+    claimed = []
+    for out in outputs:
+        with open(out) as f:
+            claimed.extend(line.strip() for line in f)
+    assert len(claimed) == len(URLS)
+    assert sorted(claimed) == sorted(URLS)
+
+
+def test_given_back_urls_are_claimed_first(tmp_path):
+    queue = SharedWorkQueue(str(tmp_path), URLS, 0, claim_batch_size=5)
+    urls = queue.iter_urls()
+    first = [next(urls), next(urls)]
+    # The two started URLs and the three not yet served go back to the queue
+    queue.give_back(first)
+    other = SharedWorkQueue(str(tmp_path), URLS, 1, claim_batch_size=5)
+    assert sorted(other.claim()) == sorted(URLS[:5])
+    assert other.claim() == URLS[5:10]
+    assert other.remaining() == len(URLS) - 10
+
+
+def test_per_task_journals_are_merged(tmp_path):
+    state_dir = str(tmp_path)
+    _run(_download_share, [(state_dir, i, 3) for i in range(3)])
+    store = StateStore(os.path.join(state_dir, "state.task0.db"))
+    others = [os.path.join(state_dir, f"state.task{i}.db") for i in (1, 2)]
+    assert store.merge_journals(others) == len(URLS) - len(partition_links(URLS, 0, 3))
+    assert all(store.get_status(url) == STATUS_COMPLETED for url in URLS)
+    # Nothing newer the second time
+    assert store.merge_journals(others) == 0
+    store.close()
+
+
+def test_merge_keeps_the_newer_record(tmp_path):
+    ours = StateStore(str(tmp_path / "state.task0.db"))
+    theirs = StateStore(str(tmp_path / "state.task1.db"))
+    theirs.update(URLS[0], status="FAILED", last_error="old")
+    theirs.set_meta("checkpoint", "{}")
+    theirs.set_meta("existing_files_verified:job", "1")
+    theirs.close()
+    ours.set_status(URLS[0], STATUS_COMPLETED)
+    ours.merge_journals([str(tmp_path / "state.task1.db")])
+    assert ours.get_status(URLS[0]) == STATUS_COMPLETED
+    assert ours.get_meta("existing_files_verified:job") == "1"
+    assert ours.get_meta("checkpoint") is None # Belongs to the other task
+    ours.close()
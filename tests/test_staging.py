@@ -0,0 +1,103 @@
+import os
+import errno
+import threading
+
+import pytest
+
+from source import staging as staging_module
+from source.staging import StagingArea, move_file, staging_dir_from_params
+
+
+def _staged(area, name, size):
+    path = area.stage_path(name)
+    with open(path, 'wb') as f:
+        f.write(b"x" * size)
+    return path
+
+
+def test_admit_bounds_scratch_use(tmp_path):
+    area = StagingArea(str(tmp_path / "scratch"), str(tmp_path / "out"), max_bytes=100)
+    assert area.admit("a", 60)
+    assert area.admit("a", 60) # A retry keeps its reservation
+    assert not area.admit("b", 60)
+    assert area.admit("c", 40)
+    assert area.used_bytes() == 100
+    area.release("a")
+    assert area.admit("b", 60)
+    # One file larger than the whole area is still admitted on its own
+    other = StagingArea(str(tmp_path / "scratch2"), str(tmp_path / "out"), max_bytes=10)
+    assert other.admit("big", 1000)
+
+
+def test_release_removes_the_partial_file(tmp_path):
+    area = StagingArea(str(tmp_path / "scratch"), str(tmp_path / "out"), max_bytes=100)
+    area.admit("a", 5)
+    path = _staged(area, "a.nc", 5)
+    area.release("a", path)
+    assert not os.path.exists(path) and area.used_bytes() == 0
+
+
+def test_submitted_files_are_flushed_in_a_batch(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    area = StagingArea(str(tmp_path / "scratch"), str(out), max_bytes=1000, flush_batch_bytes=30,
+                       flush_interval_seconds=3600)
+    flushed = []
+    done = threading.Event()
+
+    def on_flushed(name):
+        flushed.append(name)
+        if len(flushed) == 2:
+            done.set()
+
+    area.start()
+    for name in ("a.nc", "b.nc"):
+        area.admit(name, 20)
+        area.submit(name, _staged(area, name, 20), str(out / name), lambda name=name: on_flushed(name))
+    # The second file fills the batch, long before the flush interval
+    assert done.wait(10)
+    area.close()
+    assert sorted(flushed) == ["a.nc", "b.nc"]
+    assert (out / "a.nc").read_bytes() == b"x" * 20
+    assert os.listdir(area.staging_dir) == []
+    assert (area.flushed_files, area.flushed_bytes, area.used_bytes()) == (2, 40, 0)
+
+
+def test_close_flushes_what_is_left_and_records_failures(tmp_path):
+    out = tmp_path / "out"
+    out.mkdir()
+    area = StagingArea(str(tmp_path / "scratch"), str(out), max_bytes=1000, flush_interval_seconds=3600)
+    area.start()
+    area.submit("a", _staged(area, "a.nc", 5), str(out / "a.nc"), lambda: None)
+    area.submit("b", _staged(area, "b.nc", 5), str(out / "missing" / "b.nc"), lambda: None)
+    area.close()
+    assert (out / "a.nc").exists()
+    assert [url for url, _ in area.flush_failures] == ["b"]
+    assert area.flushed_files == 1 and area.used_bytes() == 0
+
+
+def test_move_file_copies_across_filesystems(tmp_path, monkeypatch):
+    src = tmp_path / "src"
+    src.write_bytes(b"data")
+    assert move_file(str(src), str(tmp_path / "renamed")) is False
+
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(staging_module.os, "rename", cross_device)
+    assert move_file(str(tmp_path / "renamed"), str(tmp_path / "copied")) is True
+    assert (tmp_path / "copied").read_bytes() == b"data"
+    assert sorted(os.listdir(tmp_path)) == ["copied"]
+
+    def other_error(src, dst):
+        raise OSError(errno.EACCES, "Permission denied")
+
+    monkeypatch.setattr(staging_module.os, "rename", other_error)
+    with pytest.raises(PermissionError):
+        move_file(str(tmp_path / "copied"), str(tmp_path / "again"))
+
+
+def test_staging_dir_from_params(monkeypatch):
+    monkeypatch.setenv("SCRATCH_TEST_DIR", "/scratch/job")
+    assert staging_dir_from_params({"staging_dir": "$SCRATCH_TEST_DIR/stage"}) == "/scratch/job/stage"
+    assert staging_dir_from_params({"staging_dir": None}) is None
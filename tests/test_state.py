@@ -0,0 +1,55 @@
+import sqlite3
+
+import pytest
+
+from source.state import StateStore, STATUS_COMPLETED, STATUS_FAILED, STATUS_PENDING
+
+
+def _committed(path):
+    with sqlite3.connect(path) as conn:
+        return dict(conn.execute("SELECT url, status FROM downloads").fetchall())
+
+
+def test_writes_are_committed_in_batches(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = StateStore(path, commit_batch_size=3, commit_interval_seconds=3600)
+    store.set_status("a", STATUS_COMPLETED)
+    store.set_status("b", STATUS_PENDING)
+    assert _committed(path) == {}
+    store.set_status("c", STATUS_FAILED)
+    assert _committed(path) == {"a": STATUS_COMPLETED, "b": STATUS_PENDING, "c": STATUS_FAILED}
+    store.record_attempt("a", error="boom", bytes_done=5)
+    store.close()
+
+    store = StateStore(path)
+    record = store.get("a")
+    assert (record["attempts"], record["last_error"], record["bytes_done"]) == (1, "boom", 5)
+    assert store.count_by_status() == {STATUS_COMPLETED: 1, STATUS_PENDING: 1, STATUS_FAILED: 1}
+    assert store.get("missing") is None
+    with pytest.raises(ValueError):
+        store.update("a", colour="red")
+    store.close()
+
+
+def test_records_returned_are_copies(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    store.set_status("a", STATUS_PENDING)
+    store.get("a")["status"] = STATUS_COMPLETED
+    assert store.get_status("a") == STATUS_PENDING
+    store.close()
+
+
+def test_legacy_state_files_are_imported_once(tmp_path):
+    state_dir = tmp_path / "download_state"
+    state_dir.mkdir()
+    (state_dir / "a.nc.state").write_text("COMPLETED\n")
+    (state_dir / "b.nc.state").write_text("curl exit code: 28\n")
+    urls = ["http://x/a.nc", "http://x/b.nc", "http://x/c.nc"]
+    store = StateStore(str(tmp_path / "state.db"))
+    assert store.import_legacy_state_dir(str(state_dir), urls, lambda url: url.rsplit("/", 1)[1]) == 2
+    assert store.get_status("http://x/a.nc") == STATUS_COMPLETED
+    assert store.get("http://x/b.nc")["last_error"] == "curl exit code: 28"
+    assert store.get("http://x/c.nc") is None
+    (state_dir / "c.nc.state").write_text("COMPLETED\n")
+    assert store.import_legacy_state_dir(str(state_dir), urls, lambda url: url.rsplit("/", 1)[1]) == 0
+    store.close()
@@ -0,0 +1,74 @@
+import io
+import json
+
+from source.state import StateStore, STATUS_COMPLETED, STATUS_FAILED
+from source.status import StatusReporter, write_merged_status, write_detail_report
+
+
+def _snapshot(path):
+    lines = path.read_text().splitlines()
+    return dict(line.split(": ", 1) for line in lines[1:] if ": " in line and not line.startswith("  "))
+
+
+def test_counters_follow_each_url(tmp_path):
+    status_path = tmp_path / "download_status.txt"
+    reporter = StatusReporter(str(status_path), ["a", "b", "c", "d"], snapshot_interval_seconds=0)
+    reporter.add_urls(["a", "e"])
+    reporter.record_started("a")
+    reporter.record_success("a", bytes_downloaded=100)
+    reporter.record_success("b", skipped=True)
+    reporter.record_started("c")
+    reporter.record_retry("c")
+    reporter.record_failure("d", "HTTP 404")
+    reporter.record_started("e")
+    reporter.write_snapshot()
+
+    snapshot = _snapshot(status_path)
+    assert snapshot["Total URLs"] == "5"
+    assert (snapshot["Successful"], snapshot["Skipped (already completed)"], snapshot["Failed"]) == ("1", "1", "1")
+    assert (snapshot["In progress"], snapshot["Waiting to retry"], snapshot["Still Pending"]) == ("1", "1", "2")
+    assert snapshot["Finished"] == "3/5 (60.0%)"
+    assert "d (Error: HTTP 404)" in status_path.read_text()
+
+    # A URL that failed and then succeeded on a later pass is no longer failed
+    reporter.record_success("d", bytes_downloaded=1)
+    reporter.stop()
+    assert _snapshot(status_path)["Failed"] == "0"
+
+
+def test_snapshot_every_events(tmp_path):
+    status_path = tmp_path / "download_status.txt"
+    reporter = StatusReporter(str(status_path), ["a", "b"], snapshot_every_events=2, snapshot_interval_seconds=0)
+    reporter.record_success("a")
+    assert not status_path.exists()
+    reporter.record_success("b")
+    assert _snapshot(status_path)["Successful"] == "2"
+
+
+def test_sharded_tasks_are_merged(tmp_path):
+    merged = tmp_path / "download_status.merged.txt"
+    for task, urls in ((0, ["a", "b"]), (1, ["c"])):
+        reporter = StatusReporter(str(tmp_path / f"download_status.task{task}.txt"), urls,
+                                  snapshot_interval_seconds=0, merged_status_path=str(merged))
+        reporter.record_success(urls[0], bytes_downloaded=10)
+        reporter.write_snapshot()
+    assert json.loads((tmp_path / "download_status.task1.json").read_text())["succeeded"] == 1
+    text = merged.read_text()
+    assert "2 tasks" in text and "URLs claimed by tasks: 3" in text and "Successful: 2" in text
+    # A counter file being replaced is skipped
+    (tmp_path / "download_status.task2.json").write_text("{")
+    write_merged_status([str(p) for p in tmp_path.glob("download_status.task*.json")], str(merged))
+    assert "2 tasks" in merged.read_text()
+
+
+def test_detail_report(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    store.set_status("http://h/a", STATUS_COMPLETED, filename="a", bytes_done=5)
+    store.set_status("http://h/b", STATUS_FAILED, filename="b", last_error="HTTP 500")
+    out = io.StringIO()
+    write_detail_report(store, out)
+    store.close()
+    report = out.getvalue()
+    assert "COMPLETED: 1" in report and "FAILED: 1" in report
+    assert "✓ COMPLETED http://h/a [a, 5 bytes, 0 attempts]" in report
+    assert "✗ FAILED http://h/b [b, 0 bytes, 0 attempts] (Error: HTTP 500)" in report
@@ -0,0 +1,146 @@
+import shutil
+
+import pytest
+
+from benchmarks.server import BenchmarkServer, file_pattern, expected_content_digest
+from source.bandwidth import BandwidthGovernor
+from source.transport import get_transport, if_range_validator, parse_retry_after, content_range_total
+
+SIZE = 300001
+OPTIONS = {"curl_retry_attempts": 0, "curl_retry_delay_seconds": 1, "curl_retry_max_time_seconds": 10,
+           "curl_connect_timeout_seconds": 5, "curl_max_time_seconds": 30,
+           "curl_speed_time_seconds": 10, "curl_speed_limit_bytes_per_sec": 1, "digest_algorithm": "sha256"}
+BACKENDS = ["http"] + (["curl"] if shutil.which("curl") else [])
+
+
+def _content(path, version=0):
+    pattern = file_pattern(path, version)
+    return (pattern * (SIZE // len(pattern) + 1))[:SIZE]
+
+
+@pytest.fixture
+def server():
+    server = BenchmarkServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(params=BACKENDS)
+def transport(request):
+    transport = get_transport(request.param)
+    yield transport
+    transport.close()
+
+
+def test_header_helpers():
+    assert parse_retry_after("120") == 120
+    assert content_range_total("bytes 0-99/1000") == 1000
+    assert if_range_validator('"abc"', "Mon, 01 Jan 2024 00:00:00 GMT") == '"abc"'
+    assert if_range_validator(None, None) is None
+
+
+def test_probe(server, transport):
+    probe = transport.probe(f"{server.base_url}/t/a_{SIZE}.bin", OPTIONS)
+    assert probe["returncode"] == 0
+    assert probe["content_length"] == SIZE and probe["accept_ranges"]
+    assert probe["etag"]
+
+
+def test_fetch_resumes_a_partial_file_and_hashes_all_of_it(server, transport, tmp_path):
+    name = f"/t/b_{SIZE}.bin"
+    path = tmp_path / "b.bin"
+    path.write_bytes(_content(name)[:1000])
+    attempt = transport.fetch(server.base_url + name, str(path), "b.bin", OPTIONS)
+    assert attempt["returncode"] == 0
+    assert attempt["digest"] == expected_content_digest(name)
+    assert path.read_bytes() == _content(name)
+
+
+def test_http_backend_keeps_connections_alive(server, tmp_path):
+    transport = get_transport("http")
+    try:
+        for name in ("g", "h"):
+            attempt = transport.fetch(f"{server.base_url}/t/{name}_{SIZE}.bin", str(tmp_path / name), name, OPTIONS)
+            assert attempt["returncode"] == 0
+        # Both downloads went over the same pooled connection
+        assert sum(len(idle) for idle in transport._idle.values()) == 1
+    finally:
+        transport.close()
+    assert transport._idle == {}
+
+
+def test_if_range_restarts_a_partial_file_of_another_version(server, transport, tmp_path):
+    name = f"/t/c_{SIZE}.bin"
+    url = server.base_url + name
+    old = transport.probe(url, OPTIONS)
+    path = tmp_path / "c.bin"
+    path.write_bytes(_content(name)[:1000])
+    server.faults["content_version"] = 1 # The object changed upstream
+    attempt = transport.fetch(url, str(path), "c.bin", dict(OPTIONS, if_range=old["etag"]))
+    if attempt["returncode"] != 0:
+        # curl won't append a whole (200) response to a partial file; it is discarded for the next attempt
+        assert not path.exists()
+        attempt = transport.fetch(url, str(path), "c.bin", OPTIONS)
+    assert attempt["returncode"] == 0
+    assert path.read_bytes() == _content(name, 1)
+    assert attempt["digest"] == expected_content_digest(name, 1)
+
+
+def test_throttling_reports_the_status_and_retry_after(transport, tmp_path):
+    server = BenchmarkServer({"throttle_probability": 1.0, "retry_after_seconds": 7}).start()
+    try:
+        attempt = transport.fetch(f"{server.base_url}/t/d_{SIZE}.bin", str(tmp_path / "d.bin"), "d.bin", OPTIONS)
+    finally:
+        server.stop()
+    assert attempt["returncode"] != 0
+    assert attempt["http_status"] == 429 and attempt["retry_after"] == 7
+
+
+def _stalling_server():
+    # 20 kB/s never reaches the 50 kB/s speed limit below, so every attempt times out mid-body
+    return BenchmarkServer({"bandwidth_bytes_per_sec": 20000}).start()
+
+
+STALL_OPTIONS = dict(OPTIONS, curl_retry_attempts=2, curl_retry_delay_seconds=0, curl_speed_time_seconds=2,
+                     curl_speed_limit_bytes_per_sec=50000)
+
+
+@pytest.mark.skipif("curl" not in BACKENDS, reason="curl is not installed")
+def test_governed_fetch_never_writes_bytes_twice(tmp_path):
+    server = _stalling_server()
+    transport = get_transport("curl", governor=BandwidthGovernor(limit_bytes_per_sec=10**9))
+    name = f"/t/e_{SIZE}.bin"
+    path = tmp_path / "e.bin"
+    try:
+        attempt = transport.fetch(server.base_url + name, str(path), "e.bin", dict(STALL_OPTIONS, digest_algorithm=None))
+        assert attempt["returncode"] == 28
+        # Whatever arrived is a prefix of the object, once
+        assert 0 < path.stat().st_size < SIZE
+        assert path.read_bytes() == _content(name)[:path.stat().st_size]
+        server.faults["bandwidth_bytes_per_sec"] = 0
+        attempt = transport.fetch(server.base_url + name, str(path), "e.bin", dict(OPTIONS, digest_algorithm=None))
+    finally:
+        server.stop()
+    assert attempt["returncode"] == 0
+    assert path.read_bytes() == _content(name)
+
+
+@pytest.mark.skipif("curl" not in BACKENDS, reason="curl is not installed")
+def test_digest_survives_a_timeout_and_resume(tmp_path):
+    server = _stalling_server()
+    transport = get_transport("curl")
+    name = f"/t/f_{SIZE}.bin"
+    path = tmp_path / "f.bin"
+    try:
+        attempt = transport.fetch(server.base_url + name, str(path), "f.bin", STALL_OPTIONS)
+        assert attempt["returncode"] == 28 and attempt["digest"] is None
+        partial = path.stat().st_size
+        assert 0 < partial < SIZE
+        server.faults["bandwidth_bytes_per_sec"] = 0
+        attempt = transport.fetch(server.base_url + name, str(path), "f.bin", STALL_OPTIONS)
+    finally:
+        server.stop()
+    # Resumed where the timeout left off, and the digest covers the bytes from before it too
+    assert attempt["returncode"] == 0 and attempt["bytes"] == SIZE - partial
+    assert attempt["digest"] == expected_content_digest(name)
+    assert path.read_bytes() == _content(name)